@@ -0,0 +1,772 @@
+#!/usr/bin/env python
+"""
+NAME
+    Bench-Fetch-SFTP - Benchmark fetch_sftp.py against a local SFTP server
+
+SYNOPSIS
+    bench_fetch_sftp.py [-h|--help] [-v|--verbose] [--files <n>] \\
+        [--size <bytes>] ... [--latency <ms>] [--bandwidth <bytes>] \\
+        [--scenario <scenario>] ... [--repeat <n>] [--fetcher <file>] \\
+        [--work-dir <dir>] [--keep] [--json] [-- <fetcher options>]
+
+DESCRIPTION
+    Measures the performance of fetch_sftp.py reproducibly without a network
+    and without a real SFTP server. A SFTP server based on paramiko is started
+    on the loopback interface. Its remote directory 'incoming' is populated
+    with synthetic archives of random content and valid state files
+    '<archive>.TRANSFERED' holding the SHA-1 hash of the archive and the name
+    of the state file (see fetch_sftp.py).
+
+    Every scenario is run by a child process executing fetch_sftp.py (with
+    '--no-jitter' to skip the random sleep at its start). Before every run
+    the remote directory is populated again and the local directory, hash
+    index and listing snapshots are emptied, so all runs start cold.
+
+    For every run the wall clock time, the exit code, the bytes transfered,
+    the throughput (bytes per wall clock second), the SFTP round trips (from
+    the metrics of the fetcher, see '--metrics-file' of fetch_sftp.py) and
+    the peak resident set size of the child process are reported.
+
+    A WAN link can be simulated by a latency and a bandwidth limit. The
+    connections of the fetcher are forwarded through a local relay then,
+    which delays every chunk of data by half of the round trip time in each
+    direction and limits the throughput of both directions.
+
+    This script is based on the following non standard python modules:
+        paramiko - SSH 2 protocol for python (licensed under the GNU LGPL)
+        json     - Optional. Needed for the round trips and '--json'
+                   (Python 2.6)
+
+SCENARIOS
+    startup
+        Only starts the fetcher and prints its usage ('--help'), without
+        connecting. Measures the cold start time of the interpreter and the
+        fetcher.
+
+    fetch
+        Fetches all archives in state 'TRANSFERED' and creates the next
+        state 'FETCHED'.
+
+    list-files
+        Lists all remote files ('--list-files').
+
+    no-fetch
+        Only creates the next state 'RELEASED' of all archives in state
+        'TRANSFERED' ('--no-fetch').
+
+    delete-file
+        Fetches all archives in state 'TRANSFERED' and deletes them
+        ('--delete-remote-file').
+
+    delete-previous-statefiles
+        Fetches all archives in state 'TRANSFERED', creates the next state
+        'FETCHED' and deletes the previous state files
+        ('--delete-remote-previous-statefiles').
+
+    delete-all-statefiles
+        Fetches all archives in state 'TRANSFERED' and deletes them together
+        with their empty state files ('--delete-remote-file
+        --delete-remote-all-statefiles').
+
+OPTIONS
+    --files
+        The number of synthetic archives in the remote directory (default:
+        10).
+
+    --size
+        The size of the archives in bytes (default: 1048576). This option can
+        be repeated, the archives get the given sizes in turn.
+
+    --latency
+        The simulated round trip time of the link in milliseconds (default: 0,
+        i.e. no delay).
+
+    --bandwidth
+        The simulated bandwidth of the link in bytes per second and direction
+        (default: 0, i.e. unlimited).
+
+    --scenario
+        Runs this scenario (see SCENARIOS). This option can be repeated. All
+        scenarios are run by default.
+
+    --repeat
+        Runs every scenario this number of times (default: 1).
+
+    --fetcher
+        The fetcher script to benchmark (default: 'fetch_sftp.py' next to this
+        script).
+
+    --work-dir
+        The directory holding the remote and local files, keys and metrics
+        (default: a new temporary directory).
+
+    --keep
+        Do not remove the work directory afterwards. The output of the
+        fetcher is kept in the file 'fetcher.log' of the work directory.
+
+    --json
+        Prints a JSON object for every run instead of a table.
+
+    -v, --verbose
+        Prints the steps taken.
+
+    -h, --help
+        Prints this little help screen.
+
+    All arguments after '--' are passed to the fetcher for every run, e.g.
+    '-- --parallel 4 --backend threaded'.
+
+EXAMPLE
+    Compare the parallel fetching on a link with a round trip time of 50 ms
+    and 10 MB/s:
+
+      bench_fetch_sftp.py --files 20 --size 5242880 --latency 50 \\
+          --bandwidth 10485760 --scenario fetch
+      bench_fetch_sftp.py --files 20 --size 5242880 --latency 50 \\
+          --bandwidth 10485760 --scenario fetch -- --parallel 4
+"""
+
+# Additionally needed Python modules
+import paramiko
+
+# Built-in Python modules
+import getopt
+import os
+import Queue
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Load the hashlib if available (Python 2.5)
+if sys.version_info[0] >= 2 and sys.version_info[1] >= 5:
+    import hashlib
+else:
+    import sha
+
+try:
+    import json
+except ImportError:
+    # No round trips and JSON output without the json module (Python < 2.6)
+    json = None
+
+# The scenarios and the arguments passed to the fetcher
+SCENARIOS = [('startup',
+              ['--help']),
+             ('fetch',
+              ['-p', 'TRANSFERED', '-n', 'FETCHED']),
+             ('list-files',
+              ['--list-files']),
+             ('no-fetch',
+              ['-p', 'TRANSFERED', '-n', 'RELEASED', '--no-fetch']),
+             ('delete-file',
+              ['-p', 'TRANSFERED', '--delete-remote-file']),
+             ('delete-previous-statefiles',
+              ['-p', 'TRANSFERED', '-n', 'FETCHED',
+               '--delete-remote-previous-statefiles']),
+             ('delete-all-statefiles',
+              ['-p', 'TRANSFERED', '--delete-remote-file',
+               '--delete-remote-all-statefiles'])]
+
+# The state of the synthetic archives
+STATE = 'TRANSFERED'
+
+# The size of the blocks in which the synthetic archives are written
+BLOCK_SIZE = 1048576
+
+
+def new_sha1():
+    """Returns a new SHA-1 hash object (see fetch_sftp.py)."""
+    if sys.version_info[0] >= 2 and sys.version_info[1] >= 5:
+        return hashlib.sha1()
+    else:
+        return sha.new()
+
+
+class BenchServer(paramiko.ServerInterface):
+    """A BenchServer accepts every public key of any user. It must only be
+    used on the loopback interface."""
+
+    def check_auth_publickey(self, username, key):
+        """Accepts every public key."""
+        return paramiko.AUTH_SUCCESSFUL
+
+
+    def get_allowed_auths(self, username):
+        """Only public key authentication is offered."""
+        return 'publickey'
+
+
+    def check_channel_request(self, kind, chanid):
+        """Allows sessions (for the SFTP subsystem) only."""
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class BenchHandle(paramiko.SFTPHandle):
+    """A BenchHandle is an open local file served via SFTP."""
+
+    def stat(self):
+        """Returns the attributes of the open file."""
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class BenchSFTPServer(paramiko.SFTPServerInterface):
+    """A BenchSFTPServer serves the files below a local root directory."""
+
+    def __init__(self, server, root):
+        """Initializes the SFTP server for the given root directory."""
+        paramiko.SFTPServerInterface.__init__(self, server)
+        self.root = root
+
+
+    def local_pathname(self, path):
+        """Returns the local pathname of the given remote path."""
+        return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+
+    def canonicalize(self, path):
+        """Returns the absolute remote path of the given path."""
+        if not path.startswith('/'):
+            path = '/' + path
+        return os.path.normpath(path)
+
+
+    def list_folder(self, path):
+        """Returns the attributes of all files of the directory."""
+        directory = self.local_pathname(path)
+        try:
+            listing = []
+            for filename in os.listdir(directory):
+                attributes = paramiko.SFTPAttributes.from_stat(
+                    os.stat(os.path.join(directory, filename)))
+                attributes.filename = filename
+                listing.append(attributes)
+            return listing
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+    def stat(self, path):
+        """Returns the attributes of the file."""
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.local_pathname(path)))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+
+    def open(self, path, flags, attr):
+        """Opens the file and returns its handle."""
+        pathname = self.local_pathname(path)
+        try:
+            fd = os.open(pathname, flags, 0644)
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+        if flags & os.O_WRONLY:
+            if flags & os.O_APPEND:
+                mode = 'ab'
+            else:
+                mode = 'wb'
+        elif flags & os.O_RDWR:
+            if flags & os.O_APPEND:
+                mode = 'a+b'
+            else:
+                mode = 'r+b'
+        else:
+            mode = 'rb'
+
+        handle = BenchHandle(flags)
+        handle.filename = pathname
+        handle.readfile = os.fdopen(fd, mode)
+        handle.writefile = handle.readfile
+        return handle
+
+
+    def remove(self, path):
+        """Deletes the file."""
+        try:
+            os.remove(self.local_pathname(path))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+    def rename(self, oldpath, newpath):
+        """Renames the file, an existing file is not replaced."""
+        if os.path.exists(self.local_pathname(newpath)):
+            return paramiko.SFTP_FAILURE
+        return self.posix_rename(oldpath, newpath)
+
+
+    def posix_rename(self, oldpath, newpath):
+        """Renames the file, replacing an existing file."""
+        try:
+            os.rename(self.local_pathname(oldpath),
+                      self.local_pathname(newpath))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class LinkEmulator:
+    """A LinkEmulator relays TCP connections to a target port on the loopback
+    interface like a WAN link: every chunk of data is delayed by half of the
+    round trip time in each direction and the throughput of each direction
+    is limited to the bandwidth."""
+
+    def __init__(self, target_port, latency, bandwidth):
+        """Opens the listening socket of the relay. The latency is the round
+        trip time in seconds, the bandwidth given in bytes per second (zero
+        means unlimited)."""
+        self.target_port = target_port
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(50)
+        self.port = self.listener.getsockname()[1]
+
+
+    def serve_forever(self):
+        """Accepts connections and relays them to the target port."""
+        while True:
+            (client, address) = self.listener.accept()
+            target = socket.create_connection(('127.0.0.1', self.target_port))
+            for (source, destination) in ((client, target), (target, client)):
+                chunks = Queue.Queue()
+                for (function, arguments) in ((self.receive, (source, chunks)),
+                                              (self.deliver, (destination,
+                                                              chunks))):
+                    thread = threading.Thread(target=function, args=arguments)
+                    thread.setDaemon(True)
+                    thread.start()
+
+
+    def receive(self, source, chunks):
+        """Reads chunks from the source and queues them together with the time
+        of their delivery."""
+        while True:
+            try:
+                data = source.recv(65536)
+            except socket.error:
+                data = ''
+            chunks.put((time.time() + self.latency / 2, data))
+            if not data:
+                break
+
+
+    def deliver(self, destination, chunks):
+        """Sends the queued chunks to the destination when they are due, not
+        faster than the bandwidth allows."""
+        while True:
+            (due, data) = chunks.get()
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            if not data:
+                try:
+                    destination.shutdown(socket.SHUT_WR)
+                except socket.error:
+                    pass
+                break
+
+            try:
+                destination.sendall(data)
+            except socket.error:
+                break
+
+            if self.bandwidth:
+                time.sleep(len(data) / float(self.bandwidth))
+
+
+class FetchBenchmark:
+    """A FetchBenchmark runs the scenarios of fetch_sftp.py against a local
+    SFTP server and reports the measurements."""
+
+    def __init__(self):
+        """Initializes this class."""
+        self.files = 10
+        self.sizes = []
+        self.latency = 0.0
+        self.bandwidth = 0
+        self.scenarios = []
+        self.repeat = 1
+        self.fetcher = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    'fetch_sftp.py')
+        self.work_dir = None
+        self.keep = False
+        self.print_json = False
+        self.print_verbose = False
+
+        # The arguments passed to the fetcher in every run
+        self.fetcher_arguments = []
+
+        # The port the fetcher connects to (the server or the link emulator)
+        self.port = None
+
+        # Parse command line arguments
+        self.parse_arguments()
+
+
+    def verbose(self, message):
+        """This method prints verbose output if wanted to the console. If no
+        verbosity is wanted, nothing is done instead."""
+        if self.print_verbose:
+            print >> sys.stderr, "%s - %s" % \
+                  (time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()),
+                   message)
+
+
+    def usage(self, error_code, message=''):
+        """Print usage information and a given message and exit the program."""
+        print >> sys.stderr, __doc__
+
+        if message:
+            print >> sys.stderr, message
+
+        sys.exit(error_code)
+
+
+    def parse_arguments(self):
+        """Read the arguments given at the command line and validate them."""
+        try:
+            options, self.fetcher_arguments = getopt.getopt(
+                sys.argv[1:],
+                'hv',
+                ['bandwidth=',
+                 'fetcher=',
+                 'files=',
+                 'help',
+                 'json',
+                 'keep',
+                 'latency=',
+                 'repeat=',
+                 'scenario=',
+                 'size=',
+                 'verbose',
+                 'work-dir=',
+                 ])
+        except getopt.error, message:
+            self.usage(1, message)
+
+        scenario_names = [name for (name, arguments) in SCENARIOS]
+
+        for (option, argument) in options:
+            if option in ('-h', '--help'):
+                self.usage(0)
+            elif option in ('-v', '--verbose'):
+                self.print_verbose = True
+            elif option in ('--fetcher'):
+                self.fetcher = os.path.abspath(os.path.expanduser(argument))
+            elif option in ('--work-dir'):
+                self.work_dir = os.path.abspath(os.path.expanduser(argument))
+            elif option in ('--keep'):
+                self.keep = True
+            elif option in ('--json'):
+                self.print_json = True
+            elif option in ('--scenario'):
+                if not argument in scenario_names:
+                    self.usage(1, "Unknown scenario '%s'!" % (argument))
+                self.scenarios.append(argument)
+            elif option in ('--latency'):
+                try:
+                    self.latency = float(argument) / 1000
+                except ValueError:
+                    self.usage(1, "Invalid latency '%s'!" % (argument))
+            elif option in ('--files', '--size', '--bandwidth', '--repeat'):
+                try:
+                    value = int(argument)
+                except ValueError:
+                    self.usage(1, "Invalid number '%s' (%s)!" %
+                                  (argument, option))
+                if value < 0:
+                    self.usage(1, "Negative number '%s' (%s)!" %
+                                  (argument, option))
+                if option == '--files':
+                    self.files = value
+                elif option == '--size':
+                    self.sizes.append(value)
+                elif option == '--bandwidth':
+                    self.bandwidth = value
+                else:
+                    self.repeat = value
+            else:
+                self.usage(1, "Unknown option (%s %s)" % (option, argument))
+
+        if not self.sizes:
+            self.sizes = [1048576]
+
+        if not self.scenarios:
+            self.scenarios = scenario_names
+
+        if self.print_json and not json:
+            self.usage(1, 'The JSON output needs the json module (Python 2.6)!')
+
+        if not os.path.exists(self.fetcher):
+            self.usage(1, "Fetcher '%s' not found!" % (self.fetcher))
+
+
+    def create_keys(self):
+        """Creates the host key of the server and the RSA identity of the
+        fetcher together with a known hosts file."""
+        self.verbose("Creating SSH keys...")
+        self.host_key = paramiko.RSAKey.generate(2048)
+
+        identity = paramiko.RSAKey.generate(2048)
+        self.identity_file = os.path.join(self.work_dir, 'id_rsa')
+        identity.write_private_key_file(self.identity_file)
+
+        self.known_hosts_file = os.path.join(self.work_dir, 'known_hosts')
+        known_hosts = open(self.known_hosts_file, 'w')
+        try:
+            known_hosts.write("127.0.0.1 %s %s\n" %
+                              (self.host_key.get_name(),
+                               self.host_key.get_base64()))
+        finally:
+            known_hosts.close()
+
+
+    def create_archives(self):
+        """Creates the synthetic archives of random content once. Returns a
+        list of their names, pathnames and state file contents."""
+        self.verbose("Creating %i synthetic archives..." % (self.files))
+        archive_dir = os.path.join(self.work_dir, 'archives')
+        os.makedirs(archive_dir)
+
+        archives = []
+        for number in range(self.files):
+            filename = 'archive_%04i.zip' % (number)
+            pathname = os.path.join(archive_dir, filename)
+            size = self.sizes[number % len(self.sizes)]
+
+            file_sha = new_sha1()
+            archive = open(pathname, 'wb')
+            try:
+                remaining = size
+                while remaining > 0:
+                    block = os.urandom(min(remaining, BLOCK_SIZE))
+                    archive.write(block)
+                    file_sha.update(block)
+                    remaining = remaining - len(block)
+            finally:
+                archive.close()
+
+            # The state file holds the hash of the archive and its own name
+            file_sha.update(filename + '.' + STATE)
+            archives.append((filename, pathname, file_sha.hexdigest()))
+
+        return archives
+
+
+    def populate(self, archives):
+        """Populates the remote directory with the archives and their state
+        files and empties all local data of the fetcher."""
+        for directory in ('remote', 'local', 'listings'):
+            pathname = os.path.join(self.work_dir, directory)
+            if os.path.exists(pathname):
+                shutil.rmtree(pathname)
+        os.makedirs(os.path.join(self.work_dir, 'remote', 'incoming'))
+        os.makedirs(os.path.join(self.work_dir, 'local'))
+
+        for name in ('index.db', 'metrics.json'):
+            pathname = os.path.join(self.work_dir, name)
+            if os.path.exists(pathname):
+                os.remove(pathname)
+
+        remote_dir = os.path.join(self.work_dir, 'remote', 'incoming')
+        for (filename, pathname, digest) in archives:
+            remote_pathname = os.path.join(remote_dir, filename)
+            try:
+                os.link(pathname, remote_pathname)
+            except OSError:
+                shutil.copyfile(pathname, remote_pathname)
+
+            state_file = open(remote_pathname + '.' + STATE, 'w')
+            try:
+                state_file.write(digest)
+            finally:
+                state_file.close()
+
+
+    def start_server(self):
+        """Starts the SFTP server (and the link emulator if wanted) in
+        background threads."""
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(50)
+        self.port = listener.getsockname()[1]
+
+        thread = threading.Thread(target=self.serve_forever, args=(listener,))
+        thread.setDaemon(True)
+        thread.start()
+        self.verbose("SFTP server listening on port %i." % (self.port))
+
+        if self.latency or self.bandwidth:
+            emulator = LinkEmulator(self.port, self.latency, self.bandwidth)
+            thread = threading.Thread(target=emulator.serve_forever)
+            thread.setDaemon(True)
+            thread.start()
+            self.port = emulator.port
+            self.verbose("Link emulator (%.1f ms, %i bytes/s) listening on "
+                         "port %i." %
+                         (self.latency * 1000, self.bandwidth, self.port))
+
+
+    def serve_forever(self, listener):
+        """Accepts SSH connections and serves SFTP on them."""
+        root = os.path.join(self.work_dir, 'remote')
+        while True:
+            (connection, address) = listener.accept()
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                                            BenchSFTPServer, root)
+            transport.start_server(server=BenchServer())
+
+
+    def run_scenario(self, name, arguments, log_file):
+        """Runs the fetcher for the scenario in a child process and returns
+        the measurements."""
+        command = [sys.executable, self.fetcher, '--no-jitter',
+                   '--remote-server', '127.0.0.1',
+                   '--remote-port', str(self.port),
+                   '--remote-user', 'bench',
+                   '--ssh-host-key-file', self.known_hosts_file,
+                   '--ssh-rsa-id-file', self.identity_file,
+                   '--remote-dir', 'incoming',
+                   '--local-dir', os.path.join(self.work_dir, 'local'),
+                   '--hash-index', os.path.join(self.work_dir, 'index.db'),
+                   '--listing-snapshots', os.path.join(self.work_dir,
+                                                       'listings')]
+        metrics_file = os.path.join(self.work_dir, 'metrics.json')
+        if json:
+            command.extend(['--metrics-file', metrics_file])
+        command.extend(arguments + self.fetcher_arguments)
+
+        self.verbose("Running scenario '%s': %s" % (name, command[1:]))
+
+        log_file.write("=== %s: %s\n" % (name, ' '.join(command[1:])))
+        log_file.flush()
+
+        started = time.time()
+        child = subprocess.Popen(command, stdout=log_file,
+                                 stderr=subprocess.STDOUT)
+        (pid, status, usage) = os.wait4(child.pid, 0)
+        duration = time.time() - started
+
+        if os.WIFEXITED(status):
+            exit_code = os.WEXITSTATUS(status)
+        else:
+            exit_code = -os.WTERMSIG(status)
+
+        transfered = None
+        round_trips = None
+        if json and os.path.exists(metrics_file):
+            transfered = 0
+            round_trips = 0
+            metrics = open(metrics_file, 'r')
+            try:
+                for line in metrics:
+                    values = json.loads(line)
+                    transfered = transfered + values['bytes_transfered']
+                    round_trips = round_trips + sum(values['round_trips'].values())
+            finally:
+                metrics.close()
+
+        rate = None
+        if transfered is not None and duration > 0:
+            rate = round(transfered / duration / 1048576, 3)
+
+        # The maximum resident set size is given in kilobytes (Linux)
+        return {'scenario': name,
+                'exit_code': exit_code,
+                'seconds': round(duration, 3),
+                'bytes_transfered': transfered,
+                'mb_per_second': rate,
+                'round_trips': round_trips,
+                'peak_rss_kb': usage.ru_maxrss}
+
+
+    def report(self, result):
+        """Prints the measurements of a run."""
+        if self.print_json:
+            print(json.dumps(result, sort_keys=True))
+            return
+
+        def column(value, format):
+            if value is None:
+                return '-'
+            return format % (value)
+
+        print("%-28s %4s %9s %12s %9s %11s %10s" %
+              (result['scenario'],
+               result['exit_code'],
+               column(result['seconds'], '%.3f'),
+               column(result['bytes_transfered'], '%i'),
+               column(result['mb_per_second'], '%.2f'),
+               column(result['round_trips'], '%i'),
+               column(result['peak_rss_kb'] / 1024.0, '%.1f')))
+
+
+    def run(self):
+        """Prepares the server and the data and runs all scenarios."""
+        remove_work_dir = False
+        if not self.work_dir:
+            self.work_dir = tempfile.mkdtemp(prefix='bench_fetch_sftp.')
+            remove_work_dir = not self.keep
+        elif not os.path.isdir(self.work_dir):
+            os.makedirs(self.work_dir)
+
+        try:
+            archives_dir = os.path.join(self.work_dir, 'archives')
+            if os.path.exists(archives_dir):
+                shutil.rmtree(archives_dir)
+
+            self.create_keys()
+            archives = self.create_archives()
+            self.start_server()
+
+            if not self.print_json:
+                print("%i archives (%s bytes), latency %.1f ms, bandwidth %s" %
+                      (self.files,
+                       '/'.join([str(size) for size in self.sizes]),
+                       self.latency * 1000,
+                       self.bandwidth and "%i bytes/s" % (self.bandwidth) or
+                       'unlimited'))
+                print("%-28s %4s %9s %12s %9s %11s %10s" %
+                      ('scenario', 'rc', 'seconds', 'bytes', 'MB/s',
+                       'round trips', 'RSS MB'))
+
+            log_file = open(os.path.join(self.work_dir, 'fetcher.log'), 'w')
+            try:
+                for name in self.scenarios:
+                    arguments = dict(SCENARIOS)[name]
+                    for number in range(self.repeat):
+                        self.populate(archives)
+                        self.report(self.run_scenario(name, arguments,
+                                                      log_file))
+            finally:
+                log_file.close()
+        finally:
+            if remove_work_dir:
+                shutil.rmtree(self.work_dir, True)
+            else:
+                self.verbose("Keeping work directory '%s'." % (self.work_dir))
+
+
+if __name__ == '__main__':
+    FetchBenchmark().run()
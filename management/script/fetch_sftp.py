@@ -6,6 +6,21 @@ NAME
 SYNOPSIS
     fetch_sftp.py [--dry-run] [-h|--help] [-l|--local-dir <dir>] \\
         [-r|--remote-dir <dir>] [--remote-port <port>] \\
+        [--request-size <bytes>] [--pipeline-depth <n>] \\
+        [--hash-index <file>] [--no-hash-index] \\
+        [--listing-snapshots <dir>] [--no-listing-snapshots] \\
+        [--parallel <n>] [--parallel-transports] \\
+        [--hash-cache-size <bytes>] [--file-cache-size <bytes>] \\
+        [--payload-cache-size <bytes>] \\
+        [--daemon [--interval <seconds>] [--max-interval <seconds>]] \\
+        [--keepalive <seconds>] [--config <file>] \\
+        [--backend <name>] [--backend-channels <n>] \\
+        [--metrics-file <file>] [--prometheus-file <file>] \\
+        [--jitter <min>:<max>] [--no-jitter] \\
+        [--claim [--claim-timeout <seconds>]] \\
+        [--content-store <dir>] [--skip-deployed <dir>] \\
+        [--delta-basis <dir>] [--state-digest <algorithm>] \\
+        [--remote-hash] \\
         [--remote-server <server>] [--ssh-host-key-file <file>] \\
         [--delete-remote-file] [--delete-remote-all-statefiles] \\
         [--delete-remote-previous-statefiles] \\
@@ -31,8 +46,45 @@ DESCRIPTION
     It does not completely avoid fetching the file, because the whole file is 
     needed for hash digest generation. So in the case of to be created new 
     states, the file nevertheless is beeing fetched.
+    
+    Remote files are transfered into hidden partial files ('.<file>.part') in
+    the local directory and renamed when complete. If a transfer gets 
+    interrupted, the partial file and a checkpoint ('.<file>.part.info') 
+    recording the size and modification time of the remote file and the hash
+    digest of the bytes already transfered are kept. The next run resumes the
+    transfer at this offset if the remote file did not change meanwhile.
 
     
+    CLAIMS
+    
+    Several fetchers (on the same or on different hosts) can work on the same 
+    remote directory. Without further precautions they race: all of them see
+    the previous states of a file, fetch it, and one of them may delete the 
+    file or its previous state files while another one is still fetching it.
+    Using the option '--claim' a fetcher claims every file before fetching it
+    by creating a claim file '<file>.<next states>.CLAIM' (or '<file>.CLAIM' 
+    without next states; several next states are joined by '+'). The claim 
+    is written into a private temporary file created exclusively and renamed
+    to the claim file afterwards. The rename fails if the claim file already
+    exists, so only one of several fetchers gets the claim. The others skip 
+    the file (and check it again in their next run). Fetchers with different 
+    next states claim different files and fetch the file in parallel.
+    
+    After getting the claim the states of the file are checked again, as 
+    another fetcher may have finished it meanwhile. The claim is removed 
+    when the next states are created. Remote files and state files are only
+    deleted if no other fetcher holds a claim on the file, so the last 
+    fetcher done with a file deletes it. The remote file is renamed before 
+    it gets deleted, so a fetcher claiming it at the same time does not start
+    to fetch it.
+    
+    A claim which is older than the claim timeout is regarded as left behind 
+    by a crashed fetcher and gets broken. The timeout must exceed the time 
+    needed for fetching the largest file. The SFTP server must refuse to 
+    rename a file to the name of an existing file (like the OpenSSH server 
+    does).
+    
+    
     WHAT ARE STATES?
         
     The remote file will only be fetched if some states exists. This states are
@@ -50,6 +102,13 @@ DESCRIPTION
     file and that the state file has not been recycled from a previous state. 
     This is always done by default when new state files are created using this
     script.
+    Other hash algorithms can be used for new state files (see 
+    '--state-digest'). Their state files hold '<algorithm>:<hexdigest>' 
+    instead of the bare hexdigest of the SHA-1 hash. State files of any known
+    algorithm (and the bare SHA-1 hexdigests written by previous versions of 
+    this script) are verified. The hash digests of all algorithms needed for 
+    the state files of a remote file are computed in a single pass over its 
+    content.
     To force this security check you should use the argument 
     '--force-state-check'. This argument is disabled at the moment to provide 
     backward compatibility but in the near future this switch will be activted
@@ -80,6 +139,7 @@ DESCRIPTION
     This script is based on the following non standard python modules:
         paramiko - SSH 2 protocol for python (licensed under the GNU LGPL)
         syslog   - This module is only available in Python on the Unix platform
+        sqlite3  - Optional. Needed for the local index of hash digests
         
     Python version 2.2 is required because paramiko suggest this version. If 
     available features of newer versions of python are used (e.g. hashlib).
@@ -138,7 +198,9 @@ OPTIONS
         
     --list-files
         Lists the remote files matching the given previous states. If no 
-        previous state is given all files are listed.
+        previous state is given all files are listed. Unless next states or 
+        the deletion of remote files are given too, nothing but the listing is
+        done (e.g. for health checks).
         
     --no-fetch
         Does not fetch the remote file. Only the states are respected and 
@@ -146,6 +208,31 @@ OPTIONS
         This can be used to only alter states on the remote server without 
         fetching the file.
         
+    --parallel
+        Check and fetch up to this number of remote files concurrently 
+        (default: 1). Each file is handled by a worker using its own SFTP 
+        channel on the SSH connection. The next state files of a file are only
+        created after this file was fetched and hashed successfully.
+    
+    --parallel-transports
+        Open a separate SSH connection for every worker instead of an 
+        additional SFTP channel. This is done automatically if the server 
+        refuses to open more channels on one connection.
+    
+    --backend
+        The backend used for bulk operations on many remote files, like 
+        reading the state files of all candidates before checking them or 
+        writing all next state files of a fetched file (default: 
+        'paramiko'). The backend 'paramiko' does one request after another on
+        the SFTP channel of the fetcher. The backend 'threaded' 
+        spreads the requests over several SFTP channels, so their round trips
+        overlap. This saves a lot of time for directories with many small 
+        state files on links with a high latency.
+    
+    --backend-channels
+        The number of SFTP channels used by the backend 'threaded' 
+        (default: 8).
+    
     --remote-port
         If you want to connect to a special remote SSH port use this option to 
         specify it. This option defaults to the standard SSh port 22.
@@ -174,11 +261,226 @@ OPTIONS
         use this option to specify its private key file.
         The default value contains a Unix specific path.
     
+    --request-size
+        Remote files are read, hashed and written to the local directory in 
+        blocks of this many bytes (default: 32768). Paramiko splits requests 
+        larger than 32768 bytes, as many SFTP servers do not answer them.
+    
+    --pipeline-depth
+        The number of read requests for a remote file which are sent to the 
+        server without waiting for their answers (default: 32). On links with
+        a high latency the throughput is limited by the round trips; a higher 
+        depth keeps more data in flight. A depth of 1 reads the file block by 
+        block. The memory needed for hashing and fetching a file is bounded by
+        the depth times the request size and does not depend on the size of 
+        the remote file. The throughput reached is reported for every file in
+        the verbose output.
+    
     --debug
         Activates printing of debugging output of all operations to the console.
         This option implicates the option '--verbose' to get a more reasonable 
         output.
     
+    --hash-cache-size
+        The number of bytes used to cache the hash objects of remote files 
+        during a run (default: 1048576). The least recently used hash objects 
+        are evicted first. Evicted remote files have to be read again if their
+        hash is needed once more.
+    
+    --file-cache-size
+        The number of bytes used to cache the contents of small remote files 
+        like state files (default: 1048576).
+    
+    --payload-cache-size
+        The number of bytes used to cache the contents of larger remote files 
+        read into memory (default: 0, i.e. they are not cached at all). Remote
+        files which are fetched are never cached but streamed to disk.
+        
+        The hits, misses and evictions of all caches are printed with the 
+        debugging output.
+    
+    --hash-index
+        The hash digests of remote files and their state files are remembered
+        in this local index file (default: 
+        '~/import_hafas_data/fetch_sftp_index.db'). The digests are stored 
+        together with the size and modification time of the remote file. As 
+        long as these do not change, the remote file is not fetched again only
+        to check its states. The index needs the 'sqlite3' module (Python 2.5).
+    
+    --no-hash-index
+        Do not use the local index of hash digests. Every remote file needed 
+        for a state check is fetched again.
+    
+    --listing-snapshots
+        The listing of the remote directory (names, sizes and modification 
+        times) is remembered in a snapshot file in this directory after every
+        successful run (default: '~/import_hafas_data/fetch_sftp_listings').
+        The next run compares its listing with the snapshot and only checks 
+        the remote files which were added or changed themselves or whose 
+        state files were added, removed or changed meanwhile. So the work of a
+        run depends on the changes in the remote directory, not on its size.
+        There is a snapshot for every combination of remote server, user, 
+        directory, states and the options influencing the checks. A failed 
+        run (or a dry run) does not update the snapshot, so all files changed
+        since the last successful run are checked again.
+    
+    --no-listing-snapshots
+        Do not use listing snapshots. All remote files are checked in every 
+        run.
+    
+    --metrics-file
+        Append a line describing every run as a JSON object to this file 
+        (needs the 'json' module of Python 2.6). It holds the time spent in 
+        the phases of the run in seconds: 'connect' (TCP), 'handshake' (SSH),
+        'auth', 'listdir', 'state_read', 'hash' (computing hash digests), 
+        'download' (reading remote files, without hashing them), 
+        'state_write' and 'delete'. Phases done by parallel workers are summed
+        up. Further the bytes transfered and the resulting MB/s per transfer 
+        (bytes divided by the download time), the numbers of fetched files, 
+        created states and round trips (by SFTP operation) and the hits, 
+        misses and hit rates of the caches (since the start of the process) 
+        are given.
+        In daemon mode or with a configuration file every working poll or job
+        is a run of its own.
+    
+    --prometheus-file
+        Write the metrics of the last run into this file in the text format
+        of the textfile collector of the Prometheus node exporter. The file is
+        replaced atomically. Jobs of a configuration file should use files of
+        their own.
+    
+    --jitter
+        Before connecting, sleep for a random number of seconds between the 
+        given minimum and maximum to spread the load on the SFTP server 
+        caused by several fetchers started at the same time (default: 0:15).
+    
+    --no-jitter
+        Do not sleep before connecting (same as '--jitter 0:0').
+    
+    --claim
+        Claim every remote file before fetching it, so several fetchers can 
+        share the work on a remote directory safely (see CLAIMS).
+    
+    --claim-timeout
+        The number of seconds after which a claim of another fetcher is 
+        regarded as stale and gets broken (default: 3600).
+    
+    --content-store
+        Keep the contents of fetched files in this local directory, each in a
+        file named by the SHA-1 hash digest of the content. The files are hard
+        linked into the store, so it must be on the same file system as the 
+        local directory and takes no additional disk space. A remote file 
+        whose content is found in the store is linked into the local 
+        directory instead of being transfered. The content of a remote file is
+        known without transfering it, if it was hashed before and did not 
+        change in size and modification time (see '--hash-index'), or if one 
+        of its previous state files holds a hash digest which matches a stored 
+        content of the same size combined with the name of the state file 
+        (e.g. a file published again under another name), or if the SSH 
+        server computes the digest of the content (see '--remote-hash'). 
+        Contents which are 
+        not linked anywhere else anymore (e.g. deployed archives deleted by a
+        clean up) are dropped from the store after every run. By default no 
+        content store is used.
+    
+    --skip-deployed
+        The directory holding the deployed archives (e.g. 
+        '~/import_hafas_data/deployed', see import_hafas_data.sh). If the 
+        content of a fetched file equals the currently deployed archive (the 
+        newest one by name), the file is not placed into the local directory,
+        so it is not imported again. Its next states are created nevertheless.
+    
+    --state-digest
+        The hash algorithm used for new state files: 'sha1' (the default, 
+        written as a bare hexdigest readable by previous versions of this 
+        script), 'sha256' and 'sha512', or 'blake2b' if available (Python 3.6
+        or the module 'pyblake2').
+    
+    --delta-basis
+        Transfer only the changed parts of zip archives. The newest file (by 
+        name) in this directory (e.g. '~/import_hafas_data/deployed') is used 
+        as the basis. The central directories of the remote archive and the 
+        basis are compared: the compressed data of members having the same 
+        name, compression method, CRC-32 and sizes are copied from the basis,
+        everything else is read from the remote archive. This is only done 
+        for files to be fetched having a previous state file with a hash 
+        digest. The reconstructed file must match this hash digest, otherwise
+        the remote file is transfered completely. Zip64 archives are always 
+        transfered completely.
+    
+    --remote-hash
+        Let the SFTP server compute the hash digests of remote files instead 
+        of transfering them, if it is able to. The SSH server is probed once 
+        per run for an exec channel running 'sha1sum' (and 'sha256sum', 
+        'sha512sum' or 'b2sum' for other algorithms of state files), which 
+        hashes the remote file together with the name of the state file. The
+        digest of the plain content may also be computed by the 'check-file' 
+        extension of the SFTP server. If neither is available the remote file
+        is transfered and hashed locally as usual. So checking the states of 
+        remote files which are not fetched (e.g. with '--no-fetch' or 
+        '--list-files') costs a few round trips instead of the transfer. A 
+        file fetched after its states were checked remotely is verified 
+        against these hash digests once it is transfered.
+    
+    --daemon
+        Do not exit after checking the remote directory once. The SSH 
+        connection is kept open and the remote directory is listed again every
+        interval. Files are only checked and fetched if the listing changed 
+        (files added, removed or changed in size or modification time). As 
+        long as nothing changes, the interval is doubled up to the maximum 
+        interval; any change resets it. A lost connection is reopened with the
+        same back off. Not possible together with '--list-files'.
+    
+    --interval
+        The (initial) number of seconds between two polls of the remote 
+        directory in daemon mode (default: 60).
+    
+    --max-interval
+        The maximum number of seconds between two polls of the remote 
+        directory in daemon mode (default: 900).
+    
+    --keepalive
+        Send a keepalive packet over the SSH connection after this number of 
+        idle seconds (default: 30 in daemon mode, otherwise disabled). Zero 
+        disables keepalive packets.
+    
+    --config
+        Runs all jobs described in this configuration file instead of a single
+        one. Every section of the file describes a job; its options are the 
+        long options of this script without the leading dashes. Switches take 
+        the values 'yes' or 'no', repeatable options (the states) take a 
+        whitespace separated list. The section 'DEFAULT' holds options common
+        to all jobs. Options given at the command line apply to all jobs too,
+        unless a job overrides them.
+        
+        EXAMPLE:
+        
+          [DEFAULT]
+          remote-server = ftp.hacon.de
+          remote-user = hafas
+          
+          [supplier_a]
+          remote-dir = incoming/a
+          local-dir = ~/import_hafas_data/incoming/a
+          previous-state = TRANSFERED
+          next-state = FETCHED_TO_APPLICATIONSERVER_A
+          
+          [supplier_a_web]
+          remote-dir = incoming/a
+          local-dir = ~/import_hafas_data/web/a
+          previous-state = TRANSFERED
+          next-state = FETCHED_TO_WEBSERVER_A
+        
+        All jobs for the same remote server, port and user share one SSH 
+        connection (each job uses its own SFTP channel), the caches and the 
+        hash index; the options of the first of these jobs are used for them.
+        Jobs for different remote directories run concurrently. Jobs for the 
+        same remote directory run one after another in the order of the file 
+        and share the listing of the directory as long as no job changes it.
+        The exit code is zero if at least one job succeeded. Otherwise it is 
+        the highest exit code of all jobs. The daemon mode and listing files 
+        are not possible with a configuration file.
+    
     -d --dry-run
         If this parameter is given, no files will be fetched. The steps that 
         would be done are printed to the console. No logging via syslog is done 
@@ -207,11 +509,14 @@ VERSION
     $Header: /cvs/hafas/script/fetch_sftp.py,v 1.16 2012-02-13 09:07:28 kf Exp $
 """
 
-# Additionally needed Python modules
-import paramiko
+# Additionally needed Python modules (imported on first use, see 
+# load_paramiko())
+paramiko = None
 
 # Built-in Python modules
+import ConfigParser
 import datetime
+import errno
 import getpass
 import getopt
 import sys
@@ -224,32 +529,929 @@ import os
 import random
 import socket
 import string
-import tempfile
+import struct
+import threading
 import time
+import Queue
+
+# The default size of a single SFTP read request while hashing or fetching a 
+# remote file
+DEFAULT_REQUEST_SIZE = 32768
+
+# The default number of read requests which are sent without waiting for their
+# answers
+DEFAULT_PIPELINE_DEPTH = 32
+
+# The number of bytes after which the progress of a transfer is recorded in 
+# the checkpoint of the partial local file
+CHECKPOINT_INTERVAL = 16777216
+
+# The size of the blocks in which local files are read
+LOCAL_BLOCK_SIZE = 1048576
+
+# The approximate number of bytes used by a cached hash object
+HASH_OBJECT_SIZE = 256
+
+# Remote files up to this size (e.g. state files) are cached as small files, 
+# larger files as payloads
+SMALL_FILE_SIZE = 4096
+
+# The default budgets of the caches in bytes (payloads are not cached)
+DEFAULT_HASH_CACHE_SIZE = 1048576
+DEFAULT_FILE_CACHE_SIZE = 1048576
+DEFAULT_PAYLOAD_CACHE_SIZE = 0
+
+# The default number of SFTP channels of the threaded backend
+DEFAULT_BACKEND_CHANNELS = 8
+
+# The default intervals (in seconds) of the daemon mode
+DEFAULT_INTERVAL = 60
+DEFAULT_MAX_INTERVAL = 900
+DEFAULT_KEEPALIVE = 30
 
-SYSLOG_ENABLED = True
+# The command line options (see parse_arguments())
+SHORT_OPTIONS = 'dhp:l:n:r:u:v'
+LONG_OPTIONS = ['backend=',
+                'backend-channels=',
+                'claim',
+                'claim-timeout=',
+                'config=',
+                'content-store=',
+                'dry-run',
+                'daemon',
+                'debug',
+                'delta-basis=',
+                'delete-remote-file',
+                'delete-remote-all-statefiles',
+                'delete-remote-previous-statefiles',
+                'file-cache-size=',
+                'force-state-check',
+                'hash-cache-size=',
+                'hash-index=',
+                'help',
+                'interval=',
+                'jitter=',
+                'keepalive=',
+                'list-files',
+                'listing-snapshots=',
+                'local-dir=',
+                'max-interval=',
+                'metrics-file=',
+                'next-state=',
+                'no-fetch',
+                'no-hash-index',
+                'no-jitter',
+                'no-listing-snapshots',
+                'parallel=',
+                'payload-cache-size=',
+                'parallel-transports',
+                'pipeline-depth=',
+                'previous-state=',
+                'prometheus-file=',
+                'remote-dir=',
+                'remote-hash',
+                'remote-port=',
+                'remote-server=',
+                'remote-user=',
+                'request-size=',
+                'skip-deployed=',
+                'skip-state-check',
+                'state-digest=',
+                'ssh-debug',
+                'ssh-host-key-file=',
+                'ssh-rsa-id-file=',
+                'verbose',
+                ]
+
+# The options of a job in a configuration file which take a list of values
+LIST_OPTIONS = ['next-state', 'previous-state']
+
+# The layouts of the records of zip archives used by the delta transfer (see
+# --delta-basis): the end of the central directory, its entries and the local
+# headers of the members. The end record is followed by a comment of up to 
+# 65535 bytes.
+ZIP_END_SIGNATURE = 'PK\x05\x06'
+ZIP_END_FORMAT = '<4s4H2LH'
+ZIP_END_SIZE = struct.calcsize(ZIP_END_FORMAT)
+ZIP_END_MAX_SIZE = ZIP_END_SIZE + 65535
+ZIP_DIRECTORY_SIGNATURE = 'PK\x01\x02'
+ZIP_DIRECTORY_FORMAT = '<4s6H3L5H2L'
+ZIP_DIRECTORY_SIZE = struct.calcsize(ZIP_DIRECTORY_FORMAT)
+ZIP_HEADER_SIGNATURE = 'PK\x03\x04'
+ZIP_HEADER_FORMAT = '<4s5H3L2H'
+ZIP_HEADER_SIZE = struct.calcsize(ZIP_HEADER_FORMAT)
+
+# The suffix of the claim files (see claim_remote_file()) and the default 
+# number of seconds after which a claim is regarded as stale
+CLAIM_SUFFIX = 'CLAIM'
+DEFAULT_CLAIM_TIMEOUT = 3600
+
+# The default range of the random sleep before connecting (in seconds)
+DEFAULT_JITTER = (0, 15)
+
+# The log is opened on first use (see open_log())
+SYSLOG_ENABLED = None
+syslog = None
+f_log_file = None
 
 try:
-    import syslog
-    syslog.openlog('fetch-sftp', syslog.LOG_PID, syslog.LOG_LOCAL0)
+    import json
 except ImportError:
-    print('Failed to import syslog module. Maybe not in an UNIX environment.')
-    print('Disableing syslog logging!')
-    SYSLOG_ENABLED = False
-    f_log_file = open(os.path.expanduser(os.path.join('~', 
-                                                      'import_hafas', 
-                                                      'fetch_sftp.log')), 'a')    
-    
+    # Metrics can not be written without the json module (Python < 2.6)
+    json = None
+
+try:
+    import sqlite3
+except ImportError:
+    # The local hash index is disabled without sqlite3 (Python < 2.5)
+    sqlite3 = None
+
 import traceback    
    
 
+def load_paramiko():
+    """Imports the paramiko module on first use and returns it. Importing 
+    paramiko takes most of the startup time of this script, so it is only 
+    done when a SSH connection is really needed."""
+    global paramiko
+    if paramiko is None:
+        import paramiko
+    return paramiko
+
+
+def open_log():
+    """Opens the syslog on first use. If the syslog module is not available 
+    (not in an UNIX environment), a log file is opened instead."""
+    global SYSLOG_ENABLED, syslog, f_log_file
+    if SYSLOG_ENABLED is not None:
+        return
+    
+    try:
+        import syslog
+        syslog.openlog('fetch-sftp', syslog.LOG_PID, syslog.LOG_LOCAL0)
+        SYSLOG_ENABLED = True
+    except ImportError:
+        print('Failed to import syslog module. Maybe not in an UNIX environment.')
+        print('Disableing syslog logging!')
+        SYSLOG_ENABLED = False
+        f_log_file = open(os.path.expanduser(os.path.join('~', 
+                                                          'import_hafas', 
+                                                          'fetch_sftp.log')), 'a')
+
+
+def new_sha1():
+    """Returns a new SHA-1 hash object. The availability of the hashlib module 
+    (introduced with Python 2.5) is determined. If the hashlib module is 
+    available it is going to be used. Older versions of python try to use the 
+    SHA-1 algorithm."""
+    if sys.version_info[0] >= 2 and sys.version_info[1] >= 5:
+        return hashlib.sha1()
+    else:
+        return sha.new()
+
+
+# The hash algorithms available for state files by name (see --state-digest)
+DIGESTS = {'sha1': new_sha1}
+if sys.version_info[0] >= 2 and sys.version_info[1] >= 5:
+    DIGESTS['sha256'] = hashlib.sha256
+    DIGESTS['sha512'] = hashlib.sha512
+    if hasattr(hashlib, 'blake2b'):
+        DIGESTS['blake2b'] = hashlib.blake2b
+    else:
+        try:
+            import pyblake2
+            DIGESTS['blake2b'] = pyblake2.blake2b
+        except ImportError:
+            pass
+
+# The commands computing the hash algorithms on the remote server (see 
+# --remote-hash) and the output of the SHA-1 command for no input, which 
+# proves that remote commands can be executed
+REMOTE_HASH_COMMANDS = {'sha1': 'sha1sum',
+                        'sha256': 'sha256sum',
+                        'sha512': 'sha512sum',
+                        'blake2b': 'b2sum'}
+REMOTE_HASH_PROBE = "printf '' | sha1sum"
+REMOTE_HASH_PROBE_DIGEST = 'da39a3ee5e6b4b0d3255bfef95601890afd80709'
+
+# The number of seconds to wait for the output of a remote command (hashing a
+# large remote file takes a while)
+REMOTE_COMMAND_TIMEOUT = 600.0
+
+# The hash algorithms the 'check-file' extension of the SFTP server is asked 
+# for (see --remote-hash)
+CHECK_FILE_DIGESTS = ['sha1', 'sha256', 'sha512']
+
+
+def shell_quote(value):
+    """Quotes the value as a single argument of a command executed by a POSIX
+    shell on the remote server."""
+    return "'%s'" % (value.replace("'", "'\"'\"'"))
+
+
+def parse_state_digest(content):
+    """Splits the content of a state file into the name of the hash algorithm
+    and the hexdigest. State files without an algorithm hold the hexdigest of
+    a SHA-1 hash (the format of previous versions)."""
+    if ':' in content:
+        (algorithm, digest) = content.split(':', 1)
+        return (algorithm, digest)
+    return ('sha1', content)
+
+
+def format_state_digest(algorithm, digest):
+    """Returns the content of a state file holding the given hexdigest of the
+    given hash algorithm. SHA-1 hexdigests are written without the algorithm,
+    so previous versions can read them."""
+    if algorithm == 'sha1':
+        return digest
+    return "%s:%s" % (algorithm, digest)
+
+
+class MultiHash:
+    """A MultiHash computes the hash digests of several algorithms (see 
+    DIGESTS) in a single pass over the data. The SHA-1 digest identifying the
+    content (e.g. in the HashIndex and the ContentStore) is always 
+    computed. A MultiHash can be used like a single hash object of the 
+    hashlib module."""
+    
+    def __init__(self, names=None, hashes=None):
+        """Creates new hash objects of SHA-1 and the algorithms of the given 
+        names."""
+        if hashes is None:
+            names = ['sha1'] + [name for name in (names or []) 
+                                if name != 'sha1']
+            hashes = [DIGESTS[name]() for name in names]
+        self.names = names
+        self.hashes = hashes
+    
+    
+    def update(self, data):
+        """Feeds the data to the hash objects of all algorithms."""
+        for file_hash in self.hashes:
+            file_hash.update(data)
+    
+    
+    def copy(self):
+        """Returns a copy of this MultiHash."""
+        return MultiHash(list(self.names), 
+                         [file_hash.copy() for file_hash in self.hashes])
+    
+    
+    def hexdigest(self, name='sha1'):
+        """Returns the hexdigest of the given algorithm."""
+        return self.hashes[self.names.index(name)].hexdigest()
+    
+    
+    def covers(self, names):
+        """Returns whether all of the given algorithms are computed."""
+        for name in names:
+            if name not in self.names:
+                return False
+        return True
+
+
+def hash_local_file(pathname, names=None):
+    """Returns a new MultiHash of SHA-1 and the given algorithms updated with
+    the content of the given local file, which is read block by block."""
+    file_sha = MultiHash(names)
+    local_file = open(pathname, 'rb')
+    try:
+        while True:
+            block = local_file.read(LOCAL_BLOCK_SIZE)
+            if not block:
+                break
+            file_sha.update(block)
+    finally:
+        local_file.close()
+    return file_sha
+
+
+def read_zip_directory(read, size):
+    """Returns the members of a zip archive of the given size as a dict 
+    mapping their names to their compression method, CRC-32, compressed size,
+    uncompressed size and the offset of their local header. The archive is 
+    read by the given function taking an offset and a length. None is 
+    returned if the archive is no (or a Zip64) zip archive."""
+    tail_offset = max(0, size - ZIP_END_MAX_SIZE)
+    tail = read(tail_offset, size - tail_offset)
+    position = tail.rfind(ZIP_END_SIGNATURE)
+    if position < 0 or len(tail) - position < ZIP_END_SIZE:
+        return None
+    
+    end = struct.unpack(ZIP_END_FORMAT, tail[position:position + ZIP_END_SIZE])
+    (directory_size, directory_offset) = end[5:7]
+    if directory_offset == 0xFFFFFFFF or \
+       directory_offset + directory_size > size:
+        return None
+    
+    if directory_offset >= tail_offset:
+        start = directory_offset - tail_offset
+        directory = tail[start:start + directory_size]
+    else:
+        directory = read(directory_offset, directory_size)
+    
+    members = {}
+    position = 0
+    while position + ZIP_DIRECTORY_SIZE <= len(directory):
+        entry = struct.unpack(ZIP_DIRECTORY_FORMAT, 
+                              directory[position:position + ZIP_DIRECTORY_SIZE])
+        if entry[0] != ZIP_DIRECTORY_SIGNATURE:
+            return None
+        (name_length, extra_length, comment_length) = entry[10:13]
+        name_offset = position + ZIP_DIRECTORY_SIZE
+        name = directory[name_offset:name_offset + name_length]
+        # (method, crc, compressed size, size, header offset)
+        members[name] = (entry[4], entry[7], entry[8], entry[9], entry[16])
+        position = name_offset + name_length + extra_length + comment_length
+    return members
+
+
+def zip_data_offset(header_offset, header):
+    """Returns the offset of the compressed data of a zip member whose local
+    header at the given offset starts with the given bytes or None if they 
+    are no local header."""
+    if len(header) < ZIP_HEADER_SIZE or \
+       not header.startswith(ZIP_HEADER_SIGNATURE):
+        return None
+    fields = struct.unpack(ZIP_HEADER_FORMAT, header[:ZIP_HEADER_SIZE])
+    return header_offset + ZIP_HEADER_SIZE + fields[9] + fields[10]
+
+
+class HashIndex:
+    """A HashIndex persistently maps remote files to the hash digests of 
+    their content combined with the names of their state files. A remote file 
+    is identified by the server, its pathname, its size and its modification 
+    time, so a digest is only valid as long as the remote file is unchanged.
+    The empty state filename denotes the digest of the plain content."""
+    
+    def __init__(self, filename):
+        """Opens (and if needed creates) the index in the given file. The index 
+        may be used by several threads."""
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS digests ('
+                                'server TEXT, '
+                                'pathname TEXT, '
+                                'size INTEGER, '
+                                'mtime INTEGER, '
+                                'state_filename TEXT, '
+                                'digest TEXT, '
+                                'PRIMARY KEY (server, pathname, size, mtime, '
+                                'state_filename))')
+        self.connection.commit()
+    
+    
+    def get(self, server, pathname, size, mtime, state_filename):
+        """Returns the known hexdigest or None if it is not indexed."""
+        self.lock.acquire()
+        try:
+            row = self.connection.execute('SELECT digest FROM digests '
+                                          'WHERE server = ? AND '
+                                          'pathname = ? AND '
+                                          'size = ? AND mtime = ? AND '
+                                          'state_filename = ?', 
+                                          (server, pathname, size, mtime, 
+                                           state_filename)).fetchone()
+        finally:
+            self.lock.release()
+        if row:
+            return str(row[0])
+        return None
+    
+    
+    def put(self, server, pathname, size, mtime, state_filename, digest):
+        """Remembers a hexdigest. Digests of previous versions of the remote 
+        file are dropped."""
+        self.lock.acquire()
+        try:
+            self.connection.execute('DELETE FROM digests '
+                                    'WHERE server = ? AND pathname = ? AND '
+                                    '(size <> ? OR mtime <> ?)', 
+                                    (server, pathname, size, mtime))
+            self.connection.execute('INSERT OR REPLACE INTO digests '
+                                    'VALUES (?, ?, ?, ?, ?, ?)', 
+                                    (server, pathname, size, mtime, 
+                                     state_filename, digest))
+            self.connection.commit()
+        finally:
+            self.lock.release()
+    
+    
+    def prune(self, server, remote_dir, pathnames):
+        """Drops the digests of all files in the remote directory which are 
+        not contained in the given list of existing pathnames."""
+        existing = {}
+        for pathname in pathnames:
+            existing[pathname] = True
+        
+        rows = self.connection.execute('SELECT DISTINCT pathname FROM digests '
+                                       'WHERE server = ?', 
+                                       (server,)).fetchall()
+        for (pathname,) in rows:
+            if os.path.dirname(pathname) == remote_dir and \
+               not existing.has_key(pathname):
+                self.connection.execute('DELETE FROM digests '
+                                        'WHERE server = ? AND pathname = ?', 
+                                        (server, pathname))
+        self.connection.commit()
+    
+    
+    def close(self):
+        """Closes the index file."""
+        self.connection.close()
+
+
+class ContentStore:
+    """A ContentStore keeps the contents of fetched files in a local 
+    directory, each in a file named by the hexdigest of the SHA-1 hash of the 
+    content ('<directory>/<first two digits>/<hexdigest>'). Contents are hard 
+    linked into and out of the store, so they take no additional disk space 
+    as long as the fetched files exist anywhere else. The store may be used by
+    several threads."""
+    
+    def __init__(self, directory):
+        """Uses (and if needed creates) the store in the given directory."""
+        self.directory = directory
+        self.lock = threading.Lock()
+        
+        # The digests of the stored contents by size (read on first use) and
+        # the hash objects of stored contents already hashed
+        self.sizes = None
+        self.hashes = {}
+    
+    
+    def pathname(self, digest):
+        """Returns the pathname of the content with the given digest."""
+        return os.path.join(self.directory, digest[:2], digest)
+    
+    
+    def has(self, digest):
+        """Returns whether the content with the given digest is stored."""
+        return os.path.isfile(self.pathname(digest))
+    
+    
+    def entries(self):
+        """Returns the pathnames of all stored contents."""
+        pathnames = []
+        if not os.path.isdir(self.directory):
+            return pathnames
+        for prefix in os.listdir(self.directory):
+            prefix_dir = os.path.join(self.directory, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for digest in os.listdir(prefix_dir):
+                if digest.startswith(prefix) and len(digest) == 40:
+                    pathnames.append(os.path.join(prefix_dir, digest))
+        return pathnames
+    
+    
+    def find(self, size):
+        """Returns the digests of all stored contents of the given size."""
+        self.lock.acquire()
+        try:
+            if self.sizes is None:
+                self.sizes = {}
+                for pathname in self.entries():
+                    try:
+                        entry_size = os.path.getsize(pathname)
+                    except OSError:
+                        continue
+                    self.sizes.setdefault(entry_size, []).append(
+                        os.path.basename(pathname))
+            return list(self.sizes.get(size, []))
+        finally:
+            self.lock.release()
+    
+    
+    def add(self, pathname, digest):
+        """Adds the content of the given local file, having the given digest,
+        to the store by hard linking it."""
+        store_pathname = self.pathname(digest)
+        if os.path.exists(store_pathname):
+            return
+        
+        if not os.path.isdir(os.path.dirname(store_pathname)):
+            try:
+                os.makedirs(os.path.dirname(store_pathname))
+            except OSError:
+                # Created by another thread meanwhile
+                if not os.path.isdir(os.path.dirname(store_pathname)):
+                    raise
+        os.link(pathname, store_pathname)
+        
+        self.lock.acquire()
+        try:
+            if self.sizes is not None:
+                self.sizes.setdefault(os.path.getsize(store_pathname), 
+                                      []).append(digest)
+        finally:
+            self.lock.release()
+    
+    
+    def link(self, digest, pathname):
+        """Hard links the stored content with the given digest to the given 
+        local pathname, replacing an existing file."""
+        if os.path.exists(pathname):
+            os.unlink(pathname)
+        os.link(self.pathname(digest), pathname)
+    
+    
+    def hash(self, digest, names=None):
+        """Returns a copy of the hash object (a MultiHash of the given 
+        algorithms, see hash_local_file()) of the stored content with the 
+        given digest. The content is only read once."""
+        file_sha = self.hashes.get(digest)
+        if file_sha is None or not file_sha.covers(names or []):
+            file_sha = hash_local_file(self.pathname(digest), names)
+            self.hashes[digest] = file_sha
+        return file_sha.copy()
+    
+    
+    def digest_of(self, pathname):
+        """Returns the digest of the stored content which is the very same 
+        file (a hard link) as the given local file or None."""
+        stat = os.stat(pathname)
+        for digest in self.find(stat.st_size):
+            try:
+                entry_stat = os.stat(self.pathname(digest))
+            except OSError:
+                continue
+            if (entry_stat.st_dev, entry_stat.st_ino) == \
+               (stat.st_dev, stat.st_ino):
+                return digest
+        return None
+    
+    
+    def prune(self):
+        """Drops all contents which are not linked anywhere else anymore.
+        Returns the number of dropped contents."""
+        pruned = 0
+        for pathname in self.entries():
+            try:
+                if os.stat(pathname).st_nlink == 1:
+                    os.unlink(pathname)
+                    pruned = pruned + 1
+            except OSError:
+                continue
+        
+        self.lock.acquire()
+        try:
+            self.sizes = None
+            self.hashes = {}
+        finally:
+            self.lock.release()
+        return pruned
+
+
+class LRUCache:
+    """A LRUCache holds values up to a budget of bytes. The size of a value is
+    given when it is put into the cache. If the budget is exceeded, the least 
+    recently used values are evicted. Values larger than the budget are not 
+    cached at all, so a budget of zero disables the cache. The numbers of hits,
+    misses and evictions are counted. The cache may be used by several 
+    threads."""
+    
+    def __init__(self, name, budget):
+        """Initializes an empty cache with the given name and budget."""
+        self.name = name
+        self.budget = budget
+        self.size = 0
+        
+        # key -> [last access, size, value]
+        self.entries = {}
+        self.access_counter = 0
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        self.lock = threading.Lock()
+    
+    
+    def has_key(self, key):
+        """Returns if a value is cached for the key (without counting a hit or 
+        miss)."""
+        return self.entries.has_key(key)
+    
+    
+    def keys(self):
+        """Returns the keys of all cached values."""
+        return self.entries.keys()
+    
+    
+    def get(self, key):
+        """Returns the cached value for the key or None on a cache miss."""
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses = self.misses + 1
+                return None
+            
+            self.hits = self.hits + 1
+            self.access_counter = self.access_counter + 1
+            entry[0] = self.access_counter
+            return entry[2]
+        finally:
+            self.lock.release()
+    
+    
+    def put(self, key, value, size):
+        """Caches the value of the given size for the key and evicts the least
+        recently used values if needed."""
+        self.lock.acquire()
+        try:
+            if self.entries.has_key(key):
+                self.size = self.size - self.entries[key][1]
+                del self.entries[key]
+            
+            if size > self.budget:
+                return
+            
+            while self.size + size > self.budget:
+                # Evict the least recently used value
+                oldest_key = None
+                for (entry_key, entry) in self.entries.items():
+                    if oldest_key is None or entry[0] < oldest_access:
+                        oldest_key = entry_key
+                        oldest_access = entry[0]
+                self.size = self.size - self.entries[oldest_key][1]
+                del self.entries[oldest_key]
+                self.evictions = self.evictions + 1
+            
+            self.access_counter = self.access_counter + 1
+            self.entries[key] = [self.access_counter, size, value]
+            self.size = self.size + size
+        finally:
+            self.lock.release()
+    
+    
+    def clear(self):
+        """Removes all values from the cache (the counters are kept)."""
+        self.lock.acquire()
+        try:
+            self.entries = {}
+            self.size = 0
+        finally:
+            self.lock.release()
+    
+    
+    def statistics(self):
+        """Returns a line describing the usage of the cache."""
+        return "%s cache: %i entries, %i of %i bytes used, %i hits, " \
+               "%i misses, %i evictions" % (self.name, 
+                                            len(self.entries), 
+                                            self.size, 
+                                            self.budget, 
+                                            self.hits, 
+                                            self.misses, 
+                                            self.evictions)
+
+
+class ParamikoBackend:
+    """A ParamikoBackend performs bulk operations on remote files for a 
+    SFTPFetcher. The requests are done one after another using the (blocking)
+    paramiko SFTP client of the fetcher. This is the default backend (see 
+    --backend). Other backends provide the same methods."""
+    
+    def __init__(self, fetcher):
+        """Initializes the backend of the given fetcher."""
+        self.fetcher = fetcher
+    
+    
+    def read_file(self, client, remote_pathname):
+        """Returns the content of the remote file read by the given client. 
+        The file is read up to its end, so a file which grew since the 
+        remote directory was listed is read completely."""
+        self.fetcher.count_round_trips('open')
+        remote_file = client.file(remote_pathname, 'r')
+        try:
+            self.fetcher.count_round_trips('read')
+            return remote_file.read()
+        finally:
+            self.fetcher.count_round_trips('close')
+            remote_file.close()
+    
+    
+    def write_file(self, client, remote_pathname, content):
+        """Appends the content to the remote file (created if missing) using 
+        the given client. The write is pipelined, it is acknowledged together
+        with closing the file."""
+        self.fetcher.count_round_trips('open')
+        remote_file = client.file(remote_pathname, 'a')
+        try:
+            remote_file.set_pipelined(True)
+            remote_file.write(content)
+        finally:
+            self.fetcher.count_round_trips('close')
+            remote_file.close()
+    
+    
+    def read_files(self, remote_pathnames):
+        """Returns a dict mapping the given remote pathnames to the contents of
+        the files. Files which can not be read are left out."""
+        contents = {}
+        for remote_pathname in remote_pathnames:
+            try:
+                contents[remote_pathname] = self.read_file(self.fetcher.client(),
+                                                           remote_pathname)
+            except IOError, e:
+                self.fetcher.debug("Failed to read remote file '%s' (%s)!" % 
+                                   (remote_pathname, str(e)))
+        return contents
+    
+    
+    def write_files(self, contents):
+        """Appends the contents of the given dict to the remote files named by
+        its keys. The first error is raised."""
+        for (remote_pathname, content) in contents.items():
+            self.write_file(self.fetcher.client(), remote_pathname, content)
+    
+    
+    def close(self):
+        """Releases the resources of the backend."""
+        pass
+
+
+class ThreadedBackend(ParamikoBackend):
+    """A ThreadedBackend spreads the requests of bulk operations over several 
+    SFTP channels, each of them served by its own thread. The round trips of 
+    the requests for different files overlap instead of adding up. The 
+    channels are opened on first use (see SFTPFetcher.open_worker_client()) 
+    and kept until the backend is closed."""
+    
+    def __init__(self, fetcher):
+        """Initializes the backend of the given fetcher."""
+        ParamikoBackend.__init__(self, fetcher)
+        
+        # The SFTP clients and their additional transports (or None)
+        self.clients = []
+        self.lock = threading.Lock()
+    
+    
+    def open_clients(self):
+        """Opens the SFTP channels if not done yet."""
+        self.lock.acquire()
+        try:
+            while len(self.clients) < self.fetcher.backend_channels:
+                self.clients.append(self.fetcher.open_worker_client())
+        finally:
+            self.lock.release()
+    
+    
+    def map_files(self, remote_pathnames, operation):
+        """Calls the operation with a client and a remote pathname for all 
+        given pathnames, spread over the channels. Returns a dict mapping the 
+        pathnames to the results and a list of (pathname, error) tuples for 
+        failed operations."""
+        self.open_clients()
+        
+        pathnames = Queue.Queue()
+        for remote_pathname in remote_pathnames:
+            pathnames.put(remote_pathname)
+        
+        results = {}
+        errors = []
+        threads = []
+        for (client, transport) in self.clients[:len(remote_pathnames)]:
+            thread = threading.Thread(target=self.map_worker, 
+                                      args=(client, pathnames, operation, 
+                                            results, errors))
+            thread.start()
+            threads.append(thread)
+        
+        for thread in threads:
+            thread.join()
+        
+        return (results, errors)
+    
+    
+    def map_worker(self, client, pathnames, operation, results, errors):
+        """Takes remote pathnames from the queue until it is empty and calls 
+        the operation for them using the given client."""
+        while True:
+            try:
+                remote_pathname = pathnames.get_nowait()
+            except Queue.Empty:
+                break
+            
+            try:
+                results[remote_pathname] = operation(client, remote_pathname)
+            except (IOError, EOFError, paramiko.SSHException), e:
+                errors.append((remote_pathname, e))
+    
+    
+    def read_files(self, remote_pathnames):
+        """Returns a dict mapping the given remote pathnames to the contents of
+        the files. Files which can not be read are left out."""
+        if len(remote_pathnames) < 2:
+            return ParamikoBackend.read_files(self, remote_pathnames)
+        
+        (contents, errors) = self.map_files(remote_pathnames, self.read_file)
+        for (remote_pathname, e) in errors:
+            self.fetcher.debug("Failed to read remote file '%s' (%s)!" % 
+                               (remote_pathname, str(e)))
+        return contents
+    
+    
+    def write_files(self, contents):
+        """Appends the contents of the given dict to the remote files named by
+        its keys. The first error is raised after all files were written."""
+        if len(contents) < 2:
+            return ParamikoBackend.write_files(self, contents)
+        
+        def write(client, remote_pathname):
+            self.write_file(client, remote_pathname, contents[remote_pathname])
+        
+        (results, errors) = self.map_files(contents.keys(), write)
+        if errors:
+            raise errors[0][1]
+    
+    
+    def close(self):
+        """Closes the SFTP channels and additional transports."""
+        self.lock.acquire()
+        try:
+            for (client, transport) in self.clients:
+                try:
+                    client.close()
+                    if transport:
+                        transport.close()
+                except:
+                    pass
+            self.clients = []
+        finally:
+            self.lock.release()
+
+
+class Metrics:
+    """Metrics collect the time spent in the phases of a run and counters 
+    like the number of bytes transfered. The times of phases done by several
+    threads are summed up. The metrics can be used by several threads."""
+    
+    # The phases of a run
+    PHASES = ['connect', 
+              'handshake', 
+              'auth', 
+              'listdir', 
+              'state_read', 
+              'hash', 
+              'download', 
+              'state_write', 
+              'delete']
+    
+    def __init__(self):
+        """Initializes the metrics of a new run."""
+        self.lock = threading.Lock()
+        self.reset()
+    
+    
+    def reset(self):
+        """Starts a new run, all times and counters are zero again."""
+        self.lock.acquire()
+        try:
+            self.started = time.time()
+            self.phases = {}
+            for phase in self.PHASES:
+                self.phases[phase] = 0.0
+            self.counters = {'bytes_transfered': 0}
+        finally:
+            self.lock.release()
+    
+    
+    def add_time(self, phase, seconds):
+        """Adds the given number of seconds to the time of the phase."""
+        self.lock.acquire()
+        try:
+            self.phases[phase] = self.phases[phase] + seconds
+        finally:
+            self.lock.release()
+    
+    
+    def count(self, counter, count=1):
+        """Increases the given counter."""
+        self.lock.acquire()
+        try:
+            self.counters[counter] = self.counters.get(counter, 0) + count
+        finally:
+            self.lock.release()
+
+
+# The available backends by name (see --backend)
+BACKENDS = {'paramiko': ParamikoBackend, 
+            'threaded': ThreadedBackend}
+
+
 class SFTPFetcher:
     """A SFTPFetcher can be used to authenticate against a SSH server which 
     supports the SFTP protocol. Remote files can be fetched based on so called 
     state files."""
     
-    def __init__(self):
-        """Initializes this class."""
+    def __init__(self, arguments=None):
+        """Initializes this class. The command line arguments are parsed unless
+        a list of arguments is given (e.g. for a job of a configuration 
+        file)."""
         # The TCP socket used for the SSH connection
         self.sock = None
         
@@ -274,6 +1476,64 @@ class SFTPFetcher:
         
         self.ssh_log_file = os.path.join(base_dir, 'fetch_sftp_paramiko.log')
         
+        # The local index of hash digests of remote files (see HashIndex)
+        self.hash_index_file = os.path.join(base_dir, 'fetch_sftp_index.db')
+        self.hash_index = None
+        
+        # The local store of fetched contents (see ContentStore), the 
+        # directory of the deployed archives and the digest of the currently 
+        # deployed archive (see deployed_digest())
+        self.content_store_dir = None
+        self.content_store = None
+        self.deployed_dir = None
+        self.deployed = None
+        
+        # The directory of the basis archives of delta transfers (see 
+        # delta_fetch())
+        self.delta_basis_dir = None
+        
+        # The hash algorithm of new state files and the algorithms needed for
+        # the state files of the remote files currently checked (see 
+        # hash_remote_file())
+        self.state_digest_name = 'sha1'
+        self.required_digests = {}
+        
+        # Whether the SSH server computes hash digests of remote files (None 
+        # until it is probed), the hash algorithms it is not able to compute,
+        # whether it supports the 'check-file' extension and the digests 
+        # computed remotely by remote pathname (see remote_state_digest())
+        self.remote_hash = False
+        self.remote_hashing = None
+        self.remote_hash_failures = []
+        self.check_file = None
+        self.remote_digests = {}
+        
+        # The directory of the snapshots of remote directory listings (see 
+        # changed_filenames())
+        self.listing_snapshot_dir = os.path.join(base_dir, 
+                                                 'fetch_sftp_listings')
+        
+        # The attributes (size, mtime) of the listed remote files by filename.
+        # All questions about the existence and size of remote files are 
+        # answered by this snapshot of the remote directory.
+        self.remote_attributes = {}
+        
+        # The state files written during a run (see confirm_state_files())
+        self.written_state_files = {}
+        
+        # The remote files deleted during a run (see run_daemon())
+        self.removed_files = {}
+        
+        # The metrics of the current run and where to write them (see 
+        # write_metrics())
+        self.metrics = Metrics()
+        self.metrics_file = None
+        self.prometheus_file = None
+        
+        # The number of SFTP requests waited for by operation (see 
+        # count_round_trips())
+        self.round_trips = {}
+        
         ssh_base_dir = os.path.expanduser(os.path.join('~', '.ssh'))
         
         self.ssh_host_key_file = os.path.join(ssh_base_dir, 'known_hosts')
@@ -289,25 +1549,91 @@ class SFTPFetcher:
         self.list_files = False
         
         # A cache for the file hashes on the remote side
-        self.hash_cache = {}
+        self.hash_cache = LRUCache('Hash', DEFAULT_HASH_CACHE_SIZE)
         
-        # A cache for file contents
-        self.file_cache = {}
+        # A cache for the contents of small files (e.g. state files)
+        self.file_cache = LRUCache('File', DEFAULT_FILE_CACHE_SIZE)
+        
+        # A cache for the contents of larger files
+        self.payload_cache = LRUCache('Payload', DEFAULT_PAYLOAD_CACHE_SIZE)
+        
+        # Local files holding the content of remote files which were already 
+        # transfered while hashing them (remote pathname -> local pathname)
+        self.spool_files = {}
+        
+        # The size of a read request and the number of outstanding requests 
+        # while reading a remote file
+        self.request_size = DEFAULT_REQUEST_SIZE
+        self.pipeline_depth = DEFAULT_PIPELINE_DEPTH
+        
+        # The number of remote files checked and fetched concurrently and if 
+        # every worker should use its own SSH transport
+        self.parallel = 1
+        self.parallel_transports = False
+        
+        # Per worker thread data (its SFTP client, see client())
+        self.worker = threading.local()
+        
+        # Serializes updates of data shared by the worker threads
+        self.lock = threading.Lock()
+        
+        # The RSA identity used for authentication
+        self.rsa_key = None
         
         self.delete_remote_file = False
         self.delete_remote_all_statefiles = False
         self.delete_remote_previous_statefiles = False
+        
+        # The range of the random sleep before connecting (see __main__)
+        self.jitter = DEFAULT_JITTER
+        
+        # Claim remote files before fetching them, the claims held by this 
+        # fetcher (see claim_remote_file()) and the files which were skipped 
+        # because of claims of other fetchers
+        self.claim = False
+        self.claim_timeout = DEFAULT_CLAIM_TIMEOUT
+        self.claims = {}
+        self.claimed_elsewhere = {}
+        
+        # Daemon mode: poll interval, maximum poll interval and the keepalive 
+        # interval of the SSH connection (in seconds)
+        self.daemon = False
+        self.interval = DEFAULT_INTERVAL
+        self.max_interval = DEFAULT_MAX_INTERVAL
+        self.keepalive = None
     
         self.dry_run = False
         self.print_verbose = False
         self.print_debug = False
         
+        # The configuration file describing the jobs to run (see run_batch())
+        # and the options given for all of its jobs
+        self.config_file = None
+        self.job_arguments = []
+        
+        # The backend for bulk operations on remote files (see --backend)
+        self.backend_name = 'paramiko'
+        self.backend_channels = DEFAULT_BACKEND_CHANNELS
+        
+        # The fetcher whose SSH connection, caches and hash index are shared 
+        # by this fetcher (a job of a configuration file, see 
+        # share_connection())
+        self.leader = None
+        
         # Parse command line arguments
-        self.parse_arguments()
+        self.parse_arguments(arguments)
+        
+        self.backend = BACKENDS[self.backend_name](self)
+        
+        if self.content_store_dir:
+            self.content_store = ContentStore(self.content_store_dir)
         
         
     def log(self, message):
         """Log via syslog if available else to the console only."""
+        if not self.dry_run:
+            open_log()
+        
         if SYSLOG_ENABLED and not self.dry_run:
             syslog.syslog(syslog.LOG_INFO, message)
         else:
@@ -350,50 +1676,42 @@ class SFTPFetcher:
         sys.exit(error_code)        
         
 
-    def parse_arguments(self):
-        """Read the arguments given at the command line and validate them."""
+    def parse_arguments(self, arguments=None):
+        """Read the arguments given at the command line (or the given list of 
+        arguments of a job) and validate them."""
         self.verbose("Parsing command line arguments")
         
+        if arguments is None:
+            arguments = sys.argv[1:]
+        
         try:
-            options, unknown_arguments = getopt.getopt(
-                sys.argv[1:],
-                'dhp:l:n:r:u:v',
-                ['dry-run',
-                 'debug',
-                 'delete-remote-file',
-                 'delete-remote-all-statefiles',
-                 'delete-remote-previous-statefiles',
-                 'force-state-check',
-                 'help',
-                 'list-files',
-                 'local-dir=',
-                 'next-state=',
-                 'no-fetch',
-                 'previous-state=',
-                 'remote-dir=',
-                 'remote-port=',
-                 'remote-server=',
-                 'remote-user=',
-                 'skip-state-check',
-                 'ssh-debug',
-                 'ssh-host-key-file=',
-                 'ssh-rsa-id-file=',
-                 'verbose',
-                 ])
+            options, unknown_arguments = getopt.getopt(arguments, 
+                                                       SHORT_OPTIONS, 
+                                                       LONG_OPTIONS)
         except getopt.error, message:
             self.usage(1, message)
             
         # Evaluate the parsed options
         for (option, argument) in options:
+            if option != '--config':
+                # Remember the options, they apply to all jobs of a 
+                # configuration file
+                self.job_arguments.append(option)
+                if self.takes_argument(option):
+                    self.job_arguments.append(argument)
+            
             if option in ('-h', '--help'):
                 self.usage(0)
+            elif option in ('--config'):
+                self.config_file = os.path.expanduser(argument)
+                self.debug("Using configuration file '%s'" % (argument))
             elif option in ('-d', '--dry-run'):
                 self.dry_run = True
                 self.print_verbose = True
                 self.debug('Dry-run (includes verbose output) activated!')
             elif option in ('--ssh-debug'):
                 # Enable Paramiko logging into logfile
-                paramiko.util.log_to_file(self.ssh_log_file)
+                load_paramiko().util.log_to_file(self.ssh_log_file)
                 self.debug("SSH connection debugging activated to file '%s'" % 
                            (self.ssh_log_file))
             elif option in ('-l', '--local-dir'):
@@ -409,7 +1727,10 @@ class SFTPFetcher:
                 self.remote_dir = argument
                 self.debug("Using remote directory '%s'" % (argument))
             elif option in ('--remote-port'):
-                self.remote_port = argument
+                try:
+                    self.remote_port = int(argument)
+                except ValueError:
+                    self.usage(1, "Invalid remote port '%s'!" % (argument))
                 self.debug("Using remote port '%s'" % (argument))
             elif option in ('--remote-server'):
                 self.remote_server = argument
@@ -452,9 +1773,157 @@ class SFTPFetcher:
             elif option in ('--list-files'):
                 self.list_files = True
                 self.debug('Listing remote files!')
+            elif option in ('--hash-index'):
+                self.hash_index_file = os.path.expanduser(argument)
+                self.debug("Using hash index file '%s'" % (argument))
+            elif option in ('--no-hash-index'):
+                self.hash_index_file = None
+                self.debug('Not using a hash index!')
+            elif option in ('--content-store'):
+                self.content_store_dir = os.path.expanduser(argument)
+                self.debug("Using content store '%s'" % (argument))
+            elif option in ('--state-digest'):
+                if not DIGESTS.has_key(argument):
+                    names = DIGESTS.keys()
+                    names.sort()
+                    self.usage(1, "Unknown hash algorithm '%s' (available: "
+                                  "%s)!" % 
+                                  (argument, ', '.join(names)))
+                self.state_digest_name = argument
+                self.debug("Using hash algorithm '%s' for new state files" % 
+                           (argument))
+            elif option in ('--remote-hash'):
+                self.remote_hash = True
+                self.debug('Computing hash digests on the remote server!')
+            elif option in ('--delta-basis'):
+                self.delta_basis_dir = os.path.expanduser(argument)
+                self.debug("Using delta basis '%s'" % (argument))
+            elif option in ('--skip-deployed'):
+                self.deployed_dir = os.path.expanduser(argument)
+                self.debug("Skipping contents deployed in '%s'" % (argument))
+            elif option in ('--jitter'):
+                try:
+                    (minimum, maximum) = [int(seconds) for seconds in 
+                                          argument.split(':')]
+                except ValueError:
+                    self.usage(1, "Invalid jitter '%s' (<min>:<max>)!" % 
+                                  (argument))
+                if minimum < 0 or maximum < minimum:
+                    self.usage(1, "Invalid jitter '%s' (<min>:<max>)!" % 
+                                  (argument))
+                self.jitter = (minimum, maximum)
+                self.debug("Sleeping %i to %i seconds before connecting" % 
+                           (minimum, maximum))
+            elif option in ('--claim'):
+                self.claim = True
+                self.debug('Claiming remote files before fetching them!')
+            elif option in ('--claim-timeout'):
+                try:
+                    self.claim_timeout = int(argument)
+                except ValueError:
+                    self.usage(1, "Invalid number of seconds '%s'!" % 
+                                  (argument))
+                self.debug("Breaking claims older than %i seconds" % 
+                           (self.claim_timeout))
+            elif option in ('--no-jitter'):
+                self.jitter = (0, 0)
+                self.debug('Not sleeping before connecting!')
+            elif option in ('--metrics-file'):
+                self.metrics_file = os.path.expanduser(argument)
+                self.debug("Writing metrics to '%s'" % (argument))
+            elif option in ('--prometheus-file'):
+                self.prometheus_file = os.path.expanduser(argument)
+                self.debug("Writing Prometheus metrics to '%s'" % (argument))
+            elif option in ('--listing-snapshots'):
+                self.listing_snapshot_dir = os.path.expanduser(argument)
+                self.debug("Using listing snapshot directory '%s'" % 
+                           (argument))
+            elif option in ('--no-listing-snapshots'):
+                self.listing_snapshot_dir = None
+                self.debug('Not using listing snapshots!')
+            elif option in ('--parallel'):
+                try:
+                    self.parallel = int(argument)
+                except ValueError:
+                    self.usage(1, "Invalid number of parallel fetches '%s'!" % 
+                                  (argument))
+                self.debug("Fetching up to %i files in parallel" % 
+                           (self.parallel))
+            elif option in ('--parallel-transports'):
+                self.parallel_transports = True
+                self.debug('Using an SSH transport per parallel fetch!')
+            elif option in ('--hash-cache-size', '--file-cache-size', 
+                            '--payload-cache-size'):
+                try:
+                    budget = int(argument)
+                except ValueError:
+                    self.usage(1, "Invalid cache size '%s'!" % (argument))
+                if budget < 0:
+                    self.usage(1, 'A cache size must not be negative!')
+                if option == '--hash-cache-size':
+                    self.hash_cache.budget = budget
+                elif option == '--file-cache-size':
+                    self.file_cache.budget = budget
+                else:
+                    self.payload_cache.budget = budget
+                self.debug("Using a budget of %i bytes (%s)" % 
+                           (budget, option))
+            elif option in ('--daemon'):
+                self.daemon = True
+                self.debug('Running as daemon!')
+            elif option in ('--interval', '--max-interval', '--keepalive'):
+                try:
+                    seconds = int(argument)
+                except ValueError:
+                    self.usage(1, "Invalid number of seconds '%s'!" % 
+                                  (argument))
+                if option == '--interval':
+                    self.interval = seconds
+                elif option == '--max-interval':
+                    self.max_interval = seconds
+                else:
+                    self.keepalive = seconds
+                self.debug("Using %i seconds (%s)" % (seconds, option))
+            elif option in ('--backend'):
+                if not BACKENDS.has_key(argument):
+                    self.usage(1, "Unknown backend '%s'!" % (argument))
+                self.backend_name = argument
+                self.debug("Using backend '%s'" % (argument))
+            elif option in ('--backend-channels'):
+                try:
+                    self.backend_channels = int(argument)
+                except ValueError:
+                    self.usage(1, "Invalid number of backend channels '%s'!" % 
+                                  (argument))
+                if self.backend_channels < 1:
+                    self.usage(1, 'The number of backend channels must be at '
+                                  'least one!')
+                self.debug("Using %i backend channels" % 
+                           (self.backend_channels))
+            elif option in ('--request-size'):
+                try:
+                    self.request_size = int(argument)
+                except ValueError:
+                    self.usage(1, "Invalid request size '%s'!" % (argument))
+                self.debug("Using a request size of %i bytes" % 
+                           (self.request_size))
+            elif option in ('--pipeline-depth'):
+                try:
+                    self.pipeline_depth = int(argument)
+                except ValueError:
+                    self.usage(1, "Invalid pipeline depth '%s'!" % (argument))
+                self.debug("Using a pipeline depth of %i requests" % 
+                           (self.pipeline_depth))
             else:
                 self.usage(1, "Unknown option (%s %s)" % (option, argument))
         
+        if self.config_file:
+            # The jobs of the configuration file are checked on their own
+            if self.daemon or self.list_files:
+                self.usage(1, 'The daemon mode and listing files are not '
+                              'possible with a configuration file!')
+            return
+        
         # Check for mandatory command line options
         if not self.remote_user:
             self.usage(1, 'The remote username must be specified!')
@@ -465,7 +1934,7 @@ class SFTPFetcher:
             else:
                 self.usage(1, 'At least one previous state must be specified!')
 
-        if len(self.next_states) == 0 and self.delete_remote_all_statefiles:
+        if self.delete_remote_all_statefiles and not self.delete_remote_file:
             self.usage(1, 'I prevent you from deleting all state files of a '
                           'file without deleting the file too!')
 
@@ -477,6 +1946,32 @@ class SFTPFetcher:
             self.usage(1, 'It makes no sense to specify a next state and '
                           'delete it immediately!')
 
+        if self.daemon and self.list_files:
+            self.usage(1, 'Listing files is not possible in daemon mode!')
+
+        if self.interval < 1 or self.max_interval < self.interval:
+            self.usage(1, 'The interval must be at least one second and must '
+                          'not exceed the maximum interval!')
+
+        if self.claim_timeout < 1:
+            self.usage(1, 'The claim timeout must be at least one second!')
+
+        if self.keepalive is None and self.daemon:
+            self.keepalive = DEFAULT_KEEPALIVE
+
+        if self.metrics_file and not json:
+            self.usage(1, 'Writing metrics needs the json module (Python 2.6)!')
+
+        if self.parallel < 1:
+            self.usage(1, 'The number of parallel fetches must be at least '
+                          'one!')
+
+        if self.request_size < 1:
+            self.usage(1, 'The request size must be at least one byte!')
+
+        if self.pipeline_depth < 1:
+            self.usage(1, 'The pipeline depth must be at least one request!')
+
         if len(self.next_states) > 0 and self.delete_remote_file:
             self.usage(1, 'It makes no sense to specify a next state and '
                           'deleting the file it belongs to!')
@@ -494,6 +1989,15 @@ class SFTPFetcher:
         self.debug("Remote server '%s'" % (self.remote_server))
         self.debug("Remote port %i" % (self.remote_port))
         self.debug("Remote user '%s'" % (self.remote_user))
+        self.debug("Request size %i bytes" % (self.request_size))
+        self.debug("Pipeline depth %i requests" % (self.pipeline_depth))
+        self.debug("Hash index file '%s'" % (self.hash_index_file))
+        self.debug("Listing snapshot directory '%s'" % 
+                   (self.listing_snapshot_dir))
+        self.debug("Parallel fetches %i" % (self.parallel))
+        self.debug("Backend '%s'" % (self.backend_name))
+        self.debug("Daemon mode wanted? '%s' (interval %i, maximum interval "
+                   "%i)" % (self.daemon, self.interval, self.max_interval))
         self.debug("Deletion of remote file wanted? '%s'" % 
                    (self.delete_remote_file))
         self.debug("Deletion of all remote state file wanted? '%s'" % 
@@ -505,9 +2009,18 @@ class SFTPFetcher:
         self.debug("Dry run!? '%s'" % (self.dry_run))
         
 
+    def takes_argument(self, option):
+        """Returns if the given command line option takes an argument."""
+        if option.startswith('--'):
+            return option[2:] + '=' in LONG_OPTIONS
+        return option[1:] + ':' in SHORT_OPTIONS
+
+
     def open_connection(self):
         """Open the TCP connection to SSH server."""
         self.debug("Connection to remote server...")
+        load_paramiko()
+        
         try:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.connect((self.remote_server, self.remote_port))
@@ -590,15 +2103,17 @@ class SFTPFetcher:
             
         # Authenticate transport using just opened RSA public key
         self.transp.auth_publickey(self.remote_user, key)
+        self.rsa_key = key
         
         # Create SFTP client
         self.sftp = paramiko.SFTPClient.from_transport(self.transp)
         self.sftp.get_channel().settimeout(30.0)
         
 
-    def fetch_files_by_state(self):
+    def fetch_files_by_state(self, remote_listing=None):
         """Fetch file list on remote host if they match the pattern given by 
-        the states."""
+        the states. An already retrieved listing of the remote directory (see 
+        list_remote_dir()) can be given."""
         self.verbose("Fetching files from remote directory '%s'." % 
                      (self.remote_dir))
         self.verbose("Fetching files matching the previous states: %s" % 
@@ -606,29 +2121,636 @@ class SFTPFetcher:
         self.verbose("Fetched files will get the following new states: %s" % 
                      (self.next_states))
         
-        # Remember the number of created remote states
-        states_created = 0
+        # Remember the number of created remote states and their contents by 
+        # remote pathname (see confirm_state_files())
+        self.states_created = 0
+        self.written_state_files = {}
+        self.removed_files = {}
+        
+        # Files claimed by other fetchers have to be checked again next time
+        self.claimed_elsewhere = {}
         
         # Keep track of all files which got fetched
         fetched_filenames = []
         
-        # The list of files on the remote side
-        remote_filename_list = self.sftp.listdir(self.remote_dir)
+        # The list of files on the remote side and their attributes
+        if remote_listing is None:
+            remote_listing = self.list_remote_dir()
+        
+        remote_filename_list = []
+        self.remote_attributes = {}
+        for attributes in remote_listing:
+            remote_filename_list.append(attributes.filename)
+            self.remote_attributes[attributes.filename] = attributes
         self.debug("%i remote files found (%s)!" % 
                    (len(remote_filename_list), remote_filename_list))
         
-        # Iterate over the list of remote files and search for the state files
-        for remote_filename in remote_filename_list:
-            remote_pathname = os.path.join(self.remote_dir, remote_filename)
+        self.open_hash_index()
+        self.prune_hash_index(remote_filename_list)
+        
+        # The listing of the last successful run
+        snapshot = self.load_listing_snapshot()
+        
+        # The result of a run which raised an error
+        result = 'error'
+        try:
+            self.fetch_listed_files_by_state(remote_filename_list, 
+                                             fetched_filenames, 
+                                             snapshot)
+            self.confirm_state_files()
             
-            self.debug("Checking file '%s' for states..." % (remote_pathname))
+            if self.content_store and not self.dry_run:
+                pruned = self.content_store.prune()
+                if pruned:
+                    self.verbose("Dropped %i contents from the content store." %
+                                 (pruned))
             
-            # Open the remote file for hash digest generation
-            if self.state_check or self.force_state_check:
-                remote_file_sha = self.hash_remote_file(remote_pathname)
-                self.debug("The Hash digest this file is '%s'." % 
-                           (remote_file_sha.hexdigest()))
+            if not self.dry_run:
+                self.save_listing_snapshot([attributes for attributes in 
+                                            remote_listing 
+                                            if not self.claimed_elsewhere.has_key(attributes.filename)])
             
+            if not self.no_fetch and len(fetched_filenames) < 1:
+                self.verbose("No files got fetched!")
+                result = 1
+            elif self.no_fetch and self.states_created < 1:
+                self.verbose("No next states have been created!")
+                result = 2
+            elif not self.no_fetch:
+                self.log("Just fetched the following local files %s" %
+                        (fetched_filenames))
+                result = None
+            else:
+                result = 0
+        finally:
+            # Never leave spooled remote files behind in the local directory
+            self.discard_spool_files()
+            
+            self.verbose(self.round_trip_summary())
+            self.metrics.count('files_fetched', len(fetched_filenames))
+            self.metrics.count('states_created', self.states_created)
+            self.write_metrics(result)
+            self.round_trips = {}
+        
+        return result
+
+
+    def metrics_values(self, result):
+        """Returns a dict describing the metrics of the current run with the 
+        given result (see --metrics-file)."""
+        duration = time.time() - self.metrics.started
+        transfered = self.metrics.counters['bytes_transfered']
+        download_time = self.metrics.phases['download']
+        if download_time > 0:
+            rate = transfered / download_time / 1048576
+        else:
+            rate = 0.0
+        
+        caches = {}
+        for cache in (self.hash_cache, self.file_cache, self.payload_cache):
+            requests = cache.hits + cache.misses
+            if requests > 0:
+                hit_rate = float(cache.hits) / requests
+            else:
+                hit_rate = 0.0
+            caches[cache.name.lower()] = {'hits': cache.hits, 
+                                          'misses': cache.misses, 
+                                          'evictions': cache.evictions, 
+                                          'hit_rate': round(hit_rate, 4)}
+        
+        values = {'timestamp': int(time.time()), 
+                  'server': self.remote_location(), 
+                  'remote_dir': self.remote_dir, 
+                  'result': result, 
+                  'duration': round(duration, 3), 
+                  'phases': dict([(phase, round(seconds, 3)) for 
+                                  (phase, seconds) in self.metrics.phases.items()]),
+                  'mb_per_second': round(rate, 3), 
+                  'round_trips': dict(self.round_trips), 
+                  'caches': caches}
+        values.update(self.metrics.counters)
+        return values
+
+
+    def write_metrics(self, result):
+        """Writes the metrics of the current run (see --metrics-file and 
+        --prometheus-file) and starts collecting the metrics of the next 
+        run. Errors are only logged, they never fail the run."""
+        values = self.metrics_values(result)
+        
+        if self.metrics_file:
+            try:
+                metrics_file = open(self.metrics_file, 'a')
+                try:
+                    metrics_file.write(json.dumps(values, sort_keys=True) + '\n')
+                finally:
+                    metrics_file.close()
+            except (IOError, OSError), e:
+                self.log("Failed to write metrics to '%s' (%s)!" % 
+                         (self.metrics_file, str(e)))
+        
+        if self.prometheus_file:
+            try:
+                self.write_prometheus_file(values)
+            except (IOError, OSError), e:
+                self.log("Failed to write metrics to '%s' (%s)!" % 
+                         (self.prometheus_file, str(e)))
+        
+        self.metrics.reset()
+
+
+    def write_prometheus_file(self, values):
+        """Replaces the Prometheus file by the given metrics of a run in the 
+        text format of the node exporter's textfile collector."""
+        labels = 'server="%s",remote_dir="%s"' % \
+                 (values['server'].replace('"', '\\"'), 
+                  values['remote_dir'].replace('"', '\\"'))
+        
+        lines = []
+        def metric(name, description, value):
+            lines.append('# HELP fetch_sftp_%s %s' % (name, description))
+            lines.append('# TYPE fetch_sftp_%s gauge' % (name))
+            lines.append('fetch_sftp_%s{%s} %s' % (name, labels, value))
+        
+        if isinstance(values['result'], int):
+            exit_code = values['result']
+        elif values['result'] is None:
+            exit_code = 0
+        else:
+            exit_code = -1
+        
+        metric('last_run_timestamp_seconds', 
+               'Time of the end of the last run.', values['timestamp'])
+        metric('last_run_exit_code', 
+               'Exit code of the last run (-1 on errors).', exit_code)
+        metric('last_run_duration_seconds', 
+               'Duration of the last run.', values['duration'])
+        metric('bytes_transfered', 
+               'Bytes of remote files read during the last run.', 
+               values['bytes_transfered'])
+        metric('megabytes_per_second', 
+               'Transfer rate of the last run.', values['mb_per_second'])
+        metric('files_fetched', 
+               'Files fetched during the last run.', values['files_fetched'])
+        metric('states_created', 
+               'State files created during the last run.', 
+               values['states_created'])
+        
+        lines.append('# HELP fetch_sftp_phase_seconds Time spent per phase of '
+                     'the last run.')
+        lines.append('# TYPE fetch_sftp_phase_seconds gauge')
+        phases = values['phases'].keys()
+        phases.sort()
+        for phase in phases:
+            lines.append('fetch_sftp_phase_seconds{%s,phase="%s"} %s' % 
+                         (labels, phase, values['phases'][phase]))
+        
+        lines.append('# HELP fetch_sftp_round_trips SFTP round trips per '
+                     'operation of the last run.')
+        lines.append('# TYPE fetch_sftp_round_trips gauge')
+        operations = values['round_trips'].keys()
+        operations.sort()
+        for operation in operations:
+            lines.append('fetch_sftp_round_trips{%s,operation="%s"} %i' % 
+                         (labels, operation, values['round_trips'][operation]))
+        
+        lines.append('# HELP fetch_sftp_cache_hit_rate Hit rate of the caches '
+                     'during the last run.')
+        lines.append('# TYPE fetch_sftp_cache_hit_rate gauge')
+        names = values['caches'].keys()
+        names.sort()
+        for name in names:
+            lines.append('fetch_sftp_cache_hit_rate{%s,cache="%s"} %s' % 
+                         (labels, name, values['caches'][name]['hit_rate']))
+        
+        # The collector must never read a partly written file
+        temporary_pathname = self.prometheus_file + '.tmp'
+        prometheus_file = open(temporary_pathname, 'w')
+        try:
+            prometheus_file.write('\n'.join(lines) + '\n')
+        finally:
+            prometheus_file.close()
+        os.rename(temporary_pathname, self.prometheus_file)
+
+
+    def listing_snapshot_pathname(self):
+        """Returns the pathname of the listing snapshot of this job or None if 
+        listing snapshots are not used. The snapshot depends on everything 
+        influencing the decisions of a run (see listing_snapshot_key())."""
+        if not self.listing_snapshot_dir:
+            return None
+        
+        key_sha = new_sha1()
+        key_sha.update(self.listing_snapshot_key())
+        return os.path.join(self.listing_snapshot_dir, 
+                            key_sha.hexdigest() + '.lst')
+
+
+    def listing_snapshot_key(self):
+        """Returns a string describing the remote directory, the states and the
+        options influencing the checks of this job."""
+        return repr((self.remote_location(), 
+                     self.remote_dir, 
+                     self.previous_states, 
+                     self.next_states, 
+                     self.local_dir, 
+                     self.no_fetch, 
+                     self.state_check, 
+                     self.force_state_check, 
+                     self.delete_remote_file, 
+                     self.delete_remote_all_statefiles, 
+                     self.delete_remote_previous_statefiles))
+
+
+    def load_listing_snapshot(self):
+        """Returns the snapshot of the listing of the last successful run as a
+        dict mapping the filenames to their sizes and modification times. 
+        None is returned if there is no (valid) snapshot."""
+        pathname = self.listing_snapshot_pathname()
+        if not pathname or not os.path.exists(pathname):
+            return None
+        
+        snapshot = {}
+        try:
+            snapshot_file = open(pathname, 'r')
+            try:
+                if snapshot_file.readline().rstrip('\n') != \
+                   self.listing_snapshot_key():
+                    return None
+                for line in snapshot_file:
+                    (size, mtime, filename) = line.rstrip('\n').split(' ', 2)
+                    snapshot[filename.decode('utf-8')] = (size, mtime)
+            finally:
+                snapshot_file.close()
+        except (IOError, ValueError), e:
+            self.log("Ignoring invalid listing snapshot '%s' (%s)!" % 
+                     (pathname, str(e)))
+            return None
+        
+        self.debug("Loaded listing snapshot '%s' (%i files)." % 
+                   (pathname, len(snapshot)))
+        return snapshot
+
+
+    def save_listing_snapshot(self, remote_listing):
+        """Replaces the listing snapshot of this job by the given listing. 
+        Listings with files of unknown sizes or modification times (or names 
+        which can not be stored) are not remembered at all."""
+        pathname = self.listing_snapshot_pathname()
+        if not pathname:
+            return
+        
+        lines = []
+        for attributes in remote_listing:
+            if attributes.st_size is None or attributes.st_mtime is None or \
+               '\n' in attributes.filename:
+                self.debug("Not remembering listing of '%s' (file '%s')." % 
+                           (self.remote_dir, attributes.filename))
+                lines = None
+                break
+            lines.append("%i %i %s\n" % (attributes.st_size, 
+                                         attributes.st_mtime, 
+                                         attributes.filename))
+        
+        try:
+            if lines is None:
+                if os.path.exists(pathname):
+                    os.remove(pathname)
+                return
+            
+            if not os.path.isdir(self.listing_snapshot_dir):
+                os.makedirs(self.listing_snapshot_dir)
+            
+            # Replace the snapshot atomically
+            temporary_pathname = pathname + '.tmp'
+            snapshot_file = open(temporary_pathname, 'w')
+            try:
+                snapshot_file.write(self.listing_snapshot_key() + '\n')
+                for line in lines:
+                    if isinstance(line, unicode):
+                        line = line.encode('utf-8')
+                    snapshot_file.write(line)
+            finally:
+                snapshot_file.close()
+            os.rename(temporary_pathname, pathname)
+        except (IOError, OSError), e:
+            self.log("Failed to save listing snapshot '%s' (%s)!" % 
+                     (pathname, str(e)))
+
+
+    def changed_filenames(self, snapshot):
+        """Compares the current listing of the remote directory (see 
+        remote_attributes) with the given snapshot. Returns a dict whose keys 
+        are the names of all files which need to be checked again: files which
+        were added or changed, and files whose state files were added, removed
+        or changed."""
+        changed_entries = []
+        added = changed = 0
+        for (filename, attributes) in self.remote_attributes.items():
+            entry = snapshot.get(filename)
+            if entry is None:
+                added = added + 1
+            elif entry != (str(attributes.st_size), str(attributes.st_mtime)):
+                changed = changed + 1
+            else:
+                continue
+            changed_entries.append(filename)
+        
+        removed = 0
+        for filename in snapshot.keys():
+            if not self.remote_attributes.has_key(filename):
+                removed = removed + 1
+                changed_entries.append(filename)
+        
+        self.debug("Listing of '%s' differs from the snapshot by %i added, %i "
+                   "removed and %i changed files." % 
+                   (self.remote_dir, added, removed, changed))
+        
+        # A changed state file changes the file it belongs to
+        changed_filenames = {}
+        for filename in changed_entries:
+            changed_filenames[filename] = True
+            for state in self.previous_states + self.next_states:
+                suffix = '.' + state
+                if filename.endswith(suffix):
+                    changed_filenames[filename[:-len(suffix)]] = True
+        
+        return changed_filenames
+
+
+    def confirm_state_files(self):
+        """Checks with a single listing of the remote directory that all state
+        files written during this run exist and hold at least the written 
+        content. Missing or short state files are logged."""
+        if not self.written_state_files:
+            return
+        
+        sizes = {}
+        for attributes in self.list_remote_dir():
+            sizes[attributes.filename] = attributes.st_size
+        
+        confirmed = 0
+        for (remote_pathname, content) in self.written_state_files.items():
+            size = sizes.get(os.path.basename(remote_pathname))
+            if size is None:
+                self.log("State file '%s' is missing after writing it!" % 
+                         (remote_pathname))
+            elif size < len(content):
+                self.log("State file '%s' was not written completely (%i of "
+                         "%i bytes)!" % 
+                         (remote_pathname, size, len(content)))
+            else:
+                confirmed = confirmed + 1
+        
+        self.verbose("Confirmed %i of %i written state files." % 
+                     (confirmed, len(self.written_state_files)))
+
+
+    def list_remote_dir(self):
+        """Returns the attributes of all files in the remote directory."""
+        self.count_round_trips('listdir')
+        started = time.time()
+        try:
+            return self.sftp.listdir_attr(self.remote_dir)
+        finally:
+            self.metrics.add_time('listdir', time.time() - started)
+
+
+    def count_round_trips(self, operation, count=1):
+        """Counts SFTP requests of the given operation the fetcher has to wait 
+        for. The round trips are reported with the verbose output of every 
+        run (see round_trip_summary())."""
+        self.lock.acquire()
+        try:
+            self.round_trips[operation] = self.round_trips.get(operation, 0) + \
+                                          count
+        finally:
+            self.lock.release()
+
+
+    def round_trip_summary(self):
+        """Returns a line describing the round trips counted since the last 
+        run."""
+        operations = self.round_trips.keys()
+        operations.sort()
+        return "%i round trips to the SFTP server (%s)." % \
+               (sum(self.round_trips.values()), 
+                ', '.join(["%s: %i" % (operation, self.round_trips[operation])
+                           for operation in operations]))
+
+
+    def listing_fingerprint(self, remote_listing, ignored_filenames=None):
+        """Returns a sorted list of the names, sizes and modification times of 
+        the files in the given listing. Two fingerprints only differ if files 
+        were added, removed or changed. The files in the given dict of ignored
+        filenames are left out."""
+        fingerprint = []
+        for attributes in remote_listing:
+            if ignored_filenames and \
+               ignored_filenames.has_key(attributes.filename):
+                continue
+            fingerprint.append((attributes.filename, 
+                                attributes.st_size, 
+                                attributes.st_mtime))
+        fingerprint.sort()
+        return fingerprint
+
+
+    def fetch_listed_files_by_state(self, remote_filename_list, 
+                                    fetched_filenames, snapshot=None):
+        """Checks the states of all files in the given list of remote 
+        filenames and fetches the files matching the states. The names of the 
+        fetched files are appended to the given list of fetched filenames. If
+        the snapshot of a previous listing is given, only files changed since
+        then are checked (see changed_filenames())."""
+        # Decide by the listing only which files have to be checked in detail
+        (candidate_filenames, state_filenames) = self.plan_fetch(remote_filename_list)
+        
+        if snapshot is not None:
+            changed_filenames = self.changed_filenames(snapshot)
+            self.verbose("%i of %i candidates changed since the last run." % 
+                         (len([filename for filename in candidate_filenames 
+                               if changed_filenames.has_key(filename)]), 
+                          len(candidate_filenames)))
+            candidate_filenames = [filename for filename in candidate_filenames
+                                   if changed_filenames.has_key(filename)]
+        
+        # Read the state files to be checked in one go
+        self.prefetch_state_files(candidate_filenames, state_filenames)
+        
+        if self.parallel > 1 and len(candidate_filenames) > 1:
+            self.fetch_files_in_parallel(candidate_filenames, 
+                                         state_filenames, 
+                                         remote_filename_list, 
+                                         fetched_filenames)
+        else:
+            # Iterate over the candidates and check their state files
+            for remote_filename in candidate_filenames:
+                self.fetch_file_by_state(remote_filename, 
+                                         state_filenames[remote_filename], 
+                                         remote_filename_list, 
+                                         fetched_filenames)
+
+
+    def prefetch_state_files(self, candidate_filenames, state_filenames):
+        """Reads the contents of the state files of the given candidates into 
+        the file cache using the backend (see --backend). Only state files 
+        whose hash digests will be checked are read (see 
+        fetch_file_by_state())."""
+        if not self.state_check:
+            return
+        
+        remote_pathnames = []
+        for remote_filename in candidate_filenames:
+            for state_filename in state_filenames[remote_filename].values():
+                size = self.remote_attributes[state_filename].st_size
+                remote_pathname = os.path.join(self.remote_dir, state_filename)
+                if size > 0 and size <= SMALL_FILE_SIZE and \
+                   not self.file_cache.has_key(remote_pathname):
+                    remote_pathnames.append(remote_pathname)
+        
+        if not remote_pathnames:
+            return
+        
+        self.debug("Reading %i state files using the backend '%s'." % 
+                   (len(remote_pathnames), self.backend_name))
+        started = time.time()
+        contents = self.backend.read_files(remote_pathnames)
+        self.metrics.add_time('state_read', time.time() - started)
+        for (remote_pathname, content) in contents.items():
+            self.file_cache.put(remote_pathname, content, len(content))
+
+
+    def fetch_files_in_parallel(self, candidate_filenames, state_filenames, 
+                                remote_filename_list, fetched_filenames):
+        """Checks and fetches the candidates concurrently by a pool of worker 
+        threads (see --parallel). Each worker uses its own SFTP client. If 
+        fetching a file fails, the other files are fetched nevertheless and 
+        the first error is raised afterwards."""
+        candidates = Queue.Queue()
+        for remote_filename in candidate_filenames:
+            candidates.put(remote_filename)
+        
+        errors = []
+        workers = []
+        for number in range(min(self.parallel, len(candidate_filenames))):
+            worker = threading.Thread(target=self.fetch_worker, 
+                                      args=(candidates, 
+                                            state_filenames, 
+                                            remote_filename_list, 
+                                            fetched_filenames, 
+                                            errors))
+            worker.start()
+            workers.append(worker)
+        
+        for worker in workers:
+            worker.join()
+        
+        if not candidates.empty():
+            self.log("Not all remote files could be checked for states!")
+        
+        if errors:
+            raise errors[0]
+
+
+    def fetch_worker(self, candidates, state_filenames, remote_filename_list, 
+                     fetched_filenames, errors):
+        """The main loop of a worker thread. Takes candidates from the queue 
+        until it is empty and checks and fetches them using an own SFTP 
+        client. Errors are appended to the given list."""
+        try:
+            (client, transport) = self.open_worker_client()
+        except Exception, e:
+            self.log("Failed to open SFTP client for worker thread (%s)!" % 
+                     (str(e)))
+            errors.append(e)
+            return
+        
+        self.worker.sftp = client
+        try:
+            while True:
+                try:
+                    remote_filename = candidates.get_nowait()
+                except Queue.Empty:
+                    break
+                
+                try:
+                    self.fetch_file_by_state(remote_filename, 
+                                             state_filenames[remote_filename], 
+                                             remote_filename_list, 
+                                             fetched_filenames)
+                except Exception, e:
+                    self.log("Failed to fetch remote file '%s' (%s)!" % 
+                             (remote_filename, str(e)))
+                    traceback.print_exc()
+                    errors.append(e)
+        finally:
+            self.worker.sftp = None
+            client.close()
+            if transport:
+                transport.close()
+
+
+    def open_worker_client(self):
+        """Opens an additional SFTP client for a worker thread. A new channel on
+        the existing SSH transport is used. If the server refuses to open 
+        another channel (or --parallel-transports is given), another SSH 
+        transport is opened and authenticated with the same RSA identity.
+        Returns the SFTP client and the additional transport (or None)."""
+        if not self.parallel_transports:
+            try:
+                client = paramiko.SFTPClient.from_transport(self.transp)
+            except paramiko.SSHException, e:
+                self.debug("Failed to open another SFTP channel (%s)!" % 
+                           (str(e)))
+                client = None
+            
+            if client:
+                client.get_channel().settimeout(30.0)
+                return (client, None)
+        
+        self.debug("Opening another SSH transport to remote server...")
+        transport = paramiko.Transport((self.remote_server, self.remote_port))
+        try:
+            # The server must present the same host key as for the main 
+            # transport
+            transport.connect(hostkey=self.transp.get_remote_server_key(), 
+                              username=self.remote_user, 
+                              pkey=self.rsa_key)
+            client = paramiko.SFTPClient.from_transport(transport)
+            client.get_channel().settimeout(30.0)
+        except:
+            transport.close()
+            raise
+        
+        return (client, transport)
+
+
+    def client(self):
+        """Returns the SFTP client of the current worker thread (see 
+        --parallel) or the main SFTP client."""
+        return getattr(self.worker, 'sftp', None) or self.sftp
+
+
+    def fetch_file_by_state(self, remote_filename, found_state_filenames, 
+                            remote_filename_list, fetched_filenames):
+        """Checks the state files of a single remote file (found in the listing
+        and given as a dict of states and state filenames) and fetches the 
+        file if all previous states are met. Afterwards the next state files 
+        are created and the remote files are deleted as wanted. The name of 
+        the file is appended to the given list of fetched filenames."""
+        remote_pathname = os.path.join(self.remote_dir, remote_filename)
+        
+        self.debug("Checking file '%s' for states..." % (remote_pathname))
+        
+        # Whether this fetcher holds a claim on the file (see --claim)
+        claimed = False
+        
+        # All hash digests needed for the states of this file are computed in
+        # one pass over its content
+        self.required_digests[remote_pathname] = self.state_digest_names(found_state_filenames)
+        
+        try:
             # Check if all state files do exist by collecting states found on 
             # remote side in this lists
             previous_states_found = []
@@ -642,17 +2764,29 @@ class SFTPFetcher:
                 self.debug("Checking for previous state file '%s'..." % 
                            (remote_state_filename))
                 
-                if remote_state_filename in remote_filename_list:
-                    state_file = self.sftp.file(remote_state_pathname, 'r')
+                if found_state_filenames.has_key(state):
+                    # The size is known from the listing, the state file is 
+                    # only read if its content has to be compared
+                    size = self.remote_attributes[remote_state_filename].st_size
                     
-                    if self.state_check and state_file.stat().st_size > 0:
-                        # Update the hash for the state file
-                        state_hash = self.hash_remote_file(remote_pathname)
-                        state_hash.update(remote_state_filename)
+                    if self.state_check and size > 0:
+                        # The content may be known locally already or be
+                        # reconstructed from a previous archive
+                        self.match_content_store(remote_filename, 
+                                                 remote_state_filename)
+                        self.delta_fetch(remote_filename, 
+                                         remote_state_filename)
+                        
+                        # Get the hash for the state file using the hash 
+                        # algorithm of the state file
+                        (algorithm, expected_digest) = parse_state_digest(self.get_remote_file(remote_state_pathname))
+                        state_digest = self.state_digest(remote_filename, 
+                                                         remote_state_filename, 
+                                                         algorithm)
                         
                         # Compare the hash hexdigest of the remote file and the 
                         # state filename with the content of the statefile
-                        if state_hash.hexdigest() == self.get_remote_file(remote_state_pathname):
+                        if state_digest == expected_digest:
                             self.verbose("Found previous state '%s' "
                                          "(Hash digest matches)!" % 
                                          (state))
@@ -661,7 +2795,7 @@ class SFTPFetcher:
                             self.verbose("Invalid Hash-Digest of the previous "
                                          "state file (Should be: '%s', "
                                          "content of state_file: %s)!" % 
-                                         (state_hash.hexdigest(), 
+                                         (state_digest, 
                                           self.get_remote_file(remote_state_pathname)))
                     elif not self.force_state_check:
                         self.verbose("Found previous state '%s' "
@@ -674,8 +2808,6 @@ class SFTPFetcher:
                                      "the state useless. Ignoring it "
                                      "(state: %s)!" % (state))
                     
-                    state_file.close()
-                    
             # Check for the next state files in the remote file list
             for state in self.next_states:
                 remote_state_filename = remote_filename + '.' + state
@@ -684,17 +2816,20 @@ class SFTPFetcher:
                 self.debug("Checking for next state file '%s'..." % 
                            (remote_state_filename))
                 
-                if remote_state_filename in remote_filename_list:
-                    state_file = self.sftp.file(remote_state_pathname, 'r')
+                if found_state_filenames.has_key(state):
+                    size = self.remote_attributes[remote_state_filename].st_size
                     
-                    if self.state_check and state_file.stat().st_size > 0:
-                        # Update the hash for the state file
-                        state_sha = self.hash_remote_file(remote_pathname)
-                        state_sha.update(remote_state_filename)
+                    if self.state_check and size > 0:
+                        # Get the hash for the state file using the hash 
+                        # algorithm of the state file
+                        (algorithm, expected_digest) = parse_state_digest(self.get_remote_file(remote_state_pathname))
+                        state_digest = self.state_digest(remote_filename, 
+                                                         remote_state_filename, 
+                                                         algorithm)
                         
                         # Compare the hash hexdigest of the remote file and the 
                         # state filename with the content of the statefile
-                        if state_sha.hexdigest() == self.get_remote_file(remote_state_pathname):
+                        if state_digest == expected_digest:
                             self.verbose("Found next state '%s' "
                                          "(Hash-Digest matches)!" % 
                                          (state))
@@ -714,8 +2849,6 @@ class SFTPFetcher:
                                      "the state useless. Ignoring it "
                                      "(state: %s)!" % 
                                      (state))
-                        
-                    state_file.close()
                     
             # If all next states were found simply skip this file
             if len(self.next_states) > 0:
@@ -723,26 +2856,45 @@ class SFTPFetcher:
                     self.verbose("Skipping the file '%s' because all next "
                                  "states are already reached!" % 
                                  (remote_pathname))
-                    continue
+                    return
                     
             # Only react if all states files were found in remote files list
             if len(previous_states_found) == len(self.previous_states):
                 
+                # Make sure no other fetcher works on this file
+                if self.claim and not self.dry_run:
+                    if not self.claim_remote_file(remote_filename):
+                        self.lock.acquire()
+                        try:
+                            self.claimed_elsewhere[remote_filename] = True
+                        finally:
+                            self.lock.release()
+                        return
+                    claimed = True
+                    
+                    if not self.states_unchanged(remote_filename, 
+                                                 next_states_found):
+                        return
+                
+                fetched = True
                 if not self.dry_run and not self.no_fetch:
                     local_pathname = os.path.join(self.local_dir, 
                                                    remote_filename)
                     self.verbose("Fetching the file '%s' to '%s'!" % 
                                  (remote_pathname, local_pathname))
-                    local_file = open(local_pathname, 'w')
-                    local_file.write(self.get_remote_file(remote_pathname))
-                    local_file.close()
+                    fetched = self.fetch_remote_file(remote_pathname, 
+                                                     local_pathname)
                 else:
                     self.verbose("Not fetching the file '%s'!" % (remote_pathname))
                     
-                # Remember this file as fetched
-                fetched_filenames.append(remote_filename)
+                # Remember this file as fetched, unless its content is 
+                # deployed already
+                if fetched:
+                    fetched_filenames.append(remote_filename)
                 
-                # Create the next state files
+                # Create the next state files, all of them written in one go
+                # (see --backend)
+                next_state_contents = {}
                 for next_state in self.next_states:
                     remote_state_filename = remote_filename + '.' + next_state
                     if not next_state in next_states_found:
@@ -750,29 +2902,52 @@ class SFTPFetcher:
                         if not self.dry_run:
                             self.debug("Creating new remote state  %s" % 
                                        (next_state))
-                            next_state_file = self.sftp.file(os.path.join(self.remote_dir, 
-                                                                          remote_state_filename),
-                                                             'a')
-                            state_hash = self.hash_remote_file(remote_pathname)
-                            state_hash.update(remote_state_filename)
+                            state_digest = format_state_digest(self.state_digest_name, 
+                                                               self.state_digest(remote_filename, 
+                                                                                 remote_state_filename, 
+                                                                                 self.state_digest_name))
                             self.verbose("Writing hash '%s' to next state "
                                          "file." % 
-                                         (state_hash.hexdigest()))
-                            next_state_file.write(state_hash.hexdigest())
-                            next_state_file.flush
-                            next_state_file.close()
-                            states_created = states_created + 1
+                                         (state_digest))
+                            next_state_contents[os.path.join(self.remote_dir, 
+                                                             remote_state_filename)] = state_digest
                         else:
                             self.verbose("!Dry-run! Not creating remote state "
                                          "'%s'!" % 
                                          (next_state))
                 
+                if next_state_contents:
+                    started = time.time()
+                    self.backend.write_files(next_state_contents)
+                    self.metrics.add_time('state_write', time.time() - started)
+                    self.lock.acquire()
+                    try:
+                        self.states_created = self.states_created + \
+                                              len(next_state_contents)
+                        self.written_state_files.update(next_state_contents)
+                    finally:
+                        self.lock.release()
+                
+                # Let other fetchers go on with this file. Deleting is left to
+                # the last fetcher holding a claim on it
+                archive_pathname = remote_pathname
+                if claimed:
+                    claim = self.release_claim(remote_filename)
+                    claimed = False
+                    
+                    if self.delete_remote_file or \
+                       self.delete_remote_all_statefiles or \
+                       self.delete_remote_previous_statefiles:
+                        archive_pathname = self.withdraw_remote_file(remote_filename, 
+                                                                     claim)
+                        if archive_pathname is None:
+                            return
+                
                 # Delete the fetched remote file
                 if self.delete_remote_file:
                     if not self.dry_run:
                         self.verbose("Deleting this remote file as wanted!")
-                        self.sftp.unlink(os.path.join(self.remote_dir, 
-                                                      remote_filename))
+                        self.remove_remote_file(archive_pathname)
                     else:
                         self.verbose("!Dry-run! Not deleting this remote file!")
                 
@@ -782,12 +2957,41 @@ class SFTPFetcher:
                         self.verbose("Deleting all state files for this remote "
                                      "file!")
                         
-                        for deletion_candidate_filename in remote_filename_list:
+                        for deletion_candidate_filename in remote_filename_list[:]:
                             deletion_candidate_pathename = os.path.join(self.remote_dir, 
                                                                         deletion_candidate_filename)
-                            if deletion_candidate_file.startswith(remote_filename) and remote_filename != deletion_candidate_filename:
-                                if self.sftp.stat(deletion_candidate_pathename).st_size == 0:
-                                    self.sftp.unlink(deletion_candidate_pathename)
+                            if self.claim and self.is_claim_file(deletion_candidate_filename):
+                                continue
+                            if deletion_candidate_filename.startswith(remote_filename) and remote_filename != deletion_candidate_filename:
+                                # Take the state file out of the listing 
+                                # before deleting it, so no other worker 
+                                # deletes it too (e.g. for 'plan.zip' and 
+                                # 'plan.zip.old')
+                                taken = False
+                                self.lock.acquire()
+                                try:
+                                    attributes = self.remote_attributes.get(deletion_candidate_filename)
+                                    if deletion_candidate_filename not in remote_filename_list or \
+                                       attributes is None:
+                                        continue
+                                    if attributes.st_size == 0:
+                                        remote_filename_list.remove(deletion_candidate_filename)
+                                        del self.remote_attributes[deletion_candidate_filename]
+                                        taken = True
+                                finally:
+                                    self.lock.release()
+                                
+                                if taken:
+                                    try:
+                                        self.remove_remote_file(deletion_candidate_pathename)
+                                    except IOError, e:
+                                        # Deleted meanwhile (e.g. by another 
+                                        # fetcher)
+                                        if e.errno != errno.ENOENT:
+                                            raise
+                                        self.debug("Remote file '%s' is "
+                                                   "already deleted." % 
+                                                   (deletion_candidate_pathename))
                                 else:
                                     self.log("Not deleting remote file '%s', "
                                              "because it is not an empty file!"
@@ -801,35 +3005,377 @@ class SFTPFetcher:
                         self.verbose("Deleting previous state files for this "
                                      "remote file!")
                         for state in self.previous_states:
+                            state_filename = remote_filename + '.' + state
                             state_pathname = os.path.join(self.remote_dir, 
-                                                          remote_filename + 
-                                                          '.' + state)
+                                                          state_filename)
+                            
+                            # Take the state file out of the listing before 
+                            # deleting it, another worker may delete it too 
+                            # (see above)
+                            self.lock.acquire()
                             try:
-                                self.sftp.unlink(state_pathname)
-                            except IOError:
-                                self.log("Failed to delete state file '%s' for "
-                                         "state '%s'!" % 
-                                         (state_pathname, state))
+                                if state_filename not in remote_filename_list or \
+                                   self.remote_attributes.get(state_filename) is None:
+                                    continue
+                                remote_filename_list.remove(state_filename)
+                                del self.remote_attributes[state_filename]
+                            finally:
+                                self.lock.release()
                             
-                            # remove the deleted statefile from the list of 
-                            # remote files as well!
-                            remote_filename_list.remove(remote_filename + '.' + 
-                                                        state) 
+                            try:
+                                self.remove_remote_file(state_pathname)
+                            except IOError, e:
+                                if e.errno == errno.ENOENT:
+                                    self.debug("Remote file '%s' is already "
+                                               "deleted." % 
+                                               (state_pathname))
+                                else:
+                                    self.log("Failed to delete state file '%s' "
+                                             "for state '%s'!" % 
+                                             (state_pathname, state))
                     else:
                         self.verbose("!Dry-run! Not deleting previous state "
                                      "files for this remote file!")
+        finally:
+            # A spool file only makes sense for the file currently checked
+            self.discard_spool_file(remote_pathname)
+            
+            # Never keep a claim on a file which could not be finished
+            if claimed:
+                self.release_claim(remote_filename)
+            
+            del self.required_digests[remote_pathname]
+            self.lock.acquire()
+            try:
+                self.remote_digests.pop(remote_pathname, None)
+            finally:
+                self.lock.release()
+
+
+    def claim_pathname(self, remote_filename):
+        """Returns the remote pathname of the claim file of this fetcher for 
+        the given remote file. Fetchers creating the same next states use the
+        same claim file."""
+        if self.next_states:
+            return os.path.join(self.remote_dir, 
+                                "%s.%s.%s" % (remote_filename, 
+                                              '+'.join(self.next_states), 
+                                              CLAIM_SUFFIX))
+        return os.path.join(self.remote_dir, 
+                            "%s.%s" % (remote_filename, CLAIM_SUFFIX))
+    
+    
+    def is_claim_file(self, remote_filename):
+        """Returns whether the given remote file is a claim file or a 
+        temporary file of the claim protocol (see claim_remote_file())."""
+        return remote_filename.endswith('.' + CLAIM_SUFFIX) or \
+               ('.' + CLAIM_SUFFIX + '.') in remote_filename
+    
+    
+    def claim_owner(self):
+        """Returns a name identifying this fetcher (and the current worker 
+        thread) on all hosts."""
+        return "%s-%i-%s" % (socket.gethostname(), 
+                             os.getpid(), 
+                             threading.currentThread().getName())
+    
+    
+    def claim_remote_file(self, remote_filename):
+        """Claims the given remote file for this fetcher. The claim is written
+        into a temporary file which is created exclusively and renamed to the
+        claim file. The rename fails if another fetcher holds the claim 
+        already. A stale claim is broken once (see break_stale_claim()). 
+        Returns whether the claim was obtained."""
+        claim_pathname = self.claim_pathname(remote_filename)
+        owner = self.claim_owner()
+        temporary_pathname = "%s.%s.tmp" % (claim_pathname, owner)
         
-        if not self.no_fetch and len(fetched_filenames) < 1:
-            self.verbose("No files got fetched!")
-            return 1
-        elif self.no_fetch and states_created < 1:
-            self.verbose("No next states have been created!")
-            return 2
-        elif not self.no_fetch:
-            self.log("Just fetched the following local files %s" %
-                    (fetched_filenames))
-        else:
-            return 0
+        self.count_round_trips('claim', 5)
+        claim_file = self.client().open(temporary_pathname, 'wx')
+        try:
+            claim_file.write("%s %i\n" % (owner, int(time.time())))
+            claim_file.flush()
+            # The modification time tells the time of the remote server, no
+            # matter how the clocks of the fetchers differ
+            claimed_mtime = claim_file.stat().st_mtime
+        finally:
+            claim_file.close()
+        
+        claimed = False
+        try:
+            for attempt in range(2):
+                try:
+                    self.client().rename(temporary_pathname, claim_pathname)
+                    claimed = True
+                    break
+                except IOError:
+                    pass
+                
+                if attempt > 0 or \
+                   not self.break_stale_claim(claim_pathname, claimed_mtime):
+                    break
+        finally:
+            if not claimed:
+                try:
+                    self.remove_remote_file(temporary_pathname)
+                except IOError, e:
+                    self.log("Failed to remove temporary claim file '%s' "
+                             "(%s)!" % 
+                             (temporary_pathname, str(e)))
+        
+        if not claimed:
+            self.verbose("Skipping the file '%s' claimed by another fetcher!" %
+                         (remote_filename))
+            return False
+        
+        self.debug("Claimed the file '%s' ('%s')." % 
+                   (remote_filename, claim_pathname))
+        self.lock.acquire()
+        try:
+            self.claims[remote_filename] = (claimed_mtime, time.time())
+        finally:
+            self.lock.release()
+        return True
+    
+    
+    def break_stale_claim(self, claim_pathname, remote_time):
+        """Removes the given claim file of another fetcher if it is older than
+        the claim timeout at the given time of the remote server. The claim 
+        is renamed to a private name first, so only one fetcher breaks it. 
+        Returns whether the claim may be tried again."""
+        self.count_round_trips('claim')
+        try:
+            attributes = self.client().stat(claim_pathname)
+        except IOError:
+            # The claim was released meanwhile
+            return True
+        
+        age = remote_time - attributes.st_mtime
+        if age <= self.claim_timeout:
+            self.debug("Claim '%s' is held by another fetcher (%i seconds "
+                       "old)." % 
+                       (claim_pathname, age))
+            return False
+        
+        self.log("Breaking stale claim '%s' (%i seconds old)!" % 
+                 (claim_pathname, age))
+        stale_pathname = "%s.%s.stale" % (claim_pathname, self.claim_owner())
+        self.count_round_trips('claim', 2)
+        try:
+            self.client().rename(claim_pathname, stale_pathname)
+            stale_attributes = self.client().stat(stale_pathname)
+        except IOError:
+            # Another fetcher broke the claim first
+            return False
+        
+        if stale_attributes.st_mtime != attributes.st_mtime:
+            # A new claim was made after the stale one was broken by another 
+            # fetcher, give it back
+            try:
+                self.client().rename(stale_pathname, claim_pathname)
+            except IOError, e:
+                self.log("Failed to restore claim '%s' (%s)!" % 
+                         (claim_pathname, str(e)))
+            return False
+        
+        self.remove_remote_file(stale_pathname)
+        return True
+    
+    
+    def release_claim(self, remote_filename):
+        """Removes the claim of this fetcher on the given remote file. Returns
+        the remote modification time of the claim and the local time it was 
+        made at."""
+        self.lock.acquire()
+        try:
+            claim = self.claims.pop(remote_filename)
+        finally:
+            self.lock.release()
+        
+        claim_pathname = self.claim_pathname(remote_filename)
+        try:
+            self.remove_remote_file(claim_pathname)
+        except IOError, e:
+            self.log("Failed to release claim '%s' (%s)!" % 
+                     (claim_pathname, str(e)))
+        self.debug("Released the claim on file '%s'." % (remote_filename))
+        return claim
+    
+    
+    def states_unchanged(self, remote_filename, next_states_found):
+        """Checks after claiming the given remote file that the file and its
+        previous state files still exist and that no missing next state was 
+        created by another fetcher since the listing. Returns whether the file
+        has to be fetched still."""
+        remote_pathnames = [os.path.join(self.remote_dir, remote_filename)]
+        for state in self.previous_states:
+            remote_pathnames.append(os.path.join(self.remote_dir, 
+                                                 remote_filename + '.' + state))
+        for pathname in remote_pathnames:
+            self.count_round_trips('stat')
+            try:
+                self.client().stat(pathname)
+            except IOError:
+                self.verbose("Skipping the file '%s' because '%s' vanished "
+                             "meanwhile!" % 
+                             (remote_filename, pathname))
+                return False
+        
+        for state in self.next_states:
+            if state in next_states_found:
+                continue
+            pathname = os.path.join(self.remote_dir, 
+                                    remote_filename + '.' + state)
+            self.count_round_trips('stat')
+            try:
+                self.client().stat(pathname)
+            except IOError:
+                continue
+            self.verbose("Skipping the file '%s' because its next state '%s' "
+                         "was created meanwhile!" % 
+                         (remote_filename, state))
+            return False
+        
+        return True
+    
+    
+    def foreign_claims(self, remote_filename, claim):
+        """Returns the names of all claim files of other fetchers on the given
+        remote file which are not stale. The time of the remote server is 
+        estimated from the given (released) claim of this fetcher. A fresh 
+        listing of the remote directory is used."""
+        (claimed_mtime, claimed) = claim
+        remote_time = claimed_mtime + (time.time() - claimed)
+        
+        self.count_round_trips('listdir')
+        claim_filenames = []
+        for attributes in self.client().listdir_attr(self.remote_dir):
+            filename = attributes.filename
+            if filename.startswith(remote_filename + '.') and \
+               filename.endswith('.' + CLAIM_SUFFIX) and \
+               remote_time - attributes.st_mtime <= self.claim_timeout:
+                claim_filenames.append(filename)
+        return claim_filenames
+    
+    
+    def withdraw_remote_file(self, remote_filename, claim):
+        """Prepares the deletion of the given remote file after the given claim
+        of this fetcher was released (see release_claim()). If the remote file is to be deleted, it is
+        renamed first, so no other fetcher claims it from now on. If other 
+        fetchers hold claims on the file, nothing is deleted and the file is 
+        renamed back. Returns the remote pathname of the file to be deleted or
+        None if the deletions have to be skipped."""
+        remote_pathname = os.path.join(self.remote_dir, remote_filename)
+        archive_pathname = remote_pathname
+        if self.delete_remote_file:
+            archive_pathname = "%s.%s.%s.deleted" % (remote_pathname, 
+                                                      CLAIM_SUFFIX, 
+                                                      self.claim_owner())
+            self.count_round_trips('rename')
+            self.client().rename(remote_pathname, archive_pathname)
+        
+        claim_filenames = self.foreign_claims(remote_filename, claim)
+        if not claim_filenames:
+            return archive_pathname
+        
+        self.verbose("Not deleting the file '%s' or its state files, because "
+                     "other fetchers hold claims on it %s!" % 
+                     (remote_filename, claim_filenames))
+        if archive_pathname != remote_pathname:
+            self.count_round_trips('rename')
+            self.client().rename(archive_pathname, remote_pathname)
+        return None
+    
+    
+    def remove_remote_file(self, remote_pathname):
+        """Deletes the given remote file."""
+        self.count_round_trips('remove')
+        started = time.time()
+        try:
+            self.client().unlink(remote_pathname)
+        finally:
+            self.metrics.add_time('delete', time.time() - started)
+        self.lock.acquire()
+        try:
+            self.removed_files[remote_pathname] = True
+        finally:
+            self.lock.release()
+
+
+    def group_state_files(self, remote_filename_list, states):
+        """Groups the state files in the given listing of the remote directory
+        by the files they belong to. Returns a dict mapping every listed 
+        filename to a dict of the found states and their state filenames. The 
+        listing is only scanned once and all lookups are done in dicts."""
+        state_filenames = {}
+        for remote_filename in remote_filename_list:
+            state_filenames[remote_filename] = {}
+        
+        for remote_filename in remote_filename_list:
+            for state in states:
+                suffix = '.' + state
+                if remote_filename.endswith(suffix):
+                    filename = remote_filename[:-len(suffix)]
+                    if state_filenames.has_key(filename):
+                        state_filenames[filename][state] = remote_filename
+        
+        return state_filenames
+
+
+    def plan_fetch(self, remote_filename_list):
+        """Decides by the listing of the remote directory which files can 
+        possibly match the states, before any remote file is read. Files 
+        lacking a previous state file are dropped, as well as files for which 
+        all next states are already reached without the need of a hash check.
+        Returns the list of remaining candidates and the state files of all 
+        listed files (see group_state_files())."""
+        state_filenames = self.group_state_files(remote_filename_list, 
+                                                 self.previous_states + 
+                                                 self.next_states)
+        candidate_filenames = []
+        
+        for remote_filename in remote_filename_list:
+            found_state_filenames = state_filenames[remote_filename]
+            
+            if self.claim and self.is_claim_file(remote_filename):
+                continue
+            
+            # Every previous state file must exist, and an empty one is 
+            # useless if the hash digest check is forced
+            missing_state = False
+            for state in self.previous_states:
+                if not found_state_filenames.has_key(state):
+                    missing_state = True
+                elif self.force_state_check and \
+                     self.remote_attributes[found_state_filenames[state]].st_size == 0:
+                    missing_state = True
+            
+            if missing_state:
+                continue
+            
+            # Next state files which would be accepted without checking a hash
+            # digest
+            next_states_reached = 0
+            for state in self.next_states:
+                if found_state_filenames.has_key(state) and \
+                   not self.force_state_check and \
+                   not (self.state_check and 
+                        self.remote_attributes[found_state_filenames[state]].st_size > 0):
+                    next_states_reached = next_states_reached + 1
+            
+            if len(self.next_states) > 0 and \
+               next_states_reached == len(self.next_states):
+                self.debug("All next states of file '%s' are already reached." % 
+                           (remote_filename))
+                continue
+            
+            candidate_filenames.append(remote_filename)
+        
+        self.debug("%i of %i remote files are candidates for fetching (%s)!" % 
+                   (len(candidate_filenames), 
+                    len(remote_filename_list), 
+                    candidate_filenames))
+        return (candidate_filenames, state_filenames)
 
 
     def list_files_with_state(self, states=None):
@@ -842,31 +3388,24 @@ class SFTPFetcher:
             for state in states:
                 self.verbose("  %s" % (state))
                 
+            self.count_round_trips('listdir')
             remote_filename_list = self.sftp.listdir(self.remote_dir)
             self.debug("Checking states for %i remote files: %s!" % 
                        (len(remote_filename_list), remote_filename_list))
             
+            state_filenames = self.group_state_files(remote_filename_list, 
+                                                     states)
+            
             for remote_filename in remote_filename_list:
                 self.debug("Checking file '%s' for matching states." % 
                            (remote_filename))
                 # This list remembers the states found for the current remote 
                 # filename.
-                found_states = []
+                found_states = state_filenames[remote_filename].keys()
                 
-                for state in states:
-                    remote_state_filename = remote_filename + '.' + state
-                    
-                    if remote_state_filename in remote_filename_list:
-                        self.debug("File '%s' matches state '%s'." % 
-                           (remote_filename, state))
-                        
-                        # Remove the state filename from the filename list to 
-                        # prevent a possible future check on states for this 
-                        # file.
-                        remote_filename_list.remove(remote_state_filename)
-                        
-                        # Remember the found state.
-                        found_states.append(state)
+                for state in found_states:
+                    self.debug("File '%s' matches state '%s'." % 
+                               (remote_filename, state))
                         
                 # If the same number of states were found we assume the 
                 # condition of all states beeing matched as fullfilled.
@@ -880,6 +3419,7 @@ class SFTPFetcher:
                                (remote_filename))
         else:
             self.verbose("Listing all remote files with no respect to states!")
+            self.count_round_trips('listdir')
             filenames_with_states = self.sftp.listdir(self.remote_dir)
         
         if filenames_with_states:
@@ -890,65 +3430,1125 @@ class SFTPFetcher:
             return 1
 
         
-    def hash_remote_file(self, remote_filename, force_update=False):
+    def hash_remote_file(self, remote_filename, force_update=False, 
+                         spool_pathname=None):
         """Returns a hash object which was already updated with the content of 
         the remote file.
         Internally this method builds an cache for the remote filenames and 
         their hash objects.
         Only copies of the cached hash objects are returned!
-        The has algorithm SHA-1 is always used, but the availability of the 
-        hashlib module (introduced with Python 2.5) is determined. If the 
-        hashlib module is available it is going to be used. Older versions of 
-        python try to use the SHA-1 algorithm."""
+        The remote file is read block by block (see stream_remote_file()), so 
+        it is never completely held in memory. If a spool pathname is given 
+        the content is written to this local file while hashing it. It can be 
+        fetched afterwards without transfering it again (see 
+        fetch_remote_file()).
+        The hash object computes all hash algorithms needed for the states of
+        the remote file (see state_digest_names()). A cached hash object 
+        lacking one of them is computed again, from the spooled content if 
+        possible."""
+        names = self.required_digests.get(remote_filename, [])
+        
+        file_sha = self.hash_cache.get(remote_filename)
+        if file_sha is not None and not file_sha.covers(names):
+            self.debug("Cached hash of file '%s' lacks an algorithm of %s." % 
+                       (remote_filename, names))
+            file_sha = None
+            if self.spool_files.has_key(remote_filename):
+                started = time.time()
+                file_sha = hash_local_file(self.spool_files[remote_filename], 
+                                           names)
+                self.metrics.add_time('hash', time.time() - started)
+                self.hash_cache.put(remote_filename, file_sha, HASH_OBJECT_SIZE)
         
-        if not self.hash_cache.has_key(remote_filename):
+        if file_sha is None:
             self.debug("Hash cache miss for file '%s'." % (remote_filename))
-            if sys.version_info[0] >= 2 and sys.version_info[1] >= 5:
-                self.hash_cache[remote_filename] = hashlib.sha1(self.get_remote_file(remote_filename))
-            else:
-                self.hash_cache[remote_filename] = sha.new(self.get_remote_file(remote_filename))
+            file_sha = self.stream_remote_file(remote_filename, spool_pathname)
+            self.hash_cache.put(remote_filename, file_sha, HASH_OBJECT_SIZE)
+            if spool_pathname:
+                self.spool_files[remote_filename] = spool_pathname
         else:
             self.debug("Hash cache hit for file '%s'." % (remote_filename))
             
         self.debug("Hash for file '%s' is '%s'." % (remote_filename, 
-                                                    self.hash_cache[remote_filename].hexdigest()))
-        return self.hash_cache[remote_filename].copy()    
+                                                    file_sha.hexdigest()))
+        return file_sha.copy()
+
+            
+    def state_digest(self, remote_filename, remote_state_filename='', 
+                     algorithm='sha1'):
+        """Returns the hexdigest of the hash of the given algorithm (SHA-1 by 
+        default) of the content of the file in the remote directory combined 
+        with the given state filename. Without a state filename the digest of 
+        the plain content is returned. None is returned for unknown 
+        algorithms.
+        The local hash index is consulted first, so an unchanged remote file is
+        only read once for all runs of this script. Then the SSH server is 
+        asked to compute the digest (see --remote-hash). If the remote file has
+        to be read and may get fetched, its content is spooled into the local 
+        directory to avoid transfering it twice."""
+        remote_pathname = os.path.join(self.remote_dir, remote_filename)
+        
+        if not DIGESTS.has_key(algorithm):
+            self.verbose("Unknown hash algorithm '%s' of state file '%s'!" % 
+                         (algorithm, remote_state_filename))
+            return None
+        
+        # Digests of other algorithms than SHA-1 are indexed with the 
+        # algorithm prefixed to the state filename
+        index_name = remote_state_filename
+        if algorithm != 'sha1':
+            index_name = "%s:%s" % (algorithm, remote_state_filename)
+        
+        index_key = self.hash_index_key(remote_pathname)
+        if index_key:
+            digest = self.hash_index.get(*(index_key + (index_name,)))
+            if digest:
+                self.debug("Hash index hit for file '%s' and state file '%s'." % 
+                           (remote_pathname, remote_state_filename))
+                return digest
+            self.debug("Hash index miss for file '%s' and state file '%s'." % 
+                       (remote_pathname, remote_state_filename))
+        
+        # The SSH server may compute the digest, unless the content was 
+        # transfered already anyway
+        if not self.hash_cache.has_key(remote_pathname) and \
+           not self.spool_files.has_key(remote_pathname):
+            digest = self.remote_state_digest(remote_pathname, 
+                                              remote_state_filename, 
+                                              algorithm)
+            if digest:
+                self.lock.acquire()
+                try:
+                    self.remote_digests.setdefault(remote_pathname, {})[(remote_state_filename, algorithm)] = digest
+                finally:
+                    self.lock.release()
+                if index_key:
+                    self.hash_index.put(*(index_key + (index_name, digest)))
+                return digest
+        
+        spool_pathname = None
+        if not self.dry_run and not self.no_fetch:
+            spool_pathname = self.spool_pathname(remote_filename)
+        
+        state_hash = self.hash_remote_file(remote_pathname, 
+                                           spool_pathname=spool_pathname)
+        state_hash.update(remote_state_filename)
+        digest = state_hash.hexdigest(algorithm)
+        
+        if index_key:
+            self.hash_index.put(*(index_key + (index_name, digest)))
+        
+        return digest
+
+
+    def state_digest_names(self, found_state_filenames):
+        """Returns the names of the hash algorithms needed for the given state
+        files of a remote file (see fetch_file_by_state()): the algorithms of
+        the non empty state files and the algorithm of new state files."""
+        names = []
+        if self.next_states:
+            names.append(self.state_digest_name)
+        
+        if not self.state_check:
+            return names
+        
+        for state_filename in found_state_filenames.values():
+            size = self.remote_attributes[state_filename].st_size
+            if size > 0 and size <= SMALL_FILE_SIZE:
+                algorithm = parse_state_digest(self.get_remote_file(os.path.join(self.remote_dir, 
+                                                                                 state_filename)))[0]
+                if DIGESTS.has_key(algorithm) and algorithm not in names:
+                    names.append(algorithm)
+        return names
+
+
+    def hash_index_key(self, remote_pathname):
+        """Returns the key identifying the remote file in the local hash index
+        by its pathname, size and modification time. None is returned if no 
+        hash index is used or the file was not listed completely."""
+        attributes = self.remote_attributes.get(os.path.basename(remote_pathname))
+        if not self.hash_index or not attributes or \
+           attributes.st_size is None or attributes.st_mtime is None:
+            return None
+        return (self.remote_location(), 
+                remote_pathname, 
+                attributes.st_size, 
+                attributes.st_mtime)
+
+
+    def known_content_digest(self, remote_pathname):
+        """Returns the digest of the plain content of the remote file if it is
+        known without reading the remote file (see hash_remote_file(), 
+        --hash-index and match_content_store()), otherwise None."""
+        # Another thread may evict the cached hash at any time
+        file_sha = self.hash_cache.get(remote_pathname)
+        if file_sha is not None:
+            return file_sha.hexdigest()
+        
+        digest = self.remote_digests.get(remote_pathname, {}).get(('', 'sha1'))
+        if digest:
+            return digest
+        
+        index_key = self.hash_index_key(remote_pathname)
+        if index_key:
+            return self.hash_index.get(*(index_key + ('',)))
+        return None
+
+
+    def remote_state_digest(self, remote_pathname, remote_state_filename, 
+                            algorithm):
+        """Returns the hexdigest of the hash of the given algorithm of the 
+        content of the remote file combined with the given state filename, 
+        computed by the SSH server without transfering the file (see 
+        --remote-hash). The digest of the plain content may be computed by the
+        'check-file' extension of the SFTP server, all others are computed by 
+        a command executed by the SSH server. None is returned if the server 
+        is not able to compute the digest."""
+        if not self.remote_hash or algorithm in self.remote_hash_failures:
+            return None
+        
+        started = time.time()
+        digest = None
+        if not remote_state_filename and algorithm in CHECK_FILE_DIGESTS:
+            digest = self.check_remote_file(remote_pathname, algorithm)
+        
+        if digest is None and REMOTE_HASH_COMMANDS.has_key(algorithm) and \
+           self.can_hash_remotely():
+            # The command prints 'done' only if the remote file was read 
+            # completely, because the exit status of a pipe is the one of the 
+            # hash command
+            command = "exec 3>&1; { cat -- %s && printf '%%s' %s && " \
+                      "echo done >&3; } | %s" % \
+                      (shell_quote(remote_pathname), 
+                       shell_quote(remote_state_filename), 
+                       REMOTE_HASH_COMMANDS[algorithm])
+            result = self.execute_remote_command(command)
+            if result is not None:
+                (status, output) = result
+                words = output.split()
+                size = DIGESTS[algorithm]().digest_size * 2
+                if status == 127:
+                    self.verbose("The SSH server is not able to compute '%s' "
+                                 "hash digests!" % 
+                                 (algorithm))
+                    self.remote_hash_failures.append(algorithm)
+                elif status == 0 and 'done' in words:
+                    for word in words:
+                        if len(word) == size and \
+                           not word.strip(string.hexdigits):
+                            digest = word.lower()
+                            break
+        
+        if digest:
+            self.metrics.add_time('hash', time.time() - started)
+            self.metrics.count('remote_hashes')
+            self.debug("The SSH server computed the hash '%s' of file '%s' "
+                       "and state file '%s'." % 
+                       (digest, remote_pathname, remote_state_filename))
+        else:
+            self.debug("The SSH server did not compute the hash of file '%s' "
+                       "and state file '%s'." % 
+                       (remote_pathname, remote_state_filename))
+        return digest
+
+
+    def can_hash_remotely(self):
+        """Returns whether the SSH server executes commands computing hash 
+        digests (see remote_state_digest()). The server is probed once per 
+        run by hashing no input."""
+        if self.remote_hashing is None:
+            result = self.execute_remote_command(REMOTE_HASH_PROBE)
+            self.remote_hashing = result is not None and result[0] == 0 and \
+                                  result[1].startswith(REMOTE_HASH_PROBE_DIGEST)
+            if self.remote_hashing:
+                self.verbose("The SSH server computes hash digests of remote "
+                             "files.")
+            else:
+                self.verbose("The SSH server does not compute hash digests, "
+                             "remote files are hashed locally!")
+        return self.remote_hashing
+
+
+    def execute_remote_command(self, command):
+        """Executes the command by the shell of the remote user in an exec 
+        channel of the SSH transport. Returns the exit status and the output 
+        of the command or None if the SSH server refuses to execute commands 
+        (e.g. for users restricted to SFTP)."""
+        self.debug("Executing remote command '%s'." % (command))
+        self.count_round_trips('exec')
+        try:
+            channel = self.transp.open_session()
+        except (paramiko.SSHException, EOFError, socket.error), e:
+            self.debug("Failed to open an exec channel (%s)" % (str(e)))
+            return None
+        
+        try:
+            try:
+                channel.settimeout(REMOTE_COMMAND_TIMEOUT)
+                channel.exec_command(command)
+                output = []
+                data = channel.recv(SMALL_FILE_SIZE)
+                while data:
+                    output.append(data)
+                    data = channel.recv(SMALL_FILE_SIZE)
+                status = channel.recv_exit_status()
+            except (paramiko.SSHException, EOFError, socket.error), e:
+                self.debug("Failed to execute remote command '%s' (%s)" % 
+                           (command, str(e)))
+                return None
+        finally:
+            channel.close()
+        return (status, ''.join(output))
+
+
+    def check_remote_file(self, remote_pathname, algorithm):
+        """Returns the hexdigest of the hash of the given algorithm of the 
+        content of the remote file computed by the 'check-file' extension of 
+        the SFTP server or None if the server does not support it. Whether it
+        does is determined by the first request."""
+        if self.check_file is False:
+            return None
+        
+        try:
+            self.count_round_trips('open')
+            remote_file = self.client().file(remote_pathname, 'r')
+        except IOError:
+            return None
+        
+        try:
+            try:
+                self.count_round_trips('check-file')
+                digest = remote_file.check(algorithm)
+            except socket.timeout:
+                raise
+            except IOError, e:
+                if self.check_file is None:
+                    self.verbose("The SFTP server does not support the "
+                                 "'check-file' extension (%s)." % 
+                                 (str(e)))
+                    self.check_file = False
+                return None
+        finally:
+            self.count_round_trips('close')
+            remote_file.close()
+        
+        self.check_file = True
+        if len(digest) != DIGESTS[algorithm]().digest_size:
+            return None
+        return digest.encode('hex')
+
+
+    def verify_remote_digests(self, remote_pathname, file_sha):
+        """Compares the digests computed by the SSH server for the remote file
+        (see remote_state_digest()) with the given hash object of its 
+        transfered content. An IOError is raised if one of them differs, 
+        because the states of the file were checked against another content.
+        """
+        digests = self.remote_digests.get(remote_pathname, {})
+        for ((remote_state_filename, algorithm), digest) in digests.items():
+            if not file_sha.covers([algorithm]):
+                continue
+            state_sha = file_sha.copy()
+            state_sha.update(remote_state_filename)
+            if state_sha.hexdigest(algorithm) != digest:
+                raise IOError("Content of remote file '%s' does not match the"
+                              " hash digest computed by the SSH server" % 
+                              (remote_pathname))
+
+
+    def match_content_store(self, remote_filename, remote_state_filename):
+        """Looks for the content of the remote file in the content store 
+        before the remote file is read to check the given (non empty) state 
+        file. Every stored content of the same size is hashed locally together
+        with the name of the state file and compared with the content of the 
+        state file. A match feeds the hash cache, so the remote file is 
+        neither transfered for checking its states nor for fetching it.
+        If the SSH server computes the digest of the content (see 
+        --remote-hash), the content is simply looked up in the store."""
+        remote_pathname = os.path.join(self.remote_dir, remote_filename)
+        attributes = self.remote_attributes.get(remote_filename)
+        if not self.content_store or not attributes or \
+           self.known_content_digest(remote_pathname):
+            return
+        
+        if self.remote_hash:
+            digest = self.remote_state_digest(remote_pathname, '', 'sha1')
+            if digest:
+                # Remembered even if the content is not stored, so the SSH 
+                # server computes it only once (see known_content_digest())
+                self.lock.acquire()
+                try:
+                    self.remote_digests.setdefault(remote_pathname, {})[('', 'sha1')] = digest
+                finally:
+                    self.lock.release()
+                index_key = self.hash_index_key(remote_pathname)
+                if index_key:
+                    self.hash_index.put(*(index_key + ('', digest)))
+                
+                if self.content_store.has(digest):
+                    self.debug("Found content of remote file '%s' in the "
+                               "content store ('%s')." % 
+                               (remote_pathname, digest))
+                    return
+        
+        (algorithm, expected_digest) = parse_state_digest(self.get_remote_file(os.path.join(self.remote_dir, 
+                                                                                            remote_state_filename)))
+        if not DIGESTS.has_key(algorithm):
+            return
+        
+        names = self.required_digests.get(remote_pathname, [])
+        for digest in self.content_store.find(attributes.st_size):
+            started = time.time()
+            try:
+                file_sha = self.content_store.hash(digest, names)
+            except (IOError, OSError):
+                continue
+            state_sha = file_sha.copy()
+            state_sha.update(remote_state_filename)
+            self.metrics.add_time('hash', time.time() - started)
+            
+            if state_sha.hexdigest(algorithm) == expected_digest:
+                self.verbose("Content of remote file '%s' found in the "
+                             "content store ('%s')." % 
+                             (remote_pathname, digest))
+                self.hash_cache.put(remote_pathname, file_sha, HASH_OBJECT_SIZE)
+                return
+
+
+    def delta_basis(self):
+        """Returns the pathname of the basis of delta transfers (the newest 
+        file by name in the directory given by --delta-basis) or None."""
+        try:
+            filenames = [filename for filename in os.listdir(self.delta_basis_dir) 
+                         if not filename.startswith('.') and 
+                         os.path.isfile(os.path.join(self.delta_basis_dir, 
+                                                     filename))]
+        except OSError, e:
+            self.log("Failed to list delta basis directory '%s' (%s)!" % 
+                     (self.delta_basis_dir, str(e)))
+            return None
+        if not filenames:
+            return None
+        return os.path.join(self.delta_basis_dir, max(filenames))
 
+
+    def delta_fetch(self, remote_filename, remote_state_filename):
+        """Reconstructs the remote file from the delta basis (see 
+        --delta-basis) before the remote file is read to check the given (non 
+        empty) state file. Only the parts not found in the basis are 
+        transfered (see reconstruct_remote_file()). The reconstructed file is 
+        verified against the hash digest in the state file. If it matches, it 
+        is used for checking the states and fetching the file, otherwise it is
+        discarded and the remote file is transfered completely."""
+        remote_pathname = os.path.join(self.remote_dir, remote_filename)
+        attributes = self.remote_attributes.get(remote_filename)
+        if not self.delta_basis_dir or self.dry_run or self.no_fetch or \
+           not attributes or attributes.st_size is None or \
+           self.spool_files.has_key(remote_pathname) or \
+           self.known_content_digest(remote_pathname):
+            return
+        
+        # An interrupted transfer is rather resumed
+        spool_pathname = self.spool_pathname(remote_filename)
+        if os.path.exists(self.checkpoint_pathname(spool_pathname)):
+            return
+        
+        basis_pathname = self.delta_basis()
+        if not basis_pathname:
+            return
+        
+        delta_pathname = spool_pathname + '.delta'
+        try:
+            file_sha = self.reconstruct_remote_file(remote_pathname, 
+                                                    attributes.st_size, 
+                                                    basis_pathname, 
+                                                    delta_pathname)
+        except (IOError, OSError, struct.error), e:
+            self.log("Failed to reconstruct remote file '%s' from '%s' (%s)!" % 
+                     (remote_pathname, basis_pathname, str(e)))
+            file_sha = None
+        
+        if file_sha:
+            (algorithm, expected_digest) = parse_state_digest(self.get_remote_file(os.path.join(self.remote_dir, 
+                                                                                                remote_state_filename)))
+            state_sha = file_sha.copy()
+            state_sha.update(remote_state_filename)
+            if not file_sha.covers([algorithm]) or \
+               state_sha.hexdigest(algorithm) != expected_digest:
+                self.log("Reconstructed remote file '%s' does not match its "
+                         "state file. Transfering it completely!" % 
+                         (remote_pathname))
+                file_sha = None
+        
+        if not file_sha:
+            if os.path.exists(delta_pathname):
+                os.unlink(delta_pathname)
+            return
+        
+        os.rename(delta_pathname, spool_pathname)
+        self.hash_cache.put(remote_pathname, file_sha, HASH_OBJECT_SIZE)
+        self.spool_files[remote_pathname] = spool_pathname
+
+
+    def reconstruct_remote_file(self, remote_pathname, size, basis_pathname, 
+                                local_pathname):
+        """Writes the content of the remote zip archive of the given size to 
+        the local file, copying the compressed data of all members which are 
+        unchanged since the given basis archive from the basis and reading 
+        everything else from the remote archive. Returns a hash object of the
+        written content or None if the archives can not be compared or have 
+        no member in common."""
+        basis_file = open(basis_pathname, 'rb')
+        try:
+            def read_basis(offset, length):
+                basis_file.seek(offset)
+                return basis_file.read(length)
             
+            basis_members = read_zip_directory(read_basis, 
+                                               os.path.getsize(basis_pathname))
+            if not basis_members:
+                self.debug("Delta basis '%s' is no zip archive." % 
+                           (basis_pathname))
+                return None
+            
+            self.count_round_trips('open')
+            remote_file = self.client().file(remote_pathname, 'r')
+            try:
+                def read_remote(offset, length):
+                    self.count_round_trips('read')
+                    remote_file.seek(offset)
+                    return remote_file.read(length)
+                
+                remote_members = read_zip_directory(read_remote, size)
+                if not remote_members:
+                    self.debug("Remote file '%s' is no zip archive." % 
+                               (remote_pathname))
+                    return None
+                
+                # The members unchanged since the basis: (remote header offset,
+                # basis data offset, compressed size)
+                unchanged = []
+                for (name, member) in remote_members.items():
+                    basis_member = basis_members.get(name)
+                    if basis_member and basis_member[:4] == member[:4] and \
+                       0 < member[2] < 0xFFFFFFFF:
+                        basis_offset = zip_data_offset(basis_member[4], 
+                                                       read_basis(basis_member[4], 
+                                                                  ZIP_HEADER_SIZE))
+                        if basis_offset is not None:
+                            unchanged.append((member[4], basis_offset, member[2]))
+                
+                if not unchanged:
+                    self.debug("Remote file '%s' has no member in common with "
+                               "'%s'." % 
+                               (remote_pathname, basis_pathname))
+                    return None
+                
+                # The local headers of the unchanged members tell where their
+                # data starts in the remote archive
+                unchanged.sort()
+                self.count_round_trips('read')
+                headers = remote_file.readv([(header_offset, ZIP_HEADER_SIZE) 
+                                             for (header_offset, basis_offset, 
+                                                  length) in unchanged])
+                copies = []
+                end = 0
+                for ((header_offset, basis_offset, length), header) in \
+                    zip(unchanged, headers):
+                    offset = zip_data_offset(header_offset, header)
+                    if offset is not None and offset >= end and \
+                       offset + length <= size:
+                        copies.append((offset, basis_offset, length))
+                        end = offset + length
+                
+                file_sha = self.write_delta(remote_file, size, basis_file, 
+                                            copies, local_pathname, 
+                                            self.required_digests.get(remote_pathname, 
+                                                                      []))
+                
+                reused = sum([length for (offset, basis_offset, length) in 
+                              copies])
+                self.metrics.count('bytes_reused', reused)
+                self.verbose("Reconstructed remote file '%s' reading %i bytes "
+                             "and reusing %i bytes of '%s'." % 
+                             (remote_pathname, size - reused, reused, 
+                              basis_pathname))
+                return file_sha
+            finally:
+                self.count_round_trips('close')
+                remote_file.close()
+        finally:
+            basis_file.close()
+
+
+    def write_delta(self, remote_file, size, basis_file, copies, 
+                    local_pathname, names):
+        """Writes the content of the opened remote file of the given size to 
+        the local file. The given ranges (offset, basis offset, length) are 
+        copied from the opened basis file, the gaps between them are read from
+        the remote file. Returns a hash object of the written content 
+        computing the given hash algorithms (see MultiHash)."""
+        file_sha = MultiHash(names)
+        local_file = open(local_pathname, 'wb')
+        start_time = time.time()
+        hash_time = 0.0
+        transfered = 0
+        try:
+            offset = 0
+            for (copy_offset, basis_offset, length) in copies + [(size, 0, 0)]:
+                blocks = []
+                if offset < copy_offset:
+                    blocks = self.read_remote_file(remote_file, copy_offset, 
+                                                   offset)
+                    transfered = transfered + copy_offset - offset
+                for block in blocks:
+                    hash_started = time.time()
+                    file_sha.update(block)
+                    hash_time = hash_time + time.time() - hash_started
+                    local_file.write(block)
+                
+                basis_file.seek(basis_offset)
+                remaining = length
+                while remaining > 0:
+                    block = basis_file.read(min(remaining, LOCAL_BLOCK_SIZE))
+                    if not block:
+                        raise IOError("Delta basis ended unexpectedly")
+                    hash_started = time.time()
+                    file_sha.update(block)
+                    hash_time = hash_time + time.time() - hash_started
+                    local_file.write(block)
+                    remaining = remaining - len(block)
+                offset = copy_offset + length
+            
+            local_file.flush()
+            os.fsync(local_file.fileno())
+        finally:
+            local_file.close()
+            self.add_stream_metrics(start_time, hash_time, transfered)
+        return file_sha
+
+
+    def deployed_digest(self):
+        """Returns the digest of the content of the currently deployed archive
+        (the newest file by name in the directory of the deployed archives, 
+        see --skip-deployed) or None if there is none. The digest is only 
+        computed again if the deployed archive changed."""
+        try:
+            filenames = [filename for filename in os.listdir(self.deployed_dir) 
+                         if not filename.startswith('.')]
+            if not filenames:
+                return None
+            
+            pathname = os.path.join(self.deployed_dir, max(filenames))
+            stat = os.stat(pathname)
+            key = (pathname, stat.st_ino, stat.st_size, stat.st_mtime)
+            if self.deployed and self.deployed[0] == key:
+                return self.deployed[1]
+            
+            digest = None
+            if self.content_store:
+                digest = self.content_store.digest_of(pathname)
+            if digest is None:
+                started = time.time()
+                digest = hash_local_file(pathname).hexdigest()
+                self.metrics.add_time('hash', time.time() - started)
+        except (IOError, OSError), e:
+            self.log("Failed to determine the deployed archive in '%s' (%s)!" % 
+                     (self.deployed_dir, str(e)))
+            return None
+        
+        self.debug("Deployed archive '%s' has the digest '%s'." % 
+                   (pathname, digest))
+        self.deployed = (key, digest)
+        return digest
+
+
+    def remote_location(self):
+        """Returns a string identifying the remote server and user."""
+        return "%s@%s:%i" % (self.remote_user, 
+                             self.remote_server, 
+                             self.remote_port)
+
+
+    def open_hash_index(self):
+        """Opens the local hash index if wanted. A hash index which can not be
+        opened is simply not used."""
+        if not self.hash_index_file or self.hash_index:
+            return
+        
+        if not sqlite3:
+            self.verbose("No hash index available (sqlite3 module missing)!")
+            return
+        
+        try:
+            self.hash_index = HashIndex(self.hash_index_file)
+        except sqlite3.Error, e:
+            self.log("Failed to open hash index '%s' (%s). Not using it!" % 
+                     (self.hash_index_file, str(e)))
+            self.hash_index = None
+        else:
+            self.debug("Using hash index '%s'." % (self.hash_index_file))
+
+
+    def prune_hash_index(self, remote_filename_list):
+        """Drops the digests of remote files which do not exist anymore from 
+        the local hash index."""
+        if not self.hash_index:
+            return
+        
+        try:
+            self.hash_index.prune(self.remote_location(), 
+                                  self.remote_dir, 
+                                  [os.path.join(self.remote_dir, filename) 
+                                   for filename in remote_filename_list])
+        except sqlite3.Error, e:
+            self.log("Failed to prune hash index '%s' (%s)!" % 
+                     (self.hash_index_file, str(e)))
+
+
+    def stream_remote_file(self, remote_filename, local_pathname=None):
+        """Reads the remote file in blocks and feeds a new SHA-1 hash object 
+        with them. If a local pathname is given, the very same blocks are 
+        written to that local file, so hashing and fetching the file is done 
+        in one pass. The memory used is bounded by the pipeline depth times 
+        the request size (see read_remote_file()).
+        The hash algorithms needed for the states of the remote file are used
+        (see hash_remote_file())."""
+        file_sha = MultiHash(self.required_digests.get(remote_filename, []))
+        
+        try:
+            self.count_round_trips('open')
+            remote_file = self.client().file(remote_filename, 'r')
+        except IOError:
+            self.debug("Failed to open file '%s' (maybe a directory)" % 
+                       (remote_filename))
+            return file_sha
+        
+        local_file = None
+        offset = 0
+        start_time = time.time()
+        start_offset = 0
+        hash_time = 0.0
+        try:
+            # The size is taken from the opened file, not from the listing: a
+            # file still growing (e.g. being uploaded) must not be read 
+            # truncated
+            self.count_round_trips('stat')
+            attributes = remote_file.stat()
+            size = attributes.st_size
+            self.update_listed_attributes(remote_filename, attributes)
+            
+            if local_pathname:
+                # Continue a previously interrupted transfer if possible
+                resume_started = time.time()
+                (file_sha, offset) = self.resume_local_file(local_pathname, 
+                                                            attributes, 
+                                                            file_sha)
+                hash_time = hash_time + time.time() - resume_started
+                self.debug("Streaming remote file '%s' to '%s' (starting at "
+                           "offset %i)." % 
+                           (remote_filename, local_pathname, offset))
+                if offset > 0:
+                    local_file = open(local_pathname, 'r+b')
+                    local_file.seek(offset)
+                    local_file.truncate()
+                else:
+                    local_file = open(local_pathname, 'wb')
+            
+            start_time = time.time()
+            start_offset = offset
+            checkpoint_offset = offset
+            for block in self.read_remote_file(remote_file, size, offset):
+                hash_started = time.time()
+                file_sha.update(block)
+                hash_time = hash_time + time.time() - hash_started
+                offset = offset + len(block)
+                if local_file:
+                    local_file.write(block)
+                    
+                    # Remember the progress regularly, so even a killed 
+                    # process leaves a resumable file behind
+                    if offset - checkpoint_offset >= CHECKPOINT_INTERVAL:
+                        local_file.flush()
+                        self.write_checkpoint(local_pathname, attributes, 
+                                              offset, file_sha.hexdigest())
+                        checkpoint_offset = offset
+        except:
+            self.add_stream_metrics(start_time, hash_time, offset - start_offset)
+            
+            # Keep the incomplete local file to resume the transfer later
+            if local_file:
+                local_file.close()
+                try:
+                    self.write_checkpoint(local_pathname, attributes, offset, 
+                                          file_sha.hexdigest())
+                    self.log("Transfer of remote file '%s' interrupted after "
+                             "%i bytes. Keeping '%s' to resume it." % 
+                             (remote_filename, offset, local_pathname))
+                except (IOError, OSError):
+                    self.log("Failed to write checkpoint for '%s'!" % 
+                             (local_pathname))
+            self.count_round_trips('close')
+            remote_file.close()
+            raise
+        
+        if local_file:
+            # Make sure the content is on disk before the file gets renamed 
+            # into place
+            local_file.flush()
+            os.fsync(local_file.fileno())
+            local_file.close()
+            self.remove_checkpoint(local_pathname)
+        self.count_round_trips('close')
+        remote_file.close()
+        
+        self.add_stream_metrics(start_time, hash_time, size - start_offset)
+        
+        duration = time.time() - start_time
+        if duration > 0:
+            rate = (size - start_offset) / duration / 1048576
+        else:
+            rate = 0.0
+        self.verbose("Read %i bytes of remote file '%s' in %.2f s "
+                     "(%.2f MB/s)." % 
+                     (size - start_offset, remote_filename, duration, rate))
+        return file_sha
+
+
+    def add_stream_metrics(self, start_time, hash_time, transfered):
+        """Adds the time spent hashing and reading a remote file streamed since
+        the given start time and the bytes transfered to the metrics."""
+        self.metrics.add_time('hash', hash_time)
+        self.metrics.add_time('download', time.time() - start_time - hash_time)
+        self.metrics.count('bytes_transfered', transfered)
+
+
+    def update_listed_attributes(self, remote_pathname, attributes):
+        """Replaces the listed size and modification time of the remote file
+        by the given attributes of the opened file if they differ, so the 
+        digests of its content are indexed (see hash_index_key()) and the 
+        listing snapshot is written for the content actually read."""
+        listed = self.listed_attributes(remote_pathname)
+        if listed is None or (listed.st_size == attributes.st_size and 
+                              listed.st_mtime == attributes.st_mtime):
+            return
+        self.verbose("Remote file '%s' changed since it was listed (%s bytes "
+                     "instead of %s)." % 
+                     (remote_pathname, attributes.st_size, listed.st_size))
+        self.lock.acquire()
+        try:
+            listed.st_size = attributes.st_size
+            listed.st_mtime = attributes.st_mtime
+        finally:
+            self.lock.release()
+
+
+    def listed_attributes(self, remote_pathname):
+        """Returns the attributes of the given remote file from the listing of
+        the remote directory or None if the file was not listed."""
+        if os.path.dirname(remote_pathname) != self.remote_dir:
+            return None
+        return self.remote_attributes.get(os.path.basename(remote_pathname))
+
+
+    def checkpoint_pathname(self, local_pathname):
+        """Returns the pathname of the file recording the progress of the 
+        transfer into the given (partial) local file."""
+        return local_pathname + '.info'
+
+
+    def write_checkpoint(self, local_pathname, attributes, offset, digest):
+        """Records the size and modification time of the remote file, the 
+        number of bytes already written to the partial local file and the 
+        SHA-1 hexdigest of these bytes."""
+        checkpoint_file = open(self.checkpoint_pathname(local_pathname), 'w')
+        checkpoint_file.write("size %i\nmtime %i\noffset %i\nsha1 %s\n" % 
+                              (attributes.st_size, 
+                               attributes.st_mtime, 
+                               offset, 
+                               digest))
+        checkpoint_file.close()
+
+
+    def remove_checkpoint(self, local_pathname):
+        """Removes the checkpoint of a (completely written) local file."""
+        if os.path.exists(self.checkpoint_pathname(local_pathname)):
+            os.unlink(self.checkpoint_pathname(local_pathname))
+
+
+    def resume_local_file(self, local_pathname, attributes, file_sha):
+        """Determines where an interrupted transfer into the local file can be 
+        continued. This is only possible if the checkpoint of the transfer 
+        refers to the same size and modification time of the remote file and 
+        the bytes already written still match the recorded hash digest. The 
+        given hash object is updated with these bytes, so the final hash 
+        covers the whole file. Returns the hash object and the offset to 
+        continue at (zero if the transfer has to start from scratch)."""
+        checkpoint = {}
+        try:
+            checkpoint_file = open(self.checkpoint_pathname(local_pathname))
+            for line in checkpoint_file.readlines():
+                (key, value) = line.split()
+                checkpoint[key] = value
+            checkpoint_file.close()
+            
+            if int(checkpoint['size']) != attributes.st_size or \
+               int(checkpoint['mtime']) != attributes.st_mtime:
+                self.verbose("Remote file changed since the transfer into '%s'"
+                             " was interrupted. Starting from scratch." % 
+                             (local_pathname))
+                return (file_sha, 0)
+            
+            offset = int(checkpoint['offset'])
+            local_file = open(local_pathname, 'rb')
+        except (IOError, OSError, KeyError, ValueError):
+            return (file_sha, 0)
+        
+        # Hash the bytes already written
+        remaining = offset
+        while remaining > 0:
+            block = local_file.read(min(remaining, LOCAL_BLOCK_SIZE))
+            if not block:
+                break
+            file_sha.update(block)
+            remaining = remaining - len(block)
+        local_file.close()
+        
+        if remaining > 0 or file_sha.hexdigest() != checkpoint.get('sha1'):
+            self.verbose("Partial local file '%s' does not match its "
+                         "checkpoint. Starting from scratch." % 
+                         (local_pathname))
+            return (MultiHash(file_sha.names), 0)
+        
+        self.verbose("Resuming the transfer into '%s' at offset %i." % 
+                     (local_pathname, offset))
+        return (file_sha, offset)
+
+
+    def read_remote_file(self, remote_file, size, offset=0):
+        """A generator yielding the content of the opened remote file of the 
+        given size in blocks of the request size, starting at the given 
+        offset. The read requests are 
+        pipelined: they are sent in batches of half the pipeline depth and the
+        requests of the next batch are sent before the blocks of the current 
+        batch are consumed. So there are always requests in flight and the 
+        link does not idle for a round trip after every batch."""
+        batch_size = max(1, self.pipeline_depth / 2)
+        pending_batch = None
+        while offset < size:
+            requests = []
+            while offset < size and len(requests) < batch_size:
+                requests.append((offset, min(self.request_size, size - offset)))
+                offset = offset + self.request_size
+            
+            self.count_round_trips('read')
+            blocks = remote_file.readv(requests)
+            if self.pipeline_depth > 1:
+                # Sends the requests of this batch (and waits for its first 
+                # block) while the blocks of the pending batch are buffered
+                batch = ([blocks.next()], blocks)
+            else:
+                batch = ([], blocks)
+            
+            if pending_batch:
+                for block in pending_batch[0]:
+                    yield block
+                for block in pending_batch[1]:
+                    yield block
+            pending_batch = batch
+        
+        if pending_batch:
+            for block in pending_batch[0]:
+                yield block
+            for block in pending_batch[1]:
+                yield block
+
+
+    def fetch_remote_file(self, remote_filename, local_pathname):
+        """Places the content of the remote file at the given local pathname. 
+        If the file was already spooled while hashing it, the spool file is 
+        simply renamed. If its content is known to be in the content store 
+        (see --content-store), the stored content is linked. Otherwise the 
+        file is streamed into its (possibly partially transfered) spool file, 
+        which is renamed afterwards. Its hash is cached on the way and 
+        verified against the digests computed by the SSH server (see 
+        verify_remote_digests()).
+        The spool file is located in the local directory and synced to disk 
+        before it is renamed, so the file appears atomically and completely.
+        Other scripts watching the local directory (e.g. 
+        import_hafas_data.sh) never see a partially written file.
+        Returns False if the file was not placed because its content equals 
+        the deployed archive (see --skip-deployed), otherwise True."""
+        if self.content_store and not self.spool_files.has_key(remote_filename):
+            digest = self.known_content_digest(remote_filename)
+            if digest and self.content_store.has(digest):
+                spool_pathname = self.spool_pathname(os.path.basename(remote_filename))
+                try:
+                    self.content_store.link(digest, spool_pathname)
+                except OSError, e:
+                    self.log("Failed to link content '%s' from the content "
+                             "store (%s)!" % 
+                             (digest, str(e)))
+                else:
+                    self.verbose("Linked the content of remote file '%s' from "
+                                 "the content store ('%s')." % 
+                                 (remote_filename, digest))
+                    self.metrics.count('bytes_deduplicated', 
+                                       os.path.getsize(spool_pathname))
+                    self.spool_files[remote_filename] = spool_pathname
+        
+        if not self.spool_files.has_key(remote_filename):
+            spool_pathname = self.spool_pathname(os.path.basename(remote_filename))
+            file_sha = self.stream_remote_file(remote_filename, spool_pathname)
+            self.spool_files[remote_filename] = spool_pathname
+            try:
+                self.verify_remote_digests(remote_filename, file_sha)
+            except IOError:
+                self.discard_spool_file(remote_filename)
+                raise
+            if not self.hash_cache.has_key(remote_filename):
+                self.hash_cache.put(remote_filename, file_sha, HASH_OBJECT_SIZE)
+        
+        digest = None
+        if self.content_store or self.deployed_dir:
+            digest = self.content_digest(remote_filename)
+        
+        if self.deployed_dir and digest and digest == self.deployed_digest():
+            self.log("Not placing the file '%s' into the local directory, "
+                     "because its content is deployed already!" % 
+                     (remote_filename))
+            self.discard_spool_file(remote_filename)
+            return False
+        
+        self.debug("Using spooled content of remote file '%s'." % 
+                   (remote_filename))
+        os.rename(self.spool_files[remote_filename], local_pathname)
+        del self.spool_files[remote_filename]
+        self.sync_directory(os.path.dirname(local_pathname))
+        
+        if self.content_store and digest:
+            try:
+                self.content_store.add(local_pathname, digest)
+            except OSError, e:
+                self.log("Failed to add '%s' to the content store (%s)!" % 
+                         (local_pathname, str(e)))
+        return True
+
+
+    def content_digest(self, remote_filename):
+        """Returns the digest of the plain content of the remote file whose 
+        content is spooled. The spool file is hashed locally if the digest is 
+        not known anymore. The digest is remembered in the local hash index, so
+        the content is known without transfering it as long as the remote file
+        does not change."""
+        index_key = self.hash_index_key(remote_filename)
+        if index_key:
+            digest = self.hash_index.get(*(index_key + ('',)))
+            if digest:
+                return digest
+        
+        file_sha = self.hash_cache.get(remote_filename)
+        if file_sha is not None:
+            digest = file_sha.hexdigest()
+        else:
+            started = time.time()
+            try:
+                digest = hash_local_file(self.spool_files[remote_filename]).hexdigest()
+            except (IOError, OSError), e:
+                self.log("Failed to hash the spooled content of '%s' (%s)!" % 
+                         (remote_filename, str(e)))
+                return None
+            self.metrics.add_time('hash', time.time() - started)
+        
+        if index_key:
+            self.hash_index.put(*(index_key + ('', digest)))
+        return digest
+
+
+    def sync_directory(self, local_dir):
+        """Flushes the directory entries of the local directory to disk, so a 
+        renamed file survives a crash. Platforms not supporting this are 
+        silently ignored."""
+        try:
+            dir_fd = os.open(local_dir, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            try:
+                os.fsync(dir_fd)
+            except OSError:
+                pass
+        finally:
+            os.close(dir_fd)
+
+
+    def spool_pathname(self, remote_filename):
+        """Returns the local pathname used to spool the content of the remote 
+        file while hashing or fetching it. The file is hidden in the local 
+        directory. If a transfer gets interrupted, this partial file is kept 
+        and the transfer is resumed by the next run (see 
+        resume_local_file())."""
+        return os.path.join(self.local_dir, '.%s.part' % (remote_filename))
+
+
+    def discard_spool_file(self, remote_filename):
+        """Deletes the spool file of the remote file if it was completely 
+        transfered but not used for fetching the file. Partial files of 
+        interrupted transfers are not registered as spool files and therefore 
+        kept."""
+        spool_pathname = self.spool_files.pop(remote_filename, None)
+        if spool_pathname:
+            self.debug("Discarding spool file '%s'." % (spool_pathname))
+            try:
+                os.unlink(spool_pathname)
+            except OSError:
+                self.log("Failed to delete spool file '%s'!" % 
+                         (spool_pathname))
+
+
+    def discard_spool_files(self):
+        """Deletes all spool files which were not used for fetching files."""
+        for remote_filename in self.spool_files.keys():
+            self.discard_spool_file(remote_filename)
+
+
     def get_remote_file(self, remote_filename):
         """Returns the content of the remote file based on a local cache.
         Internally this method returns the cached content of the remote file.
-        """
+        The content is read directly from the remote file into memory, so this
+        is only meant for small files like state files. Remote files to be 
+        fetched are streamed (see stream_remote_file())."""
         self.debug("Fetching content of remote filename '%s'." % 
                    (remote_filename))
         
-        if not self.file_cache.has_key(remote_filename):
+        content = self.file_cache.get(remote_filename)
+        if content is None and self.payload_cache.budget > 0:
+            content = self.payload_cache.get(remote_filename)
+        
+        if content is None:
             self.debug("Feeding file cache with '%s'." % (remote_filename))
             
-            # Creating a secure temporyry file            
-            (temp_file_fd, temp_filename) = tempfile.mkstemp()
-            
-            # Fetch the file using SFTP GET
+            started = time.time()
             try:
-                self.sftp.get(remote_filename, temp_filename)
+                content = self.backend.read_file(self.client(), remote_filename)
             except IOError:
                 self.debug("Failed to fetch file '%s' (maybe a directory)" % 
                            (remote_filename))
-                self.file_cache[remote_filename] = ''
+                content = ''
+            self.metrics.add_time('state_read', time.time() - started)
+            
+            if len(content) <= SMALL_FILE_SIZE:
+                self.file_cache.put(remote_filename, content, len(content))
             else:
-                # Feed the cache with the content of the temporary file
-                temp_file = os.fdopen(temp_file_fd)
-                self.file_cache[remote_filename] = temp_file.read()
-                temp_file.close()
-            os.unlink(temp_filename)
+                self.payload_cache.put(remote_filename, content, len(content))
         else:
             self.debug("File cache hit for file '%s'" % (remote_filename))
         
         self.debug("Returning content of file '%s' (%i bytes)." % 
                    (remote_filename, 
-                    len(self.file_cache[remote_filename])))
+                    len(content)))
         
-        return self.file_cache[remote_filename]
+        return content
 
 
     def connect(self):
@@ -960,21 +4560,303 @@ class SFTPFetcher:
                       self.remote_port))
         
         # Open the TCP connection
-        sftp.open_connection()
+        started = time.time()
+        self.open_connection()
+        self.metrics.add_time('connect', time.time() - started)
         
         # Create the SSH transport
-        sftp.create_transport()
+        started = time.time()
+        self.create_transport()
+        self.metrics.add_time('handshake', time.time() - started)
         
         # Authenticate the SSH transport using PSA public keys
-        sftp.authenticate_transport()
+        started = time.time()
+        self.authenticate_transport()
+        self.metrics.add_time('auth', time.time() - started)
+        
+        # Keep long living connections alive
+        if self.keepalive:
+            self.transp.set_keepalive(self.keepalive)
+
+
+    def is_connected(self):
+        """Returns if the SSH connection is (still) usable."""
+        return self.sftp is not None and self.transp is not None and \
+               self.transp.is_active()
 
             
     def disconnect(self):
-        """Closes all network connections in the correct order."""
+        """Closes all network connections in the correct order. The shared SSH
+        connection and hash index of a leader (see share_connection()) are 
+        left open for it."""
+        self.backend.close()
+        
+        if self.leader:
+            if self.hash_index and self.hash_index is not self.leader.hash_index:
+                self.hash_index.close()
+            self.hash_index = None
+            
+            self.sftp.close()
+            if self.transp is not self.leader.transp:
+                self.transp.close()
+            
+            self.transp = None
+            self.sftp = None
+            self.sock = None
+            return
+        
+        if self.hash_index:
+            self.hash_index.close()
+            self.hash_index = None
+        
         self.transp.close()
         self.sftp.close()
         self.sock.close()
         
+        self.transp = None
+        self.sftp = None
+        self.sock = None
+
+
+    def run_daemon(self):
+        """Keeps the SSH connection open and polls the remote directory every 
+        interval (see --daemon). Files are only checked and fetched if the 
+        listing of the remote directory changed since the last poll. While 
+        nothing changes the interval is doubled up to the maximum interval. A
+        lost connection is reopened with the same back off. This method only 
+        returns if interrupted."""
+        interval = self.interval
+        previous_fingerprint = None
+        ignored_filenames = {}
+        
+        while True:
+            if not self.is_connected():
+                try:
+                    self.connect()
+                except (SystemExit, Exception), e:
+                    # Opening the connection exits on errors, which must not 
+                    # end the daemon
+                    self.log("Failed to connect to '%s' (%s). Retrying in "
+                             "%i seconds." % 
+                             (self.remote_server, str(e), interval))
+                    self.close_connection()
+                    time.sleep(interval)
+                    interval = min(interval * 2, self.max_interval)
+                    continue
+            
+            try:
+                remote_listing = self.list_remote_dir()
+                fingerprint = self.listing_fingerprint(remote_listing, 
+                                                       ignored_filenames)
+                
+                if fingerprint != previous_fingerprint:
+                    self.verbose("Listing of remote directory '%s' changed." % 
+                                 (self.remote_dir))
+                    
+                    # The remote files may have changed, so start with empty 
+                    # caches like a new run (the hash index is kept)
+                    self.hash_cache.clear()
+                    self.file_cache.clear()
+                    self.payload_cache.clear()
+                    
+                    self.metrics.started = time.time()
+                    
+                    self.fetch_files_by_state(remote_listing)
+                    
+                    # Remember the processed listing, so a file uploaded 
+                    # during the run is a change for the next poll. The state
+                    # files written and the files deleted by the run itself 
+                    # are none.
+                    ignored_filenames = {}
+                    for remote_pathname in self.written_state_files.keys() + \
+                                           self.removed_files.keys():
+                        ignored_filenames[os.path.basename(remote_pathname)] = True
+                    previous_fingerprint = self.listing_fingerprint(remote_listing, 
+                                                                    ignored_filenames)
+                    interval = self.interval
+                else:
+                    self.debug("Listing of remote directory '%s' unchanged." % 
+                               (self.remote_dir))
+                    interval = min(interval * 2, self.max_interval)
+                    
+                    # An idle poll is not counted for the next run
+                    self.metrics.reset()
+                    self.round_trips = {}
+            except Exception, e:
+                self.log("Polling remote directory '%s' failed (%s). "
+                         "Reconnecting." % 
+                         (self.remote_dir, str(e)))
+                traceback.print_exc()
+                self.close_connection()
+            
+            self.debug("Next poll in %i seconds." % (interval))
+            time.sleep(interval)
+
+
+    def close_connection(self):
+        """Closes the (maybe broken or partly opened) SSH connection ignoring 
+        all errors."""
+        self.backend.close()
+        
+        for connection in (self.sftp, self.transp, self.sock):
+            if connection is not None:
+                try:
+                    connection.close()
+                except:
+                    pass
+        
+        self.transp = None
+        self.sftp = None
+        self.sock = None
+        
+        
+    def share_connection(self, leader):
+        """Uses the SSH connection, the caches and the hash index of the given 
+        (connected) fetcher for the same remote server, port and user. This 
+        fetcher gets its own SFTP channel (or SSH transport, see 
+        open_worker_client())."""
+        self.leader = leader
+        
+        (self.sftp, transport) = leader.open_worker_client()
+        self.transp = transport or leader.transp
+        self.rsa_key = leader.rsa_key
+        
+        self.hash_cache = leader.hash_cache
+        self.file_cache = leader.file_cache
+        self.payload_cache = leader.payload_cache
+        
+        if self.hash_index_file == leader.hash_index_file:
+            self.hash_index = leader.hash_index
+
+
+    def read_jobs(self):
+        """Reads the configuration file and returns a list of the names of its
+        jobs and their fetchers (see --config)."""
+        config = ConfigParser.RawConfigParser()
+        try:
+            if not config.read([self.config_file]):
+                self.usage(1, "Unable to read configuration file '%s'!" % 
+                              (self.config_file))
+        except ConfigParser.Error, e:
+            self.usage(1, "Invalid configuration file '%s' (%s)!" % 
+                          (self.config_file, str(e)))
+        
+        if not config.sections():
+            self.usage(1, "No jobs found in configuration file '%s'!" % 
+                          (self.config_file))
+        
+        jobs = []
+        for name in config.sections():
+            arguments = list(self.job_arguments)
+            for (key, value) in config.items(name):
+                option = '--' + key
+                if key in ('config', 'daemon', 'help', 'list-files'):
+                    self.usage(1, "Option '%s' not allowed for job '%s'!" % 
+                                  (key, name))
+                elif self.takes_argument(option):
+                    if key in LIST_OPTIONS:
+                        for argument in value.split():
+                            arguments.extend([option, argument])
+                    else:
+                        arguments.extend([option, value])
+                elif key in LONG_OPTIONS:
+                    if value.lower() in ('1', 'yes', 'true', 'on'):
+                        arguments.append(option)
+                    elif value.lower() not in ('0', 'no', 'false', 'off'):
+                        self.usage(1, "Invalid value '%s' of switch '%s' for "
+                                      "job '%s'!" % (value, key, name))
+                else:
+                    self.usage(1, "Unknown option '%s' for job '%s'!" % 
+                                  (key, name))
+            
+            self.debug("Arguments of job '%s': %s" % (name, arguments))
+            jobs.append((name, SFTPFetcher(arguments)))
+        
+        return jobs
+
+
+    def run_batch(self):
+        """Runs all jobs of the configuration file. One SSH connection is 
+        opened per remote server, port and user and shared by all of its jobs. 
+        The jobs are grouped by their remote directory; the groups run 
+        concurrently, the jobs of a group one after another (see 
+        run_job_group())."""
+        jobs = self.read_jobs()
+        
+        leaders = {}
+        groups = {}
+        group_keys = []
+        results = {}
+        try:
+            for (name, job) in jobs:
+                location = job.remote_location()
+                if leaders.has_key(location):
+                    job.verbose("Job '%s' shares the connection to %s." % 
+                                (name, location))
+                    job.share_connection(leaders[location])
+                else:
+                    job.connect()
+                    job.open_hash_index()
+                    leaders[location] = job
+                
+                key = (location, job.remote_dir)
+                if not groups.has_key(key):
+                    groups[key] = []
+                    group_keys.append(key)
+                groups[key].append((name, job))
+            
+            threads = []
+            for key in group_keys:
+                thread = threading.Thread(target=self.run_job_group, 
+                                          args=(groups[key], results))
+                thread.setDaemon(True)
+                thread.start()
+                threads.append(thread)
+            
+            for thread in threads:
+                thread.join()
+        finally:
+            # Close the shared connections after the jobs using them
+            for (name, job) in jobs:
+                if job.sftp and job.leader:
+                    job.disconnect()
+            for job in leaders.values():
+                for cache in (job.hash_cache, job.file_cache, job.payload_cache):
+                    self.debug(cache.statistics())
+                if job.sftp:
+                    job.disconnect()
+        
+        # Succeed if any job succeeded (see fetch_files_by_state())
+        for (name, job) in jobs:
+            if not results.get(name, 1):
+                return 0
+        return max([results.get(name, 1) for (name, job) in jobs])
+
+
+    def run_job_group(self, group, results):
+        """Runs the given jobs for the same remote directory one after another
+        and stores their results by name. The listing of the remote directory 
+        is reused until a job changes the directory."""
+        remote_listing = None
+        for (name, job) in group:
+            self.verbose("Running job '%s'." % (name))
+            try:
+                if remote_listing is None:
+                    remote_listing = job.list_remote_dir()
+                
+                result = job.fetch_files_by_state(remote_listing)
+                
+                # Nothing was fetched and no state files were created
+                if result not in (1, 2):
+                    remote_listing = None
+            except (SystemExit, Exception), e:
+                job.log("Job '%s' failed (%s)!" % (name, str(e)))
+                traceback.print_exc()
+                result = 1
+                remote_listing = None
+            
+            results[name] = result
+        
         
     def run(self):
         """Performes all actions this fetcher should do. Opening and closing 
@@ -982,11 +4864,23 @@ class SFTPFetcher:
         states."""
         result = 0
         
+        if self.config_file:
+            return self.run_batch()
+        
+        if self.daemon:
+            return self.run_daemon()
+        
         # Open the SSH connection
         self.connect()
         
         if self.list_files:
             result = self.list_files_with_state(self.previous_states)
+            
+            # A pure listing (e.g. a health check) needs nothing else
+            if not self.next_states and not self.delete_remote_file and \
+               not self.delete_remote_previous_statefiles:
+                self.disconnect()
+                return result
         
         # The value of result may contains non-zero if the previously printed 
         # list of files is emtpy. Then we don't need to lock for to be fetched
@@ -1003,19 +4897,15 @@ if __name__ == '__main__':
     sftp = SFTPFetcher()
 
     # Sleep for a random timespan to spread possible load on the SFTP server
-    time.sleep(random.randint(0, 15))
+    if sftp.jitter[1] > 0:
+        time.sleep(random.randint(*sftp.jitter))
     
     success = sftp.run()
     
-    for hash in sftp.hash_cache.keys():
-        sftp.debug("Hash for file '%s' was '%s'" % 
-                   (hash, 
-                    sftp.hash_cache[hash].hexdigest()))
-        
-    for file in sftp.file_cache.keys():
-        sftp.debug("File '%s' had %i bytes in cache." % 
-                   (file, 
-                    len(sftp.file_cache[file])))
+    # The caches of the jobs of a configuration file are reported by run_batch()
+    if not sftp.config_file:
+        for cache in (sftp.hash_cache, sftp.file_cache, sftp.payload_cache):
+            sftp.debug(cache.statistics())
     
     # Exit with the return code of the previous function, as it describes a 
     # successfull operation if zero.
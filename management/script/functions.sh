@@ -582,8 +582,11 @@ function update_hafas_data()
 #-------------------------------------------------------------------------------
 # Tries to update the HAFAS server configured in the current environment with 
 # new plan data.
-# This is done by calling the script 'import_hafas_data.sh' with parameters 
-# resulting from the current environment:
+# This is done by calling the script 'import_hafas_data.py' with parameters 
+# resulting from the current environment (the plan data is imported into a 
+# new version directory while the server keeps running, see the script). It 
+# needs a Python 2 interpreter ('python'); without one the script 
+# 'import_hafas_data.sh' is called instead:
 #   - The current command (preverably a server wrapper).
 #   - A default data import directory (the directory 
 #     '/import_hafas_data/${INT_NAME}' within the service users home 
@@ -592,6 +595,7 @@ function update_hafas_data()
 #-------------------------------------------------------------------------------
 {
 	local RETVAL
+	local IMPORT_SCRIPT
 	
 	log_info_and_console "Updating plan data for HAFAS server '${TITLE}'..."
     
@@ -601,7 +605,14 @@ function update_hafas_data()
 		DATA_IMPORT_DIR=$1
 	fi
     
-    ${HAFAS_BASE_DIR}/script/import_hafas_data.sh ${0} ${DATA_IMPORT_DIR} ${PLAN_DIR}
+	if python -c 'import sys; sys.exit(sys.version_info[0] != 2)' > /dev/null 2>&1; then
+		IMPORT_SCRIPT=import_hafas_data.py
+	else
+		log_warning "No Python 2 interpreter found, importing the plan data by 'import_hafas_data.sh'."
+		IMPORT_SCRIPT=import_hafas_data.sh
+	fi
+	
+    ${HAFAS_BASE_DIR}/script/${IMPORT_SCRIPT} ${0} ${DATA_IMPORT_DIR} ${PLAN_DIR}
     RETVAL=$?
 
     if [ ${RETVAL} -ne 0 ]; then
@@ -0,0 +1,1095 @@
+#!/usr/bin/env python
+"""
+NAME
+    Import-HAFAS-Data - Import HAFAS plan data into versioned directories
+
+SYNOPSIS
+    import_hafas_data.py [-h|--help] [-v|--verbose] [--keep-versions <n>] \\
+        [--log-file <file>] [--rollback] [--threads <n>] \\
+        [--incremental] [--write-manifest] \\
+        <server-wrapper> <data_import_dir> <plan_data_dir>
+
+DESCRIPTION
+    Imports the plan data archive found in '<data_import_dir>/incoming' into
+    a HAFAS server, like import_hafas_data.sh, without taking the server down
+    while the archive is extracted. The plan data directory is a symbolic
+    link to the current version of the plan data:
+
+      <plan_data_dir> -> <name>.versions/<YYYYmmdd-HHMMSS>_<archive>
+      <plan_data_dir>.versions/
+          <YYYYmmdd-HHMMSS>_<archive>/            the current plan data
+          <YYYYmmdd-HHMMSS>_<archive>.manifest    its manifest
+          <YYYYmmdd-HHMMSS>_<archive>/            the previous plan data
+          <YYYYmmdd-HHMMSS>_<archive>.manifest
+          previous -> <YYYYmmdd-HHMMSS>_<archive>
+
+    The server wrapper and its configuration keep using the plan data
+    directory as before. A plan data directory which is still a real
+    directory is moved into the versions directory on the first import (a
+    rename, while the server is stopped).
+
+    An import runs these steps:
+
+      1. The archive (a zip archive or a gzipped tar archive) is extracted
+         into a new version directory while the server keeps running with
+         the current plan data. The archive is moved to
+         '<data_import_dir>/deployed' afterwards.
+      2. The server is stopped and the plan data directory is switched to the
+         new version atomically (a symbolic link renamed over the old one).
+      3. The server is started in unsafe mode to test the new plan data. If
+         this fails, the plan data directory is switched back to the previous
+         version and the new version is deleted. Otherwise the test server is
+         stopped and the old version becomes the previous one.
+      4. The server is started again (unless it was not running before).
+
+    The members of zip archives are extracted by several threads in
+    parallel, each reading the archive on its own (see '--threads'); their
+    CRC-32 checksums are verified on the way. Gzipped tar archives are read
+    sequentially, decompressed by 'pigz' (a multi-threaded gzip) in a pipe
+    if it is installed. The size of every extracted file is compared with
+    the size recorded in the archive.
+
+    The manifest of a version lists every extracted file with the SHA-1
+    hash digest of its content, its size and its modification time, one
+    file per line:
+
+      <sha1 hexdigest> <size> <mtime> <name>
+
+    The hash digests are computed while the files are written, so the files
+    are not read again. A version without a manifest (e.g. a migrated plan
+    data directory) gets one when it is needed (see '--write-manifest').
+
+    An incremental import (see '--incremental') compares the archive with
+    the manifest of the current version. A file whose name, size, mode and
+    hash digest are unchanged is hard linked from the current version
+    instead of being written again; only the changed files are written. So
+    a small correction of the timetable does not rewrite the whole plan
+    data, and the unchanged files share the page cache of the running
+    server. The members of zip archives are hashed before they are written,
+    members of tar archives are replaced by the link afterwards.
+
+    So the server is only down for the restart, whatever the size of the
+    plan data. No backup archive of the old plan data is written, the
+    previous version is kept as it is instead. Older versions are deleted
+    (see '--keep-versions').
+
+    The archive must be the only (not hidden) file in the incoming directory.
+    Hidden files (e.g. the partial files of fetch_sftp.py) are ignored. A
+    lock file '<archive>.lock' prevents concurrent imports of the same
+    archive.
+
+    All steps are logged via syslog and into the log file of the updates
+    (see '--log-file').
+
+    This script needs Python 2.6 (extracting zip archives).
+
+OPTIONS
+    --keep-versions
+        The number of plan data versions kept in the versions directory,
+        including the current one (default: 2, i.e. the current and the
+        previous version). The oldest versions are deleted after an import.
+        At least 2 versions are kept.
+
+    --log-file
+        The log file of the updates (default: '/var/opt/hafas/log/update.log').
+
+    --rollback
+        Do not import an archive but switch the plan data directory back to
+        the previous version and restart the server. The version rolled back
+        from becomes the previous one, so a second rollback undoes the first.
+
+    --threads
+        The number of threads extracting the members of zip archives
+        (default: the number of processors).
+
+    --incremental
+        Hard link the files of the current version which did not change into
+        the new version (see DESCRIPTION). The versions share these files
+        then, so this must not be used if the plan data files are changed in
+        place (it would change the previous version too). Files of the
+        current version which changed since its manifest was written are
+        never linked.
+
+    --write-manifest
+        Do not import an archive but write the manifest of the current plan
+        data ('<plan_data_dir>.manifest' for a plan data directory which is
+        not versioned yet). Files whose size and modification time match
+        the existing manifest are not hashed again.
+
+    -v, --verbose
+        Prints the steps taken.
+
+    -h, --help
+        Prints this little help screen.
+
+EXIT CODES
+    0 if the plan data was imported, otherwise 1 (or the exit code of the
+    test start of the server if the new plan data did not work). 65 is
+    returned for invalid arguments.
+
+EXAMPLE
+    Import the plan data of the server wrapper 'hafas' (normally done by
+    its action 'data-update'):
+
+      import_hafas_data.py /etc/init.d/hafas \\
+          /home/hafas/import_hafas_data/hafas-prod-hafas-server-main \\
+          /opt/hafas/plan/5.20/hafas
+"""
+
+# Built-in Python modules
+import errno
+import getopt
+import hashlib
+import os
+import Queue
+import shutil
+import stat
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+import zlib
+
+try:
+    import syslog
+except ImportError:
+    # Not in an UNIX environment, only the log file is written
+    syslog = None
+
+# The suffix of the sibling directory holding the versions of the plan data
+VERSIONS_SUFFIX = '.versions'
+
+# The name of the symbolic link to the previous version (the rollback target)
+PREVIOUS_LINK = 'previous'
+
+# The default log file of the updates (see import_hafas_data.sh)
+DEFAULT_LOG_FILE = '/var/opt/hafas/log/update.log'
+
+# The default number of versions kept (the current and the previous one)
+DEFAULT_KEEP_VERSIONS = 2
+
+# The suffix of the manifest of a version (next to the version directory)
+MANIFEST_SUFFIX = '.manifest'
+
+# The size of the blocks in which members of archives are extracted
+BLOCK_SIZE = 1048576
+
+
+def cpu_count():
+    """Returns the number of processors or 1 if it is unknown."""
+    try:
+        return max(1, os.sysconf('SC_NPROCESSORS_ONLN'))
+    except (AttributeError, ValueError, OSError):
+        return 1
+
+
+def find_program(name):
+    """Returns the pathname of the executable program in the search path or
+    None if it is not installed."""
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        pathname = os.path.join(directory, name)
+        if os.path.isfile(pathname) and os.access(pathname, os.X_OK):
+            return pathname
+    return None
+
+
+def write_member(source, pathname):
+    """Copies the content of the opened member of an archive into the file
+    of the given pathname. Returns its size and the hexdigest of its SHA-1
+    hash."""
+    file_sha = hashlib.sha1()
+    size = 0
+    target = open(pathname, 'wb')
+    try:
+        data = source.read(BLOCK_SIZE)
+        while data:
+            file_sha.update(data)
+            target.write(data)
+            size = size + len(data)
+            data = source.read(BLOCK_SIZE)
+    finally:
+        target.close()
+    return (size, file_sha.hexdigest())
+
+
+def hash_file(pathname):
+    """Returns the hexdigest of the SHA-1 hash of the content of the local
+    file."""
+    file_sha = hashlib.sha1()
+    local_file = open(pathname, 'rb')
+    try:
+        data = local_file.read(BLOCK_SIZE)
+        while data:
+            file_sha.update(data)
+            data = local_file.read(BLOCK_SIZE)
+    finally:
+        local_file.close()
+    return file_sha.hexdigest()
+
+
+def build_manifest(directory, known=None):
+    """Hashes every regular file below the directory and returns the manifest
+    (see read_manifest()). The digest of a file whose size and modification
+    time equal its entry in the given known manifest is taken from there."""
+    manifest = {}
+    for (parent_dir, directory_names, filenames) in os.walk(directory):
+        for filename in filenames:
+            pathname = os.path.join(parent_dir, filename)
+            attributes = os.lstat(pathname)
+            if not stat.S_ISREG(attributes.st_mode):
+                continue
+            name = os.path.relpath(pathname, directory)
+            size = attributes.st_size
+            mtime = int(attributes.st_mtime)
+            entry = known and known.get(name)
+            if entry and entry[:2] == (size, mtime):
+                manifest[name] = entry
+            else:
+                manifest[name] = (size, mtime, hash_file(pathname))
+    return manifest
+
+
+def read_manifest(pathname):
+    """Reads the manifest of a version and returns a dict of the names of the
+    files and their (size, mtime, digest)."""
+    manifest = {}
+    manifest_file = open(pathname)
+    try:
+        for line in manifest_file:
+            (digest, size, mtime, name) = line.rstrip('\n').split(' ', 3)
+            manifest[name] = (int(size), int(mtime), digest)
+    finally:
+        manifest_file.close()
+    return manifest
+
+
+def write_manifest(pathname, manifest):
+    """Writes the manifest (a dict of the names of the files and their size,
+    mtime and digest, see read_manifest()) atomically."""
+    names = manifest.keys()
+    names.sort()
+    temporary_pathname = pathname + '.tmp'
+    manifest_file = open(temporary_pathname, 'w')
+    try:
+        for name in names:
+            (size, mtime, digest) = manifest[name]
+            manifest_file.write("%s %i %i %s\n" % (digest, size, mtime, name))
+    finally:
+        manifest_file.close()
+    os.rename(temporary_pathname, pathname)
+
+
+class PlanImport:
+    """A PlanImport imports a plan data archive into a new version directory
+    of the plan data of a HAFAS server and switches the server to it."""
+
+    def __init__(self):
+        """Initializes this class."""
+        self.server_wrapper = None
+        self.data_import_dir = None
+        self.plan_dir = None
+        self.keep_versions = DEFAULT_KEEP_VERSIONS
+        self.log_file = DEFAULT_LOG_FILE
+        self.rollback = False
+        self.threads = cpu_count()
+        self.incremental = False
+        self.write_manifest = False
+        self.print_verbose = False
+
+        # The current version and its manifest used for an incremental 
+        # import and the files linked from it (see basis_file())
+        self.basis = None
+        self.linked = []
+
+        # Parse command line arguments
+        self.parse_arguments()
+
+        self.versions_dir = self.plan_dir + VERSIONS_SUFFIX
+        self.incoming_dir = os.path.join(self.data_import_dir, 'incoming')
+        self.deployed_dir = os.path.join(self.data_import_dir, 'deployed')
+
+
+    def log(self, message):
+        """Logs the message via syslog and into the log file of the updates
+        (in the format of log_file() of functions.sh) and prints it to the
+        console."""
+        self.write_log(message, 'info')
+        print(message)
+
+
+    def error(self, message):
+        """Logs the error message like log(), but prints it to stderr."""
+        self.write_log(message, 'err')
+        print >> sys.stderr, message
+
+
+    def write_log(self, message, priority):
+        """Logs the message with the given priority ('info' or 'err') via
+        syslog (facility 'local0', see functions.sh) and into the log file of
+        the updates. Failures to write the log file are ignored."""
+        name = os.path.basename(sys.argv[0])
+        if syslog:
+            syslog.openlog(name, 0, syslog.LOG_LOCAL0)
+            syslog.syslog(getattr(syslog, 'LOG_' + priority.upper()),
+                          "(%i) - '%s'" % (os.getpid(), message))
+        try:
+            log_file = open(self.log_file, 'a')
+            try:
+                log_file.write("%s %s (%i) - %s\n" %
+                               (time.strftime("%a, %d %b %Y %H:%M:%S %z"),
+                                name,
+                                os.getpid(),
+                                message))
+            finally:
+                log_file.close()
+        except IOError:
+            pass
+
+
+    def verbose(self, message):
+        """This method prints verbose output if wanted to the console. If no
+        verbosity is wanted, nothing is done instead."""
+        if self.print_verbose:
+            print >> sys.stderr, "%s - %s" % \
+                  (time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime()),
+                   message)
+
+
+    def usage(self, error_code, message=''):
+        """Print usage information and a given message and exit the program."""
+        print >> sys.stderr, __doc__
+
+        if message:
+            print >> sys.stderr, message
+
+        sys.exit(error_code)
+
+
+    def parse_arguments(self):
+        """Read the arguments given at the command line and validate them."""
+        try:
+            options, arguments = getopt.getopt(sys.argv[1:],
+                                               'hv',
+                                               ['help',
+                                                'incremental',
+                                                'keep-versions=',
+                                                'log-file=',
+                                                'rollback',
+                                                'threads=',
+                                                'verbose',
+                                                'write-manifest',
+                                                ])
+        except getopt.error, message:
+            self.usage(65, message)
+
+        for (option, argument) in options:
+            if option in ('-h', '--help'):
+                self.usage(0)
+            elif option in ('-v', '--verbose'):
+                self.print_verbose = True
+            elif option in ('--keep-versions'):
+                try:
+                    self.keep_versions = int(argument)
+                except ValueError:
+                    self.usage(65, "Invalid number of versions '%s'!" %
+                                   (argument))
+                if self.keep_versions < 2:
+                    self.usage(65, "At least 2 versions have to be kept!")
+            elif option in ('--log-file'):
+                self.log_file = argument
+            elif option in ('--rollback'):
+                self.rollback = True
+            elif option in ('--incremental'):
+                self.incremental = True
+            elif option in ('--write-manifest'):
+                self.write_manifest = True
+            elif option in ('--threads'):
+                try:
+                    self.threads = int(argument)
+                except ValueError:
+                    self.usage(65, "Invalid number of threads '%s'!" %
+                                   (argument))
+                if self.threads < 1:
+                    self.usage(65, "At least 1 thread is needed!")
+
+        if len(arguments) != 3:
+            self.usage(65, "Usage: %s <server-wrapper> <data_import_dir> "
+                           "<plan_data_dir>" %
+                           (os.path.basename(sys.argv[0])))
+
+        # The plan data directory may be the symbolic link, so its pathname
+        # is only made absolute but not resolved
+        (self.server_wrapper,
+         self.data_import_dir,
+         self.plan_dir) = [os.path.normpath(os.path.abspath(argument))
+                           for argument in arguments]
+
+
+    def check_directories(self):
+        """Checks the plan data directory, the import directories and the
+        server wrapper. Returns an error message or None if all of them are
+        usable."""
+        for (directory, description) in ((self.plan_dir,
+                                          'Plan data directory'),
+                                         (self.data_import_dir,
+                                          'Base import directory'),
+                                         (self.incoming_dir,
+                                          'Directory for incoming (to be '
+                                          'deployed) plan data'),
+                                         (self.deployed_dir,
+                                          'Directory for the just deployed '
+                                          'plan data')):
+            if not os.path.isdir(directory):
+                return "%s '%s' not found." % (description, directory)
+            if not os.access(directory, os.R_OK | os.W_OK):
+                return "%s '%s' is not writeable." % (description, directory)
+
+        parent_dir = os.path.dirname(self.plan_dir)
+        if not os.access(parent_dir, os.W_OK):
+            return "Directory '%s' of the plan data is not writeable." % \
+                   (parent_dir)
+
+        if not os.path.isfile(self.server_wrapper):
+            return "Server wrapper '%s' not found." % (self.server_wrapper)
+        if not os.access(self.server_wrapper, os.X_OK):
+            return "Server wrapper '%s' is not executable." % \
+                   (self.server_wrapper)
+        return None
+
+
+    def find_archive(self):
+        """Returns the pathname of the archive to be imported, which must be
+        the only (not hidden) file in the incoming directory, or an error
+        message (as a tuple)."""
+        filenames = [filename for filename in os.listdir(self.incoming_dir)
+                     if not filename.startswith('.')]
+        if len(filenames) > 1:
+            return ("Too many files in plan data import directory '%s' "
+                    "(There must be exactly one archive)." %
+                    (self.incoming_dir),)
+        elif not filenames:
+            return ("No file found in plan data import directory '%s' "
+                    "(There must be exactly one archive containing plan "
+                    "data)." %
+                    (self.incoming_dir),)
+        return os.path.join(self.incoming_dir, filenames[0])
+
+
+    def archive_type(self, archive):
+        """Returns the type of the archive ('zip' or 'tar.gz') by its name or
+        None if it is unknown."""
+        name = archive.lower()
+        if name.endswith('.zip'):
+            return 'zip'
+        if name.endswith('.tar.gz') or name.endswith('.tgz'):
+            return 'tar.gz'
+        return None
+
+
+    def member_pathname(self, name, directory, archive):
+        """Returns the pathname of the member of the archive in the given
+        directory. Members with absolute pathnames or leaving the directory
+        are refused by an IOError."""
+        pathname = os.path.normpath(name)
+        if os.path.isabs(pathname) or pathname == os.pardir or \
+           pathname.startswith(os.pardir + os.sep):
+            raise IOError("Invalid member '%s' in archive '%s'" %
+                          (name, archive))
+        return os.path.join(directory, pathname)
+
+
+    def extract_archive(self, archive, directory):
+        """Extracts the archive into the given (empty) directory and returns
+        the manifest of the extracted files (see read_manifest())."""
+        if self.archive_type(archive) == 'zip':
+            return self.extract_zip(archive, directory)
+        return self.extract_tar(archive, directory)
+
+
+    def extract_zip(self, archive, directory):
+        """Extracts the zip archive into the given directory. The directories
+        are created first, then the files are extracted by several threads 
+        (see --threads), the largest files first. Every thread reads the 
+        archive on its own. The CRC-32 checksums of the members are verified
+        by the zipfile module."""
+        opened = zipfile.ZipFile(archive)
+        try:
+            members = opened.infolist()
+        finally:
+            opened.close()
+
+        queue = Queue.Queue()
+        files = []
+        for member in members:
+            pathname = self.member_pathname(member.filename, directory,
+                                            archive)
+            if member.filename.endswith('/'):
+                if not os.path.isdir(pathname):
+                    os.makedirs(pathname)
+                continue
+            if not os.path.isdir(os.path.dirname(pathname)):
+                os.makedirs(os.path.dirname(pathname))
+            files.append((member.file_size, member, pathname))
+        files.sort()
+        files.reverse()
+        for (size, member, pathname) in files:
+            queue.put((member, pathname))
+
+        manifest = {}
+        errors = []
+        threads = []
+        self.verbose("Extracting %i files of archive '%s' to '%s' by %i "
+                     "threads." %
+                     (len(files), archive, directory,
+                      min(self.threads, len(files))))
+        for number in range(min(self.threads, len(files))):
+            thread = threading.Thread(target=self.extract_zip_members,
+                                      args=(archive, queue, manifest, errors))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+        return manifest
+
+
+    def extract_zip_members(self, archive, queue, manifest, errors):
+        """Extracts the members of the zip archive taken from the queue until
+        it is empty (see extract_zip()) and adds them to the manifest. The
+        first error stops the thread and is appended to the list of 
+        errors; the other threads stop as soon as they see it."""
+        opened = zipfile.ZipFile(archive)
+        try:
+            while not errors:
+                try:
+                    (member, pathname) = queue.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    mode = (member.external_attr >> 16) & 0777
+                    entry = self.link_zip_member(opened, member, mode,
+                                                 pathname)
+                    if entry:
+                        manifest[os.path.normpath(member.filename)] = entry
+                        continue
+
+                    source = opened.open(member)
+                    try:
+                        (size, digest) = write_member(source, pathname)
+                    finally:
+                        source.close()
+                    if size != member.file_size:
+                        raise IOError("Member '%s' of archive '%s' has %i "
+                                      "instead of %i bytes" %
+                                      (member.filename, archive, size,
+                                       member.file_size))
+                    if mode:
+                        os.chmod(pathname, mode)
+                    mtime = int(time.mktime(member.date_time + (0, 0, -1)))
+                    os.utime(pathname, (mtime, mtime))
+                except Exception, e:
+                    errors.append(e)
+                    break
+                manifest[os.path.normpath(member.filename)] = (size, mtime,
+                                                               digest)
+        finally:
+            opened.close()
+
+
+    def link_zip_member(self, opened, member, mode, pathname):
+        """Hard links the file of the current version to the given pathname
+        if it equals the member of the opened zip archive (see 
+        --incremental). The member is hashed without writing it. Returns the
+        manifest entry of the linked file or None if it was not linked."""
+        name = os.path.normpath(member.filename)
+        basis = self.basis_file(name, member.file_size, mode)
+        if not basis:
+            return None
+
+        source = opened.open(member)
+        try:
+            file_sha = hashlib.sha1()
+            data = source.read(BLOCK_SIZE)
+            while data:
+                file_sha.update(data)
+                data = source.read(BLOCK_SIZE)
+        finally:
+            source.close()
+
+        (basis_pathname, entry) = basis
+        if file_sha.hexdigest() != entry[2]:
+            return None
+        try:
+            os.link(basis_pathname, pathname)
+        except OSError:
+            return None
+        self.linked.append(entry[0])
+        return entry
+
+
+    def basis_file(self, name, size, mode):
+        """Returns the pathname and the manifest entry of the file of the
+        current version which may equal the member of the archive of the
+        given name, size and mode (0 if unknown) or None if there is none
+        (see --incremental). The file must not have changed since the
+        manifest of the current version was written."""
+        if not self.basis:
+            return None
+        (basis_dir, basis_manifest) = self.basis
+        entry = basis_manifest.get(name)
+        if not entry or entry[0] != size:
+            return None
+
+        pathname = os.path.join(basis_dir, name)
+        try:
+            attributes = os.lstat(pathname)
+        except OSError:
+            return None
+        if not stat.S_ISREG(attributes.st_mode) or \
+           attributes.st_size != size or \
+           int(attributes.st_mtime) != entry[1] or \
+           (mode and stat.S_IMODE(attributes.st_mode) != mode):
+            return None
+        return (pathname, entry)
+
+
+    def extract_tar(self, archive, directory):
+        """Extracts the gzipped tar archive into the given directory in one 
+        pass. The archive is decompressed by pigz in a pipe if it is 
+        installed, otherwise by the gzip module."""
+        pigz = find_program('pigz')
+        process = None
+        if pigz:
+            self.verbose("Decompressing archive '%s' by '%s'." %
+                         (archive, pigz))
+            process = subprocess.Popen([pigz, '-dc', archive],
+                                       stdout=subprocess.PIPE)
+            opened = tarfile.open(fileobj=process.stdout, mode='r|')
+        else:
+            opened = tarfile.open(archive, 'r|gz')
+
+        manifest = {}
+        status = 0
+        try:
+            for member in opened:
+                pathname = self.member_pathname(member.name, directory,
+                                                archive)
+                if member.isdir():
+                    if not os.path.isdir(pathname):
+                        os.makedirs(pathname)
+                    continue
+                if not os.path.isdir(os.path.dirname(pathname)):
+                    os.makedirs(os.path.dirname(pathname))
+                if not member.isfile():
+                    if member.issym() or member.islnk():
+                        self.member_pathname(member.linkname, directory,
+                                             archive)
+                    opened.extract(member, directory)
+                    continue
+
+                source = opened.extractfile(member)
+                try:
+                    (size, digest) = write_member(source, pathname)
+                finally:
+                    source.close()
+                if size != member.size:
+                    raise IOError("Member '%s' of archive '%s' has %i instead"
+                                  " of %i bytes" %
+                                  (member.name, archive, size, member.size))
+                os.chmod(pathname, member.mode & 0777)
+                os.utime(pathname, (member.mtime, member.mtime))
+                manifest[os.path.normpath(member.name)] = (size,
+                                                           int(member.mtime),
+                                                           digest)
+
+                # The written file is replaced by the unchanged file of the
+                # current version (see --incremental)
+                basis = self.basis_file(os.path.normpath(member.name), size,
+                                        member.mode & 0777)
+                if basis and basis[1][2] == digest:
+                    try:
+                        os.link(basis[0], pathname + '.link')
+                        os.rename(pathname + '.link', pathname)
+                    except OSError:
+                        continue
+                    self.linked.append(size)
+                    manifest[os.path.normpath(member.name)] = basis[1]
+        finally:
+            opened.close()
+            if process:
+                process.stdout.close()
+                status = process.wait()
+
+        # Only checked if the archive was read completely, a failure reading
+        # it is reported instead
+        if status != 0:
+            raise IOError("Failed to decompress archive '%s' by '%s'" %
+                          (archive, pigz))
+        return manifest
+
+
+    def create_version(self, archive):
+        """Extracts the archive into a new version directory and returns its
+        pathname. The archive is extracted into a hidden directory first, so
+        the versions directory never holds a partial version. The manifest of
+        the version is written before the version appears."""
+        if not os.path.isdir(self.versions_dir):
+            os.mkdir(self.versions_dir)
+
+        version = "%s_%s" % (time.strftime('%Y%m%d-%H%M%S'),
+                             os.path.basename(archive))
+        version_dir = os.path.join(self.versions_dir, version)
+        partial_dir = os.path.join(self.versions_dir, '.%s.partial' % (version))
+        if os.path.exists(partial_dir):
+            shutil.rmtree(partial_dir)
+        os.mkdir(partial_dir)
+
+        self.basis = None
+        self.linked = []
+        if self.incremental:
+            # A plan data directory which is not versioned yet is the basis
+            # itself
+            current_version_dir = self.current_version() or self.plan_dir
+            self.basis = (current_version_dir,
+                          self.version_manifest(current_version_dir))
+
+        started = time.time()
+        try:
+            manifest = self.extract_archive(archive, partial_dir)
+            write_manifest(version_dir + MANIFEST_SUFFIX, manifest)
+        except:
+            shutil.rmtree(partial_dir, True)
+            raise
+        os.rename(partial_dir, version_dir)
+
+        seconds = time.time() - started
+        size = sum([entry[0] for entry in manifest.values()])
+        self.log("Extracted %i files (%i bytes) in %.1f seconds (%.1f MB/s)." %
+                 (len(manifest), size, seconds,
+                  size / 1048576.0 / max(seconds, 0.001)))
+        if self.basis:
+            self.log("Linked %i unchanged files (%i bytes) from '%s'." %
+                     (len(self.linked), sum(self.linked), self.basis[0]))
+        return version_dir
+
+
+    def version_manifest(self, version_dir):
+        """Returns the manifest of the given version (see read_manifest()). A
+        missing or unreadable manifest is written (see --write-manifest)."""
+        pathname = version_dir + MANIFEST_SUFFIX
+        try:
+            return read_manifest(pathname)
+        except (IOError, ValueError):
+            pass
+        return self.update_manifest(version_dir)
+
+
+    def update_manifest(self, directory):
+        """Writes the manifest of the given plan data directory (or version)
+        next to it and returns it. The digests of the existing manifest are
+        kept for files which did not change in size and modification 
+        time."""
+        pathname = directory + MANIFEST_SUFFIX
+        try:
+            known = read_manifest(pathname)
+        except (IOError, ValueError):
+            known = None
+
+        started = time.time()
+        manifest = build_manifest(directory, known)
+        write_manifest(pathname, manifest)
+        self.log("Wrote manifest '%s' of %i files in %.1f seconds." %
+                 (pathname, len(manifest), time.time() - started))
+        return manifest
+
+
+    def remove_version(self, version_dir):
+        """Deletes the version directory and its manifest."""
+        shutil.rmtree(version_dir, True)
+        try:
+            os.unlink(version_dir + MANIFEST_SUFFIX)
+        except OSError:
+            pass
+
+
+    def current_version(self):
+        """Returns the pathname of the version the plan data directory links
+        to or None if it is no symbolic link (yet)."""
+        if not os.path.islink(self.plan_dir):
+            return None
+        return os.path.join(os.path.dirname(self.plan_dir),
+                            os.readlink(self.plan_dir))
+
+
+    def previous_version(self):
+        """Returns the pathname of the previous version (the rollback target)
+        or None if there is none."""
+        link = os.path.join(self.versions_dir, PREVIOUS_LINK)
+        if not os.path.islink(link):
+            return None
+        version_dir = os.path.join(self.versions_dir, os.readlink(link))
+        if not os.path.isdir(version_dir):
+            return None
+        return version_dir
+
+
+    def replace_link(self, link, target):
+        """Points the symbolic link at the target (relative to the directory
+        of the link) by renaming a new link over it, so the link is switched
+        atomically."""
+        temporary_link = "%s.%i.link" % (link, os.getpid())
+        if os.path.lexists(temporary_link):
+            os.unlink(temporary_link)
+        os.symlink(os.path.relpath(target, os.path.dirname(link)),
+                   temporary_link)
+        os.rename(temporary_link, link)
+
+
+    def migrate_plan_dir(self):
+        """Moves a plan data directory which is still a real directory into
+        the versions directory, so it becomes a version of its own. Returns
+        the pathname of this version or None if the plan data directory was
+        empty (it is removed then)."""
+        if not os.listdir(self.plan_dir):
+            os.rmdir(self.plan_dir)
+            if os.path.exists(self.plan_dir + MANIFEST_SUFFIX):
+                os.unlink(self.plan_dir + MANIFEST_SUFFIX)
+            return None
+
+        if not os.path.isdir(self.versions_dir):
+            os.mkdir(self.versions_dir)
+        version_dir = os.path.join(self.versions_dir,
+                                   "%s_migrated" %
+                                   (time.strftime('%Y%m%d-%H%M%S')))
+        self.log("Moving plan data directory '%s' to '%s'." %
+                 (self.plan_dir, version_dir))
+        os.rename(self.plan_dir, version_dir)
+        if os.path.exists(self.plan_dir + MANIFEST_SUFFIX):
+            os.rename(self.plan_dir + MANIFEST_SUFFIX,
+                      version_dir + MANIFEST_SUFFIX)
+        return version_dir
+
+
+    def switch_version(self, version_dir):
+        """Switches the plan data directory to the given version. A real plan
+        data directory is migrated first (see migrate_plan_dir()). Returns
+        the version switched from."""
+        if os.path.islink(self.plan_dir):
+            old_version_dir = self.current_version()
+        else:
+            old_version_dir = self.migrate_plan_dir()
+
+        self.replace_link(self.plan_dir, version_dir)
+        self.log("Switched plan data directory '%s' to '%s'." %
+                 (self.plan_dir, version_dir))
+        return old_version_dir
+
+
+    def prune_versions(self):
+        """Deletes the oldest versions (by name) except the current and the
+        previous one, so only the given number of versions is kept (see
+        --keep-versions)."""
+        kept = [self.current_version(), self.previous_version()]
+        versions = [filename for filename in os.listdir(self.versions_dir)
+                    if not filename.startswith('.') and
+                    filename != PREVIOUS_LINK and
+                    not filename.endswith(MANIFEST_SUFFIX)]
+        versions.sort()
+        obsolete = [filename for filename in versions
+                    if os.path.join(self.versions_dir, filename) not in kept]
+        for filename in obsolete[:max(0, len(versions) - self.keep_versions)]:
+            version_dir = os.path.join(self.versions_dir, filename)
+            self.verbose("Deleting old plan data version '%s'." %
+                         (version_dir))
+            self.remove_version(version_dir)
+
+
+    def call_server(self, action):
+        """Calls the server wrapper with the given action and returns its exit
+        code."""
+        self.verbose("Calling '%s %s'." % (self.server_wrapper, action))
+        return subprocess.call([self.server_wrapper, action])
+
+
+    def deploy(self, version_dir):
+        """Switches the server to the new version of the plan data and tests
+        it by starting the server in unsafe mode. The previous version is
+        restored if the test fails. Returns the exit code of the test (or 1
+        if the final restart failed)."""
+        self.log("Stopping HAFAS server before updating the plan data.")
+        restart_server = self.call_server('stop') == 0
+        stopped = time.time()
+
+        try:
+            old_version_dir = self.switch_version(version_dir)
+        except OSError, e:
+            self.error("Failed to switch the plan data directory '%s' (%s)." %
+                       (self.plan_dir, str(e)))
+            if restart_server:
+                self.call_server('start')
+            return 1
+
+        self.log("Testing HAFAS plan data by starting the server in unsafe "
+                 "mode...")
+        update_state = self.call_server('start_unsafe')
+        if update_state != 0:
+            self.error("Failed to start HAFAS server with new plan data.")
+            try:
+                if old_version_dir:
+                    self.error("Restoring previous state (using old plan "
+                               "data)!")
+                    self.replace_link(self.plan_dir, old_version_dir)
+                else:
+                    self.error("No previous plan data exists!")
+                    os.unlink(self.plan_dir)
+                    os.mkdir(self.plan_dir)
+            except OSError, e:
+                self.error("Failed to restore the plan data directory '%s' "
+                           "(%s)." %
+                           (self.plan_dir, str(e)))
+            else:
+                self.remove_version(version_dir)
+        else:
+            self.log("Testing HAFAS plan data succeeded!")
+            self.call_server('stop')
+            if old_version_dir:
+                try:
+                    self.replace_link(os.path.join(self.versions_dir,
+                                                   PREVIOUS_LINK),
+                                      old_version_dir)
+                except OSError, e:
+                    self.error("Failed to link the previous plan data "
+                               "version '%s' (%s)." %
+                               (old_version_dir, str(e)))
+
+        if restart_server:
+            self.log("Restarting the HAFAS server (in safe mode).")
+            if self.call_server('start') != 0:
+                self.error("Final restart of HAFAS server failed. Exitting "
+                           "with no HAFAS server running! VERY BAD STATE!!!")
+                return 1
+            self.log("The HAFAS server was down for %.1f seconds." %
+                     (time.time() - stopped))
+        else:
+            self.log("Not Restarting the HAFAS server because it was not "
+                     "running when this script was called!")
+        return update_state
+
+
+    def roll_back(self):
+        """Switches the server back to the previous version of the plan data
+        (see --rollback). Returns the exit code."""
+        previous_version_dir = self.previous_version()
+        if not os.path.islink(self.plan_dir) or not previous_version_dir:
+            self.error("No previous plan data version to roll back to.")
+            return 1
+
+        self.log("Stopping HAFAS server before rolling back the plan data.")
+        restart_server = self.call_server('stop') == 0
+
+        exit_code = 0
+        try:
+            version_dir = self.switch_version(previous_version_dir)
+            self.replace_link(os.path.join(self.versions_dir, PREVIOUS_LINK),
+                              version_dir)
+        except OSError, e:
+            self.error("Failed to roll back the plan data directory '%s' "
+                       "(%s)." %
+                       (self.plan_dir, str(e)))
+            exit_code = 1
+
+        if restart_server and self.call_server('start') != 0:
+            self.error("Restart of HAFAS server failed after the rollback!")
+            return 1
+        return exit_code
+
+
+    def run(self):
+        """Imports the archive of the incoming directory or rolls back to the
+        previous version. Returns the exit code."""
+        self.log("Plan data update initiated for server wrapper '%s'." %
+                 (self.server_wrapper))
+
+        message = self.check_directories()
+        if message:
+            self.error(message)
+            self.error("Plan data update failed for server wrapper '%s'." %
+                       (self.server_wrapper))
+            return 1
+
+        if self.rollback:
+            return self.roll_back()
+
+        if self.write_manifest:
+            try:
+                self.update_manifest(self.current_version() or self.plan_dir)
+            except (IOError, OSError), e:
+                self.error("Failed to write the manifest of the plan data "
+                           "(%s)." %
+                           (str(e)))
+                return 1
+            return 0
+
+        archive = self.find_archive()
+        if isinstance(archive, tuple):
+            self.error(archive[0])
+            return 1
+
+        if not self.archive_type(archive):
+            self.error("Failed to identify archive type of file '%s'." %
+                       (archive))
+            return 1
+
+        lock_pathname = archive + '.lock'
+        try:
+            os.close(os.open(lock_pathname, os.O_WRONLY | os.O_CREAT |
+                                            os.O_EXCL))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            self.error("The lock file of already running plan data update "
+                       "exists ('%s')!" %
+                       (lock_pathname))
+            return 1
+
+        try:
+            self.log("Extracting new plan data from plan data archive '%s'..." %
+                     (archive))
+            # Any failure of the extraction (e.g. an encrypted zip member or
+            # an unsupported compression) leaves the plan data untouched
+            try:
+                version_dir = self.create_version(archive)
+            except Exception, e:
+                self.error("Failed to extract plan data archive '%s' (%s)." %
+                           (archive, str(e)))
+                update_state = 1
+            else:
+                deployed_pathname = os.path.join(
+                    self.deployed_dir,
+                    "%s_%s" % (time.strftime('%Y%m%d-%H%M%S'),
+                               os.path.basename(archive)))
+                os.rename(archive, deployed_pathname)
+                self.log("Extracting new plan data completed (archive moved "
+                         "to '%s')!" %
+                         (deployed_pathname))
+
+                update_state = self.deploy(version_dir)
+                self.prune_versions()
+        finally:
+            os.unlink(lock_pathname)
+
+        if update_state == 0:
+            self.log("Plan data update finished for server wrapper '%s'." %
+                     (self.server_wrapper))
+        else:
+            self.error("Plan data update failed for server wrapper '%s'." %
+                       (self.server_wrapper))
+        return update_state
+
+
+if __name__ == '__main__':
+    sys.exit(PlanImport().run())